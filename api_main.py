@@ -1,16 +1,39 @@
 # api_main.py
+import asyncio
+import hmac
+import json
+import sqlite3
+import threading
 import time
 import logging
+import requests # Job completion callbacks
 from contextlib import asynccontextmanager # For the lifespan manager
-from fastapi import FastAPI, HTTPException, Body, Request 
+from fastapi import FastAPI, HTTPException, Body, Header, Request, Response
+from fastapi.responses import StreamingResponse, JSONResponse
 
 # Your existing modules (ensure these are in the same directory or accessible in PYTHONPATH)
 # And ensure ModelManager uses logging, not Streamlit elements.
 # And ensure PromptTemplates does not have duplicate <|begin_of_text|> if llama_cpp handles it.
-from model_manager import ModelManager 
+from model_variants import ModelVariantRegistry, VariantRoutingPolicy, UnknownModelVariantError
 from prompt_templates import PromptTemplates
-from utils import validate_input, format_response
-# config.py is used by model_manager.py (MODEL_PATH, MODEL_CONFIG)
+from utils import validate_input, validate_callback_url, format_response, parse_report_sections, StreamingResponseFormatter, ReportSectionTracker
+from section_budget import generation_max_tokens
+from inference_queue import InferenceQueue, QueueFullError, QueueDeadlineExceededError, ClientDisconnectedError
+from worker_pool import ModelWorkerPool
+from response_cache import ResponseCache, generation_fingerprint
+from session_store import SessionStore
+from job_queue import JobQueue, JobQueueFullError, IdempotencyConflictError
+from tracking_summary import TrackingSummarizer, TrackingDataError, TrackingDataTooLargeError, render_summary_block
+from health_input_parser import detect_red_flags
+from metrics import (REGISTRY, StageTimer, record_generation_stats, REQUESTS, REQUEST_SECONDS, QUEUE_WAIT_SECONDS,
+                     PREFILL_SECONDS, DECODE_SECONDS_PER_TOKEN, PROMPT_TOKENS, COMPLETION_TOKENS, CACHE_LOOKUPS,
+                     MODEL_LOAD_SECONDS, MODEL_WARMUP_SECONDS, QUEUE_WAITING, QUEUE_RUNNING, SESSIONS, SESSION_STATE_BYTES,
+                     SESSION_FOLLOW_UPS, JOB_QUEUE_DEPTH, JOB_OLDEST_QUEUED_AGE_SECONDS, JOBS_RUNNING, JOB_CALLBACKS,
+                     TRACKING_SAMPLES, TRACKING_RECORDS_SKIPPED, MODEL_VARIANT_REPORTS)
+from config import (MODEL_CONFIG, MODEL_PATH, QUEUE_CONFIG, WORKER_POOL_CONFIG, RESPONSE_CACHE_CONFIG, BATCH_CONFIG,
+                    PROMPT_BUDGET_CONFIG, METRICS_CONFIG, STARTUP_CONFIG, STRUCTURED_OUTPUT_CONFIG, SESSION_CONFIG,
+                    JOB_QUEUE_CONFIG, TRACKING_CONFIG, MODEL_VARIANTS, ADMIN_CONFIG)
+# config.py is also used by model_manager.py (MODEL_PATH, MODEL_CONFIG)
 
 # Configure basic logging 
 # This will show INFO level logs from your app and other libraries like uvicorn.
@@ -18,50 +41,267 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__) # Logger for this specific file
 
 # --- Pydantic Models (for request and response data validation) ---
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
 
 class HealthInput(BaseModel):
     user_input: str = Field(..., 
                             min_length=10, # Basic validation by Pydantic
+                            max_length=PROMPT_BUDGET_CONFIG.get("max_input_characters", 20000),
                             description="All health information provided by the user.")
+    create_session: bool = Field(False,
+                                 description="Keep the conversation for POST /sessions/{session_id}/follow_up (needs SESSION_CONFIG enabled).")
+
+class ReportSections(BaseModel):
+    """The 7 report sections as separate fields (None if the model did not write that section)."""
+    short_term_risks: Optional[str] = None
+    long_term_risks: Optional[str] = None
+    warnings: Optional[str] = None
+    advice: Optional[str] = None
+    food_recommendations: Optional[str] = None
+    exercise_recommendations: Optional[str] = None
+    early_detection_and_preventive_care: Optional[str] = None
 
 class HealthResponse(BaseModel):
     recommendations: str
+    sections: Optional[ReportSections] = None  # recommendations split by section header; None if it has no headers
+    execution_time_seconds: float
+    queue_wait_seconds: float = 0.0  # Time spent waiting for the model in the admission queue
+    queue_depth: int = 0  # Requests already waiting or running when this one was admitted
+    cache_status: str = "disabled"  # "hit", "coalesced" (shared a concurrent identical generation), "miss" or "disabled"
+    session_id: Optional[str] = None  # For POST /sessions/{session_id}/follow_up; None unless create_session was set and sessions are enabled
+    model_variant: Optional[str] = None  # GGUF variant (MODEL_VARIANTS) that wrote the report; the faster one under load
+
+class JobInput(BaseModel):
+    user_input: str = Field(...,
+                            min_length=10,
+                            max_length=PROMPT_BUDGET_CONFIG.get("max_input_characters", 20000),
+                            description="All health information provided by the user.")
+    callback_url: Optional[str] = Field(None,
+                                        max_length=2048,
+                                        description="Optional http(s) URL that receives the finished job (POST, same JSON as GET /jobs/{job_id}).")
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str  # "queued", "running", "succeeded", "failed" or "expired"
+    priority: int  # Higher runs first; red-flag inputs get JOB_QUEUE_CONFIG["red_flag_priority"]
+    red_flags: List[str] = []
+    queue_position: Optional[int] = None  # Jobs that will start before this one, while it is queued
+    attempts: int = 0
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    expires_at: float  # The job expires if it has not started by then
+    result: Optional[HealthResponse] = None  # Once succeeded
+    error: Optional[str] = None
+    callback_status: Optional[str] = None  # "delivered" or "failed" once the callback was attempted
+
+class TrackingSummaryResponse(BaseModel):
+    summary_block: str  # Fixed-size text for the prompt: add it to user_input of /get_health_recommendations or /jobs
+    metrics: Dict[str, dict]  # Aggregates per metric (mean, percentiles, trend_per_week, categories, out_of_range, ...)
+    first_date: str
+    last_date: str
+    records: int
+    samples: int
+    skipped_records: int = 0
+    errors: List[str] = []  # The first skipped records and why
+    ignored_fields: List[str] = []  # Wide-format columns that are not a known metric
+    ingest_seconds: float  # Reading and parsing the upload
+    summary_seconds: float  # NumPy aggregates + summary block
+
+class FollowUpInput(BaseModel):
+    question: str = Field(...,
+                          min_length=2,
+                          max_length=SESSION_CONFIG.get("max_question_characters", 2000),
+                          description="Follow-up question about the report of this session.")
+
+class FollowUpResponse(BaseModel):
+    session_id: str
+    answer: str
+    turn: int  # 1 for the first follow-up of a session
+    session_resume: str  # "kv_state" (only the question was prefilled) or "full_prefill" (state evicted / not available)
+    prompt_tokens: Optional[int] = None
+    prefilled_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    session_state_bytes: int = 0  # Size of the saved llama.cpp state of this session after the answer
+    model_variant: Optional[str] = None
     execution_time_seconds: float
+    queue_wait_seconds: float = 0.0
+    queue_depth: int = 0
+
+class BatchHealthInput(BaseModel):
+    items: List[HealthInput] = Field(...,
+                                     min_length=1,
+                                     max_length=BATCH_CONFIG.get("max_items", 256),
+                                     description="Health records to generate reports for; each one gets its own result.")
 
 # --- Lifespan Management for Model Loading ---
+def _load_model_blocking(num_workers):
+    """Creates and loads the model variants (or worker pool). Blocking; runs in a thread. Returns (instance, loaded)."""
+    # Initialize the model variants (or a pool of worker processes, each with its own variants) and load them.
+    # Both expose generate_response / generate_response_stream; the instance and its status are stored in app.state.
+    if num_workers > 1:
+        model_manager_instance = ModelWorkerPool(
+            num_workers,
+            threads_per_worker=WORKER_POOL_CONFIG.get("threads_per_worker"),
+            pin_cpus=WORKER_POOL_CONFIG.get("pin_cpus", True),
+            startup_timeout_seconds=WORKER_POOL_CONFIG.get("startup_timeout_seconds", 600),
+        )
+        model_loaded = model_manager_instance.start()
+        if not model_loaded:
+            model_manager_instance.shutdown()
+    else:
+        model_manager_instance = ModelVariantRegistry() # One ModelManager per loaded variant (MODEL_VARIANTS)
+        model_loaded = model_manager_instance.load_model() # Default variant + preloaded ones
+    return model_manager_instance, model_loaded
+
+async def _load_and_warm_model(app_instance: FastAPI):
+    """
+    Loads the model in a thread (so the event loop and /health stay responsive), runs the warmup generation
+    and only then attaches the model to app.state. app.state.model_status: loading -> warming -> ready (or failed).
+    """
+    num_workers = WORKER_POOL_CONFIG.get("num_workers", 1)
+    load_started_at = time.perf_counter()
+    model_manager_instance, model_loaded = await asyncio.to_thread(_load_model_blocking, num_workers)
+    model_load_seconds = time.perf_counter() - load_started_at
+    MODEL_LOAD_SECONDS.set(model_load_seconds)
+    logger.info(f"Lifespan event: Startup - Model loading took {model_load_seconds:.2f} seconds.")
+
+    if not model_loaded:
+        app_instance.state.model_status = "failed"
+        logger.error("Lifespan event: Startup - Model loading failed. Check ModelManager's logs for details.")
+        return
+
+    if STARTUP_CONFIG.get("warmup_enabled", True):
+        app_instance.state.model_status = "warming"
+        try:
+            warmup_seconds = await asyncio.to_thread(
+                model_manager_instance.warmup, STARTUP_CONFIG.get("warmup_max_tokens", 16)
+            )
+            MODEL_WARMUP_SECONDS.set(warmup_seconds)
+        except Exception as e:
+            # A failed warmup only costs first-request latency; the model itself loaded fine
+            logger.warning(f"Lifespan event: Startup - Warmup failed, continuing without it: {str(e)}", exc_info=True)
+
+    app_instance.state.model_manager = model_manager_instance
+    # One executor slot per model instance: a llama.cpp context must not be used concurrently.
+    app_instance.state.inference_queue = InferenceQueue(
+        concurrency=num_workers,
+        max_queue_size=QUEUE_CONFIG.get("max_queue_size", 8),
+        retry_after_seconds=QUEUE_CONFIG.get("retry_after_seconds", 15),
+        request_deadline_seconds=QUEUE_CONFIG.get("request_deadline_seconds", 120),
+        disconnect_poll_seconds=QUEUE_CONFIG.get("disconnect_poll_seconds", 0.5),
+    )
+    app_instance.state.model_loaded_successfully = True
+    app_instance.state.model_status = "ready"
+    logger.info("Lifespan event: Startup - Model loaded, warmed up and attached to app.state. Ready.")
+
 @asynccontextmanager
 async def lifespan(app_instance: FastAPI):
     """
     Manages the application's lifespan.
-    Loads the model on startup and can handle cleanup on shutdown.
+    Starts loading the model (in the background unless STARTUP_CONFIG says otherwise) and cleans up on shutdown.
     """
     logger.info("Lifespan event: Startup - Attempting to load model...")
-    
-    # Initialize ModelManager and attempt to load the model.
-    # The model_manager instance and its status will be stored in app.state.
-    model_manager_instance = ModelManager() # Assumes ModelManager uses config.py for paths/params
-    if model_manager_instance.load_model(): # load_model in ModelManager should use its own logger
-        app_instance.state.model_manager = model_manager_instance
-        app_instance.state.model_loaded_successfully = True
-        logger.info("Lifespan event: Startup - Model loaded successfully and attached to app.state.")
+    app_instance.state.model_status = "loading"
+    app_instance.state.model_manager = None
+    app_instance.state.model_loaded_successfully = False
+    app_instance.state.inference_queue = None
+    # Which variant serves the next report, from the queue depth and recent latencies (MODEL_ROUTING_CONFIG)
+    app_instance.state.variant_policy = VariantRoutingPolicy()
+
+    # Response cache (memory LRU + SQLite), independent of whether the model loaded
+    if RESPONSE_CACHE_CONFIG.get("enabled", False):
+        app_instance.state.response_cache = ResponseCache(
+            sqlite_path=RESPONSE_CACHE_CONFIG.get("sqlite_path"),
+            memory_max_entries=RESPONSE_CACHE_CONFIG.get("memory_max_entries", 512),
+            memory_max_bytes=RESPONSE_CACHE_CONFIG.get("memory_max_bytes", 32 * 1024 * 1024),
+            ttl_seconds=RESPONSE_CACHE_CONFIG.get("ttl_seconds", 24 * 3600),
+            sqlite_max_entries=RESPONSE_CACHE_CONFIG.get("sqlite_max_entries", 100000),
+        )
     else:
-        app_instance.state.model_manager = None 
-        app_instance.state.model_loaded_successfully = False
-        logger.error("Lifespan event: Startup - Model loading failed. Check ModelManager's logs for details.")
+        app_instance.state.response_cache = None
+
+    # Follow-up sessions (conversation text + llama.cpp state, memory with spill to disk)
+    if SESSION_CONFIG.get("enabled", False):
+        app_instance.state.session_store = SessionStore(
+            max_sessions=SESSION_CONFIG.get("max_sessions", 1000),
+            ttl_seconds=SESSION_CONFIG.get("ttl_seconds", 1800),
+            memory_max_bytes=SESSION_CONFIG.get("memory_max_bytes", 512 * 1024 * 1024),
+            disk_dir=SESSION_CONFIG.get("disk_dir"),
+            disk_max_bytes=SESSION_CONFIG.get("disk_max_bytes", 4 * 1024 * 1024 * 1024),
+        )
+    else:
+        app_instance.state.session_store = None
+
+    # Asynchronous jobs: the queue is persistent, so jobs submitted before a restart are picked up again. Runners
+    # wait until the model is ready; submissions are accepted while it is still loading.
+    app_instance.state.job_queue = None
+    job_runners = []
+    if JOB_QUEUE_CONFIG.get("enabled", False):
+        try:
+            app_instance.state.job_queue = JobQueue(
+                sqlite_path=JOB_QUEUE_CONFIG.get("sqlite_path"),
+                job_ttl_seconds=JOB_QUEUE_CONFIG.get("job_ttl_seconds", 3600),
+                result_ttl_seconds=JOB_QUEUE_CONFIG.get("result_ttl_seconds", 24 * 3600),
+                max_attempts=JOB_QUEUE_CONFIG.get("max_attempts", 2),
+                max_queued_jobs=JOB_QUEUE_CONFIG.get("max_queued_jobs", 10000),
+            )
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Lifespan event: Startup - Could not open the job queue, jobs are disabled: {str(e)}")
+        if app_instance.state.job_queue is not None:
+            app_instance.state.job_wakeup = asyncio.Event()
+            app_instance.state.job_callback_tasks = set()
+            num_runners = JOB_QUEUE_CONFIG.get("runners") or WORKER_POOL_CONFIG.get("num_workers", 1)
+            job_runners = [asyncio.create_task(_job_runner(app_instance, runner_id)) for runner_id in range(num_runners)]
+
+    if STARTUP_CONFIG.get("background_load", True):
+        # The server accepts connections right away; /health reports loading / warming until the model is ready
+        model_load_task = asyncio.create_task(_load_and_warm_model(app_instance))
+    else:
+        model_load_task = None
+        await _load_and_warm_model(app_instance)
     
     yield  # The application runs while the yield is active
 
     # --- Shutdown logic (optional cleanup) ---
     logger.info("Lifespan event: Shutdown - Cleaning up resources if any...")
+    if model_load_task is not None and not model_load_task.done():
+        # The loading thread cannot be interrupted; its worker processes (if any) are daemons and exit with us
+        model_load_task.cancel()
+        logger.info("Lifespan event: Shutdown - Model was still loading, load abandoned.")
+    # Running jobs go back to the queue (see _run_job) and are picked up after the restart
+    pending_job_tasks = job_runners + list(getattr(app_instance.state, 'job_callback_tasks', ()))
+    for task in pending_job_tasks:
+        task.cancel()
+    await asyncio.gather(*pending_job_tasks, return_exceptions=True)
+    current_inference_queue = getattr(app_instance.state, 'inference_queue', None)
+    if current_inference_queue:
+        current_inference_queue.shutdown()
+    current_response_cache = getattr(app_instance.state, 'response_cache', None)
+    if current_response_cache:
+        current_response_cache.close()
+    current_session_store = getattr(app_instance.state, 'session_store', None)
+    if current_session_store:
+        current_session_store.close()
+    current_job_queue = getattr(app_instance.state, 'job_queue', None)
+    if current_job_queue:
+        current_job_queue.close()
     current_model_manager = getattr(app_instance.state, 'model_manager', None)
-    if current_model_manager:
+    if isinstance(current_model_manager, ModelWorkerPool):
+        current_model_manager.shutdown()
+    elif current_model_manager:
         # If your ModelManager had a specific cleanup method (e.g., to release GPU memory explicitly),
         # you would call it here: e.g., current_model_manager.cleanup()
         logger.info("Lifespan event: Shutdown - Model resources (if any specific cleanup was needed) handled.")
     
     app_instance.state.model_manager = None
     app_instance.state.model_loaded_successfully = False
+    app_instance.state.model_status = "stopped"
+    app_instance.state.inference_queue = None
+    app_instance.state.response_cache = None
+    app_instance.state.session_store = None
+    app_instance.state.job_queue = None
     logger.info("Lifespan event: Shutdown - Application state cleared.")
 
 
@@ -73,59 +313,276 @@ app = FastAPI(
     lifespan=lifespan # Assign the lifespan context manager
 )
 
+class _RequestMetricsMiddleware:
+    """Counts every request by route and status and times it until the last body chunk (streams included)."""
+
+    def __init__(self, app):
+        self.app = app
+        self._known_paths = None # Paths of the app's routes, collected on the first request (all routes exist by then)
+
+    def _endpoint_label(self, scope):
+        # Only known routes become label values, so scanners cannot blow up the metric cardinality
+        # Routes with path parameters are counted under their template (FastAPI's router sets scope["route"])
+        route_path = getattr(scope.get("route"), "path", None)
+        if route_path:
+            return route_path
+        if self._known_paths is None:
+            self._known_paths = frozenset(getattr(route, "path", None) for route in app.routes)
+        return scope["path"] if scope["path"] in self._known_paths else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started_at = time.perf_counter()
+        status = {"code": 500} # Stays 500 if the app fails before sending a response
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = self._endpoint_label(scope)
+            REQUESTS.inc(endpoint=endpoint, status=status["code"])
+            if status["code"] == 200:
+                REQUEST_SECONDS.observe(time.perf_counter() - started_at, endpoint=endpoint)
+
+if METRICS_CONFIG.get("enabled", True):
+    app.add_middleware(_RequestMetricsMiddleware)
+
+# --- Shared Request Helpers ---
+def _timing_requested(request: Request):
+    """True if the client opted in to the per-request timing breakdown (see METRICS_CONFIG)."""
+    if not METRICS_CONFIG.get("timing_header_enabled", False):
+        return False
+    return METRICS_CONFIG.get("timing_request_header", "X-Timing") in request.headers
+
+def _record_queue_wait(timer: StageTimer, queue_info: dict):
+    timer.add("queue_wait", queue_info["queue_wait_seconds"])
+    QUEUE_WAIT_SECONDS.observe(queue_info["queue_wait_seconds"])
+
+def _get_ready_inference(request: Request, endpoint_name: str):
+    """Returns (model_manager, inference_queue) from app.state, or raises 503 if the model is not ready."""
+    model_is_loaded = getattr(request.app.state, 'model_loaded_successfully', False)
+    current_model_manager = getattr(request.app.state, 'model_manager', None)
+    current_inference_queue = getattr(request.app.state, 'inference_queue', None)
+
+    if not model_is_loaded or not current_model_manager or not current_inference_queue:
+        model_status = getattr(request.app.state, 'model_status', 'loading')
+        logger.warning(f"{endpoint_name}: Attempted access when model not ready (status: {model_status}).")
+        if model_status in ("loading", "warming"):
+            raise HTTPException(
+                status_code=503,
+                detail=f"Service Unavailable: Model is {model_status}. Please try again shortly.",
+                headers={"Retry-After": str(STARTUP_CONFIG.get("not_ready_retry_after_seconds", 5))},
+            )
+        raise HTTPException(status_code=503, detail="Service Unavailable: Model is not loaded or failed to load. Please try again later.")
+    return current_model_manager, current_inference_queue
+
+def _build_prompt(user_text: str, endpoint_name: str, model_manager, timer: StageTimer = None):
+    """
+    Validates the user input (400 on failure) and returns (prompt, prompt_tokens), sized with the model's
+    tokenizer so prompt + max_tokens always fits n_ctx (see PromptTemplates.build_prompt_within_budget).
+    Tokenizes the prompt several times (and may load the tokenizer), so callers run it with asyncio.to_thread.
+    """
+    timer = timer or StageTimer()
+    # Pydantic already did a min_length check. Your custom util might have more complex rules.
+    with timer.stage("validate"):
+        is_valid, error_msg = validate_input(user_text, min_length=50) # Using 50 from your original app.py
+    if not is_valid:
+        logger.warning(f"{endpoint_name}: Invalid input - {error_msg}")
+        raise HTTPException(status_code=400, detail=f"Invalid input: {error_msg}")
+
+    formatted_input_for_prompt = PromptTemplates.format_user_input(user_text)
+    try:
+        with timer.stage("prompt_build"):
+            prompt_text, budget_report = PromptTemplates.build_prompt_within_budget(
+                formatted_input_for_prompt,
+                timer.timed("tokenize", model_manager.count_tokens),
+                n_ctx=MODEL_CONFIG.get("n_ctx", 2048),
+                max_tokens=generation_max_tokens(),
+                safety_margin_tokens=PROMPT_BUDGET_CONFIG.get("safety_margin_tokens", 32),
+            )
+    except ValueError as ve:
+        logger.error(f"{endpoint_name}: Prompt does not fit the context window: {str(ve)}")
+        raise HTTPException(status_code=503, detail=f"Processing error: {str(ve)}")
+    if budget_report["dropped"] or budget_report["truncated_characters"]:
+        logger.warning(f"{endpoint_name}: Input too long for the context window, prompt reduced: {budget_report}")
+    else:
+        logger.info(f"{endpoint_name}: Prompt has {budget_report['prompt_tokens']} tokens (reference blocks {budget_report['reference_blocks']}, {budget_report['reasoning_clues']} clues).")
+    logger.debug(f"Generated prompt for model (first 100 chars): {prompt_text[:100]}...")
+    return prompt_text, budget_report["prompt_tokens"]
+
+def _select_variant(app_state, model_manager, inference_queue: InferenceQueue):
+    """The model variant for the next report: the default one, or a faster one while the server is overloaded."""
+    queue_stats = inference_queue.stats()
+    return app_state.variant_policy.select(
+        queue_stats["waiting"] + queue_stats["running"], model_manager.default_variant, model_manager.loaded_variants()
+    )
+
+def _response_cache_key(user_text: str, variant: str = None):
+    # The key covers the template, MODEL_CONFIG and the variant's GGUF file too, so changing any of them never
+    # serves stale reports (and a report of the faster variant is never served as one of the default variant)
+    fingerprint = generation_fingerprint(
+        PromptTemplates.get_template_signature(),
+        {**MODEL_CONFIG, "prompt_budget": PROMPT_BUDGET_CONFIG, "structured_output": STRUCTURED_OUTPUT_CONFIG},
+        MODEL_VARIANTS.get(variant, {}).get("path") or MODEL_PATH,
+    )
+    return ResponseCache.make_key(user_text, fingerprint)
+
+async def _create_session(session_store: SessionStore, prompt_text: str, report_text: str, session_state: dict = None):
+    """
+    Stores the report's conversation for follow-ups and returns the session id (None without a store).
+    Reports that did not come from the model (response cache) get a text-only session: their first follow-up
+    prefills the conversation once.
+    """
+    if session_store is None:
+        return None
+    if session_state is None:
+        session_state = {"text": prompt_text + report_text, "tokens": None, "llama_state": None, "fingerprint": None}
+    # Off the event loop: storing may spill other sessions' states to disk
+    return await asyncio.to_thread(session_store.create, session_state)
+
+async def _generate_report(app_state, user_text: str, prompt_text: str, model_manager, inference_queue: InferenceQueue,
+                           timer: StageTimer, is_disconnected=None, deadline_seconds=None, create_session=False):
+    """
+    Report generation shared by /get_health_recommendations and the job runner: response cache lookup (concurrent
+    identical requests share one generation), generation behind the admission queue, formatting and, if
+    create_session is set, the follow-up session. Returns (final_response, cache_status, queue_info, session_id,
+    model_variant); queue and model errors propagate.
+    """
+    current_response_cache = getattr(app_state, 'response_cache', None)
+    # Capturing the llama.cpp state costs a copy of tens of MB per report; only for clients that asked for it
+    current_session_store = getattr(app_state, 'session_store', None) if create_session else None
+    queue_info = {"queue_depth": 0, "queue_wait_seconds": 0.0} # Stays like this when the cache answers
+    session_state = None # llama.cpp state after the report, if this request generated it
+    model_variant = _select_variant(app_state, model_manager, inference_queue)
+
+    async def generate_and_format():
+        nonlocal queue_info, session_state, model_variant
+        # 3. Generate Response on the inference executor (never on the event loop), behind the admission queue
+        started_at = time.perf_counter()
+        if current_session_store is not None:
+            (raw_response, generation_stats, session_state), queue_info = await inference_queue.run(
+                model_manager.generate_response_for_session,
+                prompt_text,
+                model_variant,
+                is_disconnected=is_disconnected,
+                deadline_seconds=deadline_seconds,
+            )
+        else:
+            (raw_response, generation_stats), queue_info = await inference_queue.run(
+                model_manager.generate_response_with_stats,
+                prompt_text,
+                model_variant,
+                is_disconnected=is_disconnected,
+                deadline_seconds=deadline_seconds,
+            )
+        app_state.variant_policy.observe_latency(time.perf_counter() - started_at)
+        model_variant = generation_stats.get("model_variant", model_variant) # Differs if it was unloaded meanwhile
+        MODEL_VARIANT_REPORTS.inc(variant=model_variant)
+        _record_queue_wait(timer, queue_info)
+        timer.add_generation_stats(generation_stats)
+        record_generation_stats(generation_stats)
+        # 4. Format Response (using your existing util)
+        with timer.stage("format"):
+            return format_response(raw_response)
+
+    if current_response_cache is not None:
+        # Identical inputs are served from the cache; concurrent identical requests share one generation.
+        # If the leading request's client disconnects, the others generate themselves.
+        final_response, cache_status = await current_response_cache.get_or_compute(
+            _response_cache_key(user_text, model_variant),
+            generate_and_format,
+            retry_exceptions=(ClientDisconnectedError,),
+        )
+        CACHE_LOOKUPS.inc(result=cache_status)
+    else:
+        final_response, cache_status = await generate_and_format(), "disabled"
+    session_id = await _create_session(current_session_store, prompt_text, final_response, session_state)
+    return final_response, cache_status, queue_info, session_id, model_variant
+
+def _queue_full_http_exception(qf: QueueFullError):
+    return HTTPException(
+        status_code=QUEUE_CONFIG.get("full_status_code", 429),
+        detail=f"Server busy: {qf.queue_depth} requests are already in the queue. Please retry later.",
+        headers={"Retry-After": str(qf.retry_after_seconds)},
+    )
+
+def _queue_deadline_http_exception(de: QueueDeadlineExceededError):
+    return HTTPException(
+        status_code=503,
+        detail="Server busy: the request timed out while waiting for the model. Please retry later.",
+        headers={"Retry-After": str(de.retry_after_seconds)},
+    )
+
 # --- API Endpoint ---
 @app.post("/get_health_recommendations", response_model=HealthResponse)
 async def get_health_recommendations_endpoint(
     request: Request, # Inject the Request object to access app.state
+    response: Response, # Used to add the opt-in Server-Timing header
     payload: HealthInput = Body(...) # Use the Pydantic model for the request body
 ):
     """
     Accepts user health information string (input parameter) and returns 
     personalized health recommendations (response back).
     This endpoint functions like a programmatic interface (e.g., similar to calling an API like ChatGPT).
+    With the METRICS_CONFIG timing request header set, a Server-Timing header breaks the time down per stage.
     """
     logger.info(f"Received request for /get_health_recommendations with input length: {len(payload.user_input)}")
 
     # Access model status and instance from app.state
-    model_is_loaded = getattr(request.app.state, 'model_loaded_successfully', False)
-    current_model_manager = getattr(request.app.state, 'model_manager', None)
-
-    if not model_is_loaded or not current_model_manager:
-        logger.warning("/get_health_recommendations: Attempted access when model not ready.")
-        raise HTTPException(status_code=503, detail="Service Unavailable: Model is not loaded or failed to load. Please try again later.")
+    current_model_manager, current_inference_queue = _get_ready_inference(request, "/get_health_recommendations")
 
     user_text = payload.user_input
 
-    # 1. Validate Input (using your existing util)
-    # Pydantic already did a min_length check. Your custom util might have more complex rules.
-    is_valid, error_msg = validate_input(user_text, min_length=50) # Using 50 from your original app.py
-    if not is_valid:
-        logger.warning(f"/get_health_recommendations: Invalid input - {error_msg}")
-        raise HTTPException(status_code=400, detail=f"Invalid input: {error_msg}")
+    timer = StageTimer()
+
+    # 1. Validate Input and 2. Create Prompt (using your existing utils and PromptTemplates)
+    prompt_text, _ = await asyncio.to_thread(_build_prompt, user_text, "/get_health_recommendations", current_model_manager, timer)
 
     try:
         start_time = time.time()
 
-        # 2. Format input and Create Prompt (using your existing PromptTemplates)
-        formatted_input_for_prompt = PromptTemplates.format_user_input(user_text)
-        prompt_text = PromptTemplates.create_health_advisor_prompt(formatted_input_for_prompt)
-        logger.debug(f"Generated prompt for model (first 100 chars): {prompt_text[:100]}...")
-        
-        # 3. Generate Response (using the model_manager from app.state)
-        raw_response = current_model_manager.generate_response(prompt_text)
+        final_response, cache_status, queue_info, session_id, model_variant = await _generate_report(
+            request.app.state, user_text, prompt_text, current_model_manager, current_inference_queue, timer,
+            is_disconnected=request.is_disconnected, create_session=payload.create_session,
+        )
+        logger.debug(f"Formatted response (first 100 chars): {final_response[:100]}...")
+        timer.observe_all()
+        if _timing_requested(request):
+            response.headers["Server-Timing"] = timer.server_timing_header()
         
         end_time = time.time()
         execution_time = end_time - start_time
-        logger.info(f"/get_health_recommendations: Response generated in {execution_time:.2f} seconds.")
-
-        # 4. Format Response (using your existing util)
-        final_response = format_response(raw_response)
-        logger.debug(f"Formatted response (first 100 chars): {final_response[:100]}...")
+        logger.info(
+            f"/get_health_recommendations: Response ready in {execution_time:.2f} seconds ({model_variant}, cache {cache_status}, "
+            f"queue wait {queue_info['queue_wait_seconds']:.2f}s, queue depth at admission {queue_info['queue_depth']})."
+        )
 
+        sections = parse_report_sections(final_response)
         return HealthResponse(
             recommendations=final_response,
-            execution_time_seconds=round(execution_time, 2)
+            sections=ReportSections(**sections) if sections else None,
+            execution_time_seconds=round(execution_time, 2),
+            queue_wait_seconds=round(queue_info["queue_wait_seconds"], 2),
+            queue_depth=queue_info["queue_depth"],
+            cache_status=cache_status,
+            session_id=session_id,
+            model_variant=model_variant
         )
+    except QueueFullError as qf:
+        logger.warning(f"/get_health_recommendations: {str(qf)}")
+        raise _queue_full_http_exception(qf)
+    except QueueDeadlineExceededError as de:
+        logger.warning(f"/get_health_recommendations: {str(de)}")
+        raise _queue_deadline_http_exception(de)
+    except ClientDisconnectedError:
+        logger.info("/get_health_recommendations: Client disconnected while queued, request dropped before generation.")
+        return Response(status_code=499) # Client Closed Request; nobody is listening anymore
     except ValueError as ve: 
         logger.error(f"ValueError during processing in /get_health_recommendations: {str(ve)}", exc_info=True)
         raise HTTPException(status_code=503, detail=f"Processing error: {str(ve)}") 
@@ -133,20 +590,831 @@ async def get_health_recommendations_endpoint(
         logger.error(f"Generic error in /get_health_recommendations: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="An internal server error occurred while generating recommendations.")
 
+# --- Streaming Helpers ---
+async def _iterate_on_executor(inference_queue: InferenceQueue, request: Request, generator_function, *args, run_info=None):
+    """
+    Runs generator_function(*args) on the inference executor (behind the admission queue) and yields
+    (item, received_at) on the event loop as the items are produced. Queue and generation errors are raised
+    after the items produced before them; `run_info` receives the queue info, the time the generator
+    started running (generation_started_at, time.time()) and its return value (generator_result) on success.
+    Closing this generator early (e.g. the client disconnected) stops the producer at its next item.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stop_generation = threading.Event()
+    generation_info = {}
+
+    def produce():
+        # Runs on the inference executor; hands every item over to the event loop.
+        generation_info["generation_started_at"] = time.time()
+        generator = generator_function(*args)
+        try:
+            while True:
+                try:
+                    item = next(generator)
+                except StopIteration as stop:
+                    generation_info["generator_result"] = stop.value
+                    break
+                if stop_generation.is_set(): # Nobody is reading anymore, stop decoding
+                    break
+                loop.call_soon_threadsafe(items.put_nowait, (item, time.time()))
+        finally:
+            generator.close()
+
+    generation = asyncio.create_task(inference_queue.run(produce, is_disconnected=request.is_disconnected))
+    # Sentinel; queued after every item because the executor future completes after the last call_soon_threadsafe
+    generation.add_done_callback(lambda _: items.put_nowait(None))
+    try:
+        while True:
+            entry = await items.get()
+            if entry is None:
+                break
+            yield entry
+        _, queue_info = generation.result() # Raises queue / generation errors
+        if run_info is not None:
+            run_info.update(queue_info)
+            run_info.update(generation_info)
+    finally:
+        stop_generation.set()
+        if not generation.done():
+            generation.cancel() # Drops a request that is still waiting in the queue
+
+def _check_queue_capacity(inference_queue: InferenceQueue, endpoint_name: str):
+    # Reject before a 200 + streamed body starts, so clients still get a proper 429/503 + Retry-After
+    try:
+        inference_queue.check_capacity()
+    except QueueFullError as qf:
+        logger.warning(f"{endpoint_name}: {str(qf)}")
+        raise _queue_full_http_exception(qf)
+
+# --- Streaming API Endpoint (Server-Sent Events) ---
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/get_health_recommendations/stream")
+async def stream_health_recommendations_endpoint(
+    request: Request,
+    payload: HealthInput = Body(...)
+):
+    """
+    Streaming variant of /get_health_recommendations. Sends Server-Sent Events:
+    - `token`: the next piece of (already formatted) report text
+    - `section`: a "**N. ...**" report header has been completed (the previous section is finished)
+    - `done`: time to first token, tokens per second, total (generated) tokens, prompt and prefilled tokens, prefill time, the model variant,
+      the session id for follow-ups if create_session was set (plus `server_timing` in ms per stage if the METRICS_CONFIG timing request header was sent)
+    - `error`: the request could not be served (queue timeout, model failure)
+    """
+    logger.info(f"Received request for /get_health_recommendations/stream with input length: {len(payload.user_input)}")
+    current_model_manager, current_inference_queue = _get_ready_inference(request, "/get_health_recommendations/stream")
+    timer = StageTimer()
+    prompt_text, prompt_tokens = await asyncio.to_thread(
+        _build_prompt, payload.user_input, "/get_health_recommendations/stream", current_model_manager, timer
+    )
+    timing_requested = _timing_requested(request)
+    current_session_store = getattr(request.app.state, 'session_store', None) if payload.create_session else None
+
+    _check_queue_capacity(current_inference_queue, "/get_health_recommendations/stream")
+    model_variant = _select_variant(request.app.state, current_model_manager, current_inference_queue)
+
+    start_time = time.time()
+
+    async def event_source():
+        formatter = StreamingResponseFormatter()
+        section_tracker = ReportSectionTracker()
+        first_token_time = None
+        last_token_time = None
+        total_tokens = 0
+        queue_info = {}
+        try:
+            async for piece, received_at in _iterate_on_executor(
+                current_inference_queue, request, current_model_manager.generate_response_stream, prompt_text, model_variant,
+                run_info=queue_info,
+            ):
+                total_tokens += 1
+                if first_token_time is None:
+                    first_token_time = received_at
+                last_token_time = received_at
+                text = formatter.feed(piece)
+                if text:
+                    yield _sse_event("token", {"text": text})
+                    for section_number, title in section_tracker.feed(text):
+                        yield _sse_event("section", {
+                            "section": section_number,
+                            "title": title,
+                            "completed_section": section_number - 1 if section_number > 1 else None,
+                        })
+        except QueueDeadlineExceededError as de:
+            logger.warning(f"/get_health_recommendations/stream: {str(de)}")
+            yield _sse_event("error", {"status_code": 503, "detail": "Server busy: the request timed out while waiting for the model.", "retry_after_seconds": de.retry_after_seconds})
+            return
+        except QueueFullError as qf:
+            logger.warning(f"/get_health_recommendations/stream: {str(qf)}")
+            yield _sse_event("error", {"status_code": QUEUE_CONFIG.get("full_status_code", 429), "detail": "Server busy. Please retry later.", "retry_after_seconds": qf.retry_after_seconds})
+            return
+        except ClientDisconnectedError:
+            logger.info("/get_health_recommendations/stream: Client disconnected while queued, request dropped before generation.")
+            return
+        except Exception as e:
+            logger.error(f"Generic error in /get_health_recommendations/stream: {str(e)}", exc_info=True)
+            yield _sse_event("error", {"status_code": 500, "detail": "An internal server error occurred while generating recommendations."})
+            return
+
+        text = formatter.finish()
+        if text:
+            yield _sse_event("token", {"text": text})
+
+        end_time = time.time()
+        generation_stats = queue_info.get("generator_result") or {}
+        decode_seconds = (last_token_time - first_token_time) if first_token_time else 0.0
+        request.app.state.variant_policy.observe_latency(end_time - queue_info["generation_started_at"] + queue_info["queue_wait_seconds"])
+        MODEL_VARIANT_REPORTS.inc(variant=model_variant)
+        _record_queue_wait(timer, queue_info)
+        PROMPT_TOKENS.inc(prompt_tokens)
+        COMPLETION_TOKENS.inc(total_tokens)
+        if first_token_time is not None:
+            # Seen from here, prefill (incl. the prefix KV restore) ends with the first token
+            prefill_seconds = first_token_time - queue_info["generation_started_at"]
+            timer.add("prefill", prefill_seconds)
+            timer.add("decode", decode_seconds)
+            PREFILL_SECONDS.observe(prefill_seconds)
+            if total_tokens > 1:
+                DECODE_SECONDS_PER_TOKEN.observe(decode_seconds / (total_tokens - 1))
+        timer.observe_all()
+        summary = {
+            "time_to_first_token_seconds": round(first_token_time - start_time, 3) if first_token_time else None,
+            "tokens_per_second": round((total_tokens - 1) / decode_seconds, 2) if decode_seconds > 0 else None,
+            "total_tokens": total_tokens,
+            "prompt_tokens": prompt_tokens,
+            # Prompt tokens really evaluated (not restored from the prefix KV state) and the time spent on them only;
+            # None if the model cannot report them
+            "prefilled_tokens": generation_stats.get("prefilled_tokens"),
+            "prefill_seconds": round(generation_stats["prefill_seconds"], 4) if generation_stats.get("prefill_seconds") is not None else None,
+            "execution_time_seconds": round(end_time - start_time, 2),
+            "queue_wait_seconds": round(queue_info["queue_wait_seconds"], 2),
+            "queue_depth": queue_info["queue_depth"],
+            "model_variant": model_variant,
+            "sections_completed": section_tracker.current_section or 0,
+            "sections": parse_report_sections(section_tracker.text),
+            # Text-only session: the stream does not hand back the llama.cpp state, the first follow-up prefills
+            "session_id": await _create_session(current_session_store, prompt_text, section_tracker.text),
+        }
+        if timing_requested:
+            summary["server_timing"] = timer.as_milliseconds()
+        logger.info(f"/get_health_recommendations/stream: Stream finished: {summary}")
+        yield _sse_event("done", summary)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # Disable proxy buffering
+    )
+
+# --- Batch API Endpoint (NDJSON, results in completion order) ---
+@app.post("/get_health_recommendations/batch")
+async def batch_health_recommendations_endpoint(
+    request: Request,
+    payload: BatchHealthInput = Body(...)
+):
+    """
+    Generates reports for many records in one request. The records are decoded concurrently as parallel
+    sequences of one llama.cpp context (continuous batching, the system prompt is evaluated once and shared).
+    Streams one JSON object per line as each item finishes (not in input order):
+    {"index", "recommendations", "sections", "error", "cache_status", "model_variant", "prompt_tokens", "completion_tokens",
+    "seconds"}
+    followed by a final {"summary": {...}} line. Invalid items get an error line and do not fail the batch.
+    """
+    logger.info(f"Received request for /get_health_recommendations/batch with {len(payload.items)} items")
+    current_model_manager, current_inference_queue = _get_ready_inference(request, "/get_health_recommendations/batch")
+    _check_queue_capacity(current_inference_queue, "/get_health_recommendations/batch")
+    current_response_cache = getattr(request.app.state, 'response_cache', None)
+    model_variant = _select_variant(request.app.state, current_model_manager, current_inference_queue)
+
+    start_time = time.time()
+
+    async def result_lines():
+        summary = {"items": len(payload.items), "errors": 0, "cache_hits": 0, "completion_tokens": 0, "model_variant": model_variant}
+        to_generate = [] # (index, prompt_text, cache_key)
+        for index, item in enumerate(payload.items):
+            try:
+                prompt_text, _ = await asyncio.to_thread(
+                    _build_prompt, item.user_input, "/get_health_recommendations/batch", current_model_manager
+                )
+            except HTTPException as he:
+                summary["errors"] += 1
+                yield json.dumps({"index": index, "recommendations": None, "error": he.detail, "cache_status": None}) + "\n"
+                continue
+            cache_key = _response_cache_key(item.user_input, model_variant) if current_response_cache is not None else None
+            cached = await current_response_cache.get_async(cache_key) if cache_key else None
+            if cache_key:
+                CACHE_LOOKUPS.inc(result="hit" if cached is not None else "miss")
+            if cached is not None:
+                summary["cache_hits"] += 1
+                yield json.dumps({"index": index, "recommendations": cached, "sections": parse_report_sections(cached), "error": None, "cache_status": "hit", "model_variant": model_variant}) + "\n"
+                continue
+            to_generate.append((index, prompt_text, cache_key))
+
+        queue_info = {"queue_depth": 0, "queue_wait_seconds": 0.0}
+        decode_started_at = None
+        if to_generate:
+            try:
+                async for result, received_at in _iterate_on_executor(
+                    current_inference_queue, request, current_model_manager.generate_batch,
+                    [prompt_text for _, prompt_text, _ in to_generate], model_variant,
+                    run_info=queue_info,
+                ):
+                    if decode_started_at is None:
+                        decode_started_at = received_at - result["seconds"]
+                    index, _, cache_key = to_generate[result["index"]]
+                    recommendations = None
+                    if result["error"] is None:
+                        recommendations = format_response(result["text"])
+                        if cache_key:
+                            await current_response_cache.put_async(cache_key, recommendations)
+                    else:
+                        summary["errors"] += 1
+                    summary["completion_tokens"] += result["completion_tokens"]
+                    MODEL_VARIANT_REPORTS.inc(variant=result.get("model_variant", model_variant))
+                    PROMPT_TOKENS.inc(result["prompt_tokens"])
+                    COMPLETION_TOKENS.inc(result["completion_tokens"])
+                    yield json.dumps({
+                        "index": index,
+                        "recommendations": recommendations,
+                        "sections": parse_report_sections(recommendations) if recommendations else None,
+                        "error": result["error"],
+                        "cache_status": "miss" if cache_key else "disabled",
+                        "model_variant": result.get("model_variant", model_variant),
+                        "prompt_tokens": result["prompt_tokens"],
+                        "completion_tokens": result["completion_tokens"],
+                        "seconds": result["seconds"],
+                    }) + "\n"
+            except QueueDeadlineExceededError as de:
+                logger.warning(f"/get_health_recommendations/batch: {str(de)}")
+                yield json.dumps({"error": "Server busy: the request timed out while waiting for the model.", "status_code": 503, "retry_after_seconds": de.retry_after_seconds}) + "\n"
+                return
+            except QueueFullError as qf:
+                logger.warning(f"/get_health_recommendations/batch: {str(qf)}")
+                yield json.dumps({"error": "Server busy. Please retry later.", "status_code": QUEUE_CONFIG.get("full_status_code", 429), "retry_after_seconds": qf.retry_after_seconds}) + "\n"
+                return
+            except ClientDisconnectedError:
+                logger.info("/get_health_recommendations/batch: Client disconnected while queued, batch dropped before generation.")
+                return
+            except Exception as e:
+                logger.error(f"Generic error in /get_health_recommendations/batch: {str(e)}", exc_info=True)
+                yield json.dumps({"error": "An internal server error occurred while generating recommendations.", "status_code": 500}) + "\n"
+                return
+
+        end_time = time.time()
+        decode_seconds = (end_time - decode_started_at) if decode_started_at else 0.0
+        if to_generate:
+            QUEUE_WAIT_SECONDS.observe(queue_info["queue_wait_seconds"])
+        summary.update({
+            "generated": len(to_generate),
+            "tokens_per_second": round(summary["completion_tokens"] / decode_seconds, 2) if decode_seconds > 0 else None,
+            "execution_time_seconds": round(end_time - start_time, 2),
+            "queue_wait_seconds": round(queue_info["queue_wait_seconds"], 2),
+            "queue_depth": queue_info["queue_depth"],
+        })
+        logger.info(f"/get_health_recommendations/batch: Batch finished: {summary}")
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return StreamingResponse(
+        result_lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Asynchronous Jobs (submit / poll / callback) ---
+def _job_response(job: dict):
+    return JobResponse(
+        job_id=job["id"],
+        status=job["status"],
+        priority=job["priority"],
+        red_flags=job["red_flags"],
+        queue_position=job.get("queue_position"),
+        attempts=job["attempts"],
+        created_at=job["created_at"],
+        started_at=job["started_at"],
+        finished_at=job["finished_at"],
+        expires_at=job["expires_at"],
+        result=job["result"],
+        error=job["error"],
+        callback_status=job["callback_status"],
+    )
+
+def _deliver_job_callback(job_queue: JobQueue, job_id: str):
+    """POSTs the finished job to its callback_url, retrying with backoff. Blocking; runs in a thread."""
+    job = job_queue.get(job_id)
+    if job is None or not job["callback_url"]:
+        return
+    payload = _job_response(job).model_dump()
+    max_attempts = JOB_QUEUE_CONFIG.get("callback_max_attempts", 3)
+    for attempt in range(1, max_attempts + 1):
+        # Checked again: the host may resolve to another address now than at submission
+        is_valid, error_msg = validate_callback_url(job["callback_url"], JOB_QUEUE_CONFIG.get("callback_allowed_hosts"))
+        if not is_valid:
+            logger.warning(f"Job {job_id}: callback not delivered: {error_msg}")
+            break
+        try:
+            callback_response = requests.post(
+                job["callback_url"], json=payload, timeout=JOB_QUEUE_CONFIG.get("callback_timeout_seconds", 10),
+                allow_redirects=False, # A redirect could point at an address the check above would reject
+            )
+            if callback_response.status_code < 300:
+                job_queue.set_callback_status(job_id, "delivered")
+                JOB_CALLBACKS.inc(result="delivered")
+                logger.info(f"Job {job_id}: callback delivered to {job['callback_url']}.")
+                return
+            error = f"HTTP {callback_response.status_code}"
+        except requests.RequestException as e:
+            error = str(e)
+        logger.warning(f"Job {job_id}: callback attempt {attempt}/{max_attempts} to {job['callback_url']} failed: {error}")
+        if attempt < max_attempts:
+            time.sleep(2 ** attempt)
+    job_queue.set_callback_status(job_id, "failed")
+    JOB_CALLBACKS.inc(result="failed")
+
+async def _run_job(app_instance: FastAPI, job: dict):
+    """Generates one claimed job like /get_health_recommendations and records the result in the job queue."""
+    job_queue = app_instance.state.job_queue
+    timer = StageTimer()
+    start_time = time.time()
+    try:
+        current_model_manager = app_instance.state.model_manager
+        current_inference_queue = app_instance.state.inference_queue
+        prompt_text, _ = await asyncio.to_thread(_build_prompt, job["user_input"], "/jobs", current_model_manager, timer)
+        final_response, cache_status, queue_info, session_id, model_variant = await _generate_report(
+            app_instance.state, job["user_input"], prompt_text, current_model_manager, current_inference_queue, timer,
+            deadline_seconds=max(1.0, job["expires_at"] - time.time()), # A job may wait for the model until it expires
+        )
+    except asyncio.CancelledError:
+        await asyncio.to_thread(job_queue.release, job["id"]) # Shutdown: the job runs again after the restart
+        raise
+    except HTTPException as he:
+        # Invalid input or a prompt that cannot fit; trying again would not help
+        await asyncio.to_thread(job_queue.fail, job["id"], str(he.detail))
+    except QueueFullError as qf:
+        # The synchronous endpoints keep the model busy; put the job back and try again later
+        await asyncio.to_thread(job_queue.release, job["id"])
+        logger.info(f"Job {job['id']}: inference queue is full, retrying in {qf.retry_after_seconds}s.")
+        await asyncio.sleep(qf.retry_after_seconds)
+        return
+    except QueueDeadlineExceededError:
+        logger.warning(f"Job {job['id']}: expired while waiting for the model.")
+        await asyncio.to_thread(job_queue.expire, job["id"])
+    except Exception as e:
+        status = await asyncio.to_thread(job_queue.fail, job["id"], str(e), retry=True)
+        logger.error(f"Job {job['id']}: generation failed (job is {status} now): {str(e)}", exc_info=True)
+    else:
+        timer.observe_all()
+        execution_time = time.time() - start_time
+        sections = parse_report_sections(final_response)
+        await asyncio.to_thread(job_queue.complete, job["id"], HealthResponse(
+            recommendations=final_response,
+            sections=ReportSections(**sections) if sections else None,
+            execution_time_seconds=round(execution_time, 2),
+            queue_wait_seconds=round(queue_info["queue_wait_seconds"], 2),
+            queue_depth=queue_info["queue_depth"],
+            cache_status=cache_status,
+            session_id=session_id,
+            model_variant=model_variant,
+        ).model_dump())
+        logger.info(f"Job {job['id']}: finished in {execution_time:.2f} seconds (cache {cache_status}, {time.time() - job['created_at']:.2f}s after submission).")
+
+    if job["callback_url"]:
+        callback_task = asyncio.create_task(asyncio.to_thread(_deliver_job_callback, job_queue, job["id"]))
+        app_instance.state.job_callback_tasks.add(callback_task)
+        callback_task.add_done_callback(app_instance.state.job_callback_tasks.discard)
+
+async def _job_runner(app_instance: FastAPI, runner_id: int):
+    """Takes jobs from the persistent queue (highest priority first) and generates them, one at a time."""
+    job_queue = app_instance.state.job_queue
+    wakeup = app_instance.state.job_wakeup
+    poll_seconds = JOB_QUEUE_CONFIG.get("poll_seconds", 1.0)
+    while True:
+        try:
+            if not getattr(app_instance.state, 'model_loaded_successfully', False):
+                await asyncio.sleep(poll_seconds) # Jobs stay queued while the model loads
+                continue
+            wakeup.clear()
+            job = await asyncio.to_thread(job_queue.claim_next) # Also expires and purges old jobs
+            if job is None:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), poll_seconds) # Set by POST /jobs
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.info(f"Job runner {runner_id}: starting job {job['id']} (priority {job['priority']}, attempt {job['attempts']}).")
+            await _run_job(app_instance, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job runner {runner_id}: unexpected error, continuing: {str(e)}", exc_info=True)
+            await asyncio.sleep(poll_seconds)
+
+def _get_job_queue(request: Request):
+    current_job_queue = getattr(request.app.state, 'job_queue', None)
+    if current_job_queue is None:
+        raise HTTPException(status_code=404, detail="Jobs are disabled.")
+    return current_job_queue
+
+@app.post("/jobs", response_model=JobResponse, status_code=202)
+async def submit_job_endpoint(
+    request: Request,
+    response: Response,
+    payload: JobInput = Body(...),
+    idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    """
+    Queues a report job and answers right away (202) with the job id; poll GET /jobs/{job_id} for the result or
+    pass a callback_url. Jobs are persistent and survive restarts. Inputs with red flags (e.g. chest pain plus
+    shortness of breath) are scheduled before all others. With an Idempotency-Key header, repeating the same
+    submission returns the existing job (200) instead of queueing another one.
+    """
+    current_job_queue = _get_job_queue(request)
+    is_valid, error_msg = validate_input(payload.user_input, min_length=50)
+    if not is_valid:
+        logger.warning(f"/jobs: Invalid input - {error_msg}")
+        raise HTTPException(status_code=400, detail=f"Invalid input: {error_msg}")
+    if payload.callback_url:
+        # Resolves the host (blocking DNS lookup)
+        is_valid, error_msg = await asyncio.to_thread(
+            validate_callback_url, payload.callback_url, JOB_QUEUE_CONFIG.get("callback_allowed_hosts")
+        )
+        if not is_valid:
+            logger.warning(f"/jobs: Invalid callback_url - {error_msg}")
+            raise HTTPException(status_code=400, detail=f"Invalid input: {error_msg}.")
+
+    red_flags = detect_red_flags(payload.user_input)
+    try:
+        job, created = await asyncio.to_thread(
+            current_job_queue.submit,
+            payload.user_input,
+            priority=JOB_QUEUE_CONFIG.get("red_flag_priority", 10) if red_flags else 0,
+            red_flags=red_flags,
+            idempotency_key=idempotency_key,
+            callback_url=payload.callback_url,
+        )
+    except IdempotencyConflictError as ice:
+        logger.warning(f"/jobs: {str(ice)}")
+        raise HTTPException(status_code=409, detail=str(ice))
+    except JobQueueFullError as jqf:
+        logger.warning(f"/jobs: {str(jqf)}")
+        raise HTTPException(
+            status_code=429,
+            detail=f"Server busy: {jqf.queued_jobs} jobs are already queued. Please retry later.",
+            headers={"Retry-After": str(QUEUE_CONFIG.get("retry_after_seconds", 15))},
+        )
+
+    if created:
+        request.app.state.job_wakeup.set()
+        logger.info(f"/jobs: Job {job['id']} queued (priority {job['priority']}, red flags {red_flags or 'none'}).")
+    else:
+        response.status_code = 200 # Idempotent repeat
+        logger.info(f"/jobs: Idempotency key matched existing job {job['id']} ({job['status']}).")
+    response.headers["Location"] = f"/jobs/{job['id']}"
+    return _job_response(await asyncio.to_thread(current_job_queue.get, job["id"]) or job)
+
+@app.get("/jobs/stats")
+async def job_stats(request: Request):
+    """
+    Jobs per status, queued jobs per priority and the age of the oldest queued job.
+    """
+    current_job_queue = getattr(request.app.state, 'job_queue', None)
+    if current_job_queue is None:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(current_job_queue.stats)}
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job_endpoint(job_id: str, request: Request):
+    """
+    Status of a job, its position in the queue while queued and the report (same fields as
+    /get_health_recommendations) once it succeeded. Finished jobs are kept for JOB_QUEUE_CONFIG["result_ttl_seconds"].
+    """
+    current_job_queue = _get_job_queue(request)
+    job = await asyncio.to_thread(current_job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return _job_response(job)
+
+# --- Wearable Tracking Data Endpoint ---
+@app.post("/tracking/summary", response_model=TrackingSummaryResponse)
+async def tracking_summary_endpoint(request: Request):
+    """
+    Summarizes longitudinal tracking data (daily steps, blood pressure readings, glucose samples, screen time) sent
+    as the raw request body: text/csv, application/json (array of records) or application/x-ndjson. The body is
+    parsed as it arrives, so histories of any length are fine. Returns NumPy aggregates per metric, counts per
+    reference range category (PromptTemplates.REFERENCE_THRESHOLDS) and a compact summary_block for the prompt.
+    Does not use the model.
+    """
+    try:
+        summarizer = TrackingSummarizer(
+            request.headers.get("content-type"),
+            max_samples=TRACKING_CONFIG.get("max_samples", 5000000),
+            max_record_bytes=TRACKING_CONFIG.get("max_record_bytes", 64 * 1024),
+            recent_days=TRACKING_CONFIG.get("recent_days", 7),
+            max_reported_errors=TRACKING_CONFIG.get("max_reported_errors", 5),
+        )
+    except TrackingDataError as tde:
+        raise HTTPException(status_code=415, detail=str(tde))
+
+    start_time = time.time()
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await asyncio.to_thread(summarizer.feed, chunk) # Parsing is CPU work, keep it off the event loop
+        ingest_done = time.time()
+        summary = await asyncio.to_thread(summarizer.close)
+        summary_block = render_summary_block(summary, summarizer.recent_days)
+    except TrackingDataTooLargeError as tle:
+        logger.warning(f"/tracking/summary: {str(tle)}")
+        raise HTTPException(status_code=413, detail=str(tle))
+    except TrackingDataError as tde:
+        logger.warning(f"/tracking/summary: Invalid tracking data - {str(tde)}")
+        raise HTTPException(status_code=400, detail=f"Invalid tracking data: {str(tde)}")
+    end_time = time.time()
+
+    for metric, aggregates in summary["metrics"].items():
+        TRACKING_SAMPLES.inc(aggregates["samples"], metric=metric)
+    if summary["skipped_records"]:
+        TRACKING_RECORDS_SKIPPED.inc(summary["skipped_records"])
+    logger.info(
+        f"/tracking/summary: {summary['samples']} samples from {summary['records']} records ({summary['skipped_records']} "
+        f"skipped), parsed in {ingest_done - start_time:.3f}s, summarized in {end_time - ingest_done:.3f}s."
+    )
+    return TrackingSummaryResponse(
+        summary_block=summary_block,
+        ingest_seconds=round(ingest_done - start_time, 4),
+        summary_seconds=round(end_time - ingest_done, 4),
+        **summary,
+    )
+
+# --- Follow-up Endpoint (session turns) ---
+@app.post("/sessions/{session_id}/follow_up", response_model=FollowUpResponse)
+async def follow_up_endpoint(
+    session_id: str,
+    request: Request,
+    response: Response,
+    payload: FollowUpInput = Body(...)
+):
+    """
+    Answers a follow-up question about the report of a session (session_id from /get_health_recommendations).
+    The question is appended as a new user turn; the model continues from the session's saved llama.cpp state,
+    so only the question is prefilled. 404 if the session is unknown or expired, 409 if the conversation no
+    longer fits the context window (start a new report then).
+    """
+    logger.info(f"Received follow-up for session {session_id} with question length: {len(payload.question)}")
+    current_model_manager, current_inference_queue = _get_ready_inference(request, "/sessions/follow_up")
+    current_session_store = getattr(request.app.state, 'session_store', None)
+    if current_session_store is None:
+        raise HTTPException(status_code=404, detail="Sessions are disabled.")
+    session_state = await asyncio.to_thread(current_session_store.get, session_id)
+    if session_state is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired. Please request a new report.")
+
+    timer = StageTimer()
+    turn_text = PromptTemplates.create_follow_up_turn(payload.question)
+    max_tokens = SESSION_CONFIG.get("followup_max_tokens", 200)
+    with timer.stage("tokenize"):
+        # The tokenizer counts the chat markers as text here, so this errs on the safe side
+        conversation_tokens = (len(session_state["tokens"]) if session_state["tokens"]
+                               else await asyncio.to_thread(current_model_manager.count_tokens, session_state["text"]))
+        needed_tokens = conversation_tokens + await asyncio.to_thread(current_model_manager.count_tokens, turn_text) + max_tokens
+    if needed_tokens > MODEL_CONFIG.get("n_ctx", 2048):
+        logger.warning(f"/sessions/follow_up: Session {session_id} is too long for another turn ({needed_tokens} tokens needed).")
+        raise HTTPException(status_code=409, detail="The conversation is too long for another follow-up. Please request a new report.")
+
+    try:
+        start_time = time.time()
+        (answer, generation_stats, new_session_state), queue_info = await current_inference_queue.run(
+            current_model_manager.generate_followup,
+            session_state,
+            turn_text,
+            _select_variant(request.app.state, current_model_manager, current_inference_queue),
+            is_disconnected=request.is_disconnected,
+        )
+        _record_queue_wait(timer, queue_info)
+        timer.add("session_restore", generation_stats.get("session_restore_seconds"))
+        timer.add_generation_stats(generation_stats)
+        record_generation_stats(generation_stats)
+        SESSION_FOLLOW_UPS.inc(resume=generation_stats["session_resume"])
+        if not await asyncio.to_thread(current_session_store.update, session_id, new_session_state):
+            logger.info(f"/sessions/follow_up: Session {session_id} expired while its follow-up was generated.")
+        with timer.stage("format"):
+            final_answer = format_response(answer)
+        timer.observe_all()
+        if _timing_requested(request):
+            response.headers["Server-Timing"] = timer.server_timing_header()
+
+        execution_time = time.time() - start_time
+        logger.info(
+            f"/sessions/follow_up: Answer ready in {execution_time:.2f} seconds ({generation_stats['session_resume']}, "
+            f"{generation_stats['prefilled_tokens']} tokens prefilled, queue wait {queue_info['queue_wait_seconds']:.2f}s)."
+        )
+        llama_state = new_session_state.get("llama_state")
+        return FollowUpResponse(
+            session_id=session_id,
+            answer=final_answer,
+            turn=session_state["turns"] + 1,
+            session_resume=generation_stats["session_resume"],
+            prompt_tokens=generation_stats.get("prompt_tokens"),
+            prefilled_tokens=generation_stats.get("prefilled_tokens"),
+            completion_tokens=generation_stats.get("completion_tokens"),
+            session_state_bytes=len(llama_state) if llama_state is not None else 0,
+            execution_time_seconds=round(execution_time, 2),
+            queue_wait_seconds=round(queue_info["queue_wait_seconds"], 2),
+            queue_depth=queue_info["queue_depth"],
+            model_variant=generation_stats.get("model_variant"),
+        )
+    except QueueFullError as qf:
+        logger.warning(f"/sessions/follow_up: {str(qf)}")
+        raise _queue_full_http_exception(qf)
+    except QueueDeadlineExceededError as de:
+        logger.warning(f"/sessions/follow_up: {str(de)}")
+        raise _queue_deadline_http_exception(de)
+    except ClientDisconnectedError:
+        logger.info("/sessions/follow_up: Client disconnected while queued, request dropped before generation.")
+        return Response(status_code=499)
+    except ValueError as ve:
+        logger.error(f"ValueError during processing in /sessions/follow_up: {str(ve)}", exc_info=True)
+        raise HTTPException(status_code=409, detail=f"Processing error: {str(ve)}")
+    except Exception as e:
+        logger.error(f"Generic error in /sessions/follow_up: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An internal server error occurred while answering the follow-up.")
+
+# --- Admin Endpoints (model variants) ---
+def _require_admin(request: Request, endpoint_name: str):
+    """404 if no admin token is configured (ADMIN_CONFIG), 401 if the request does not send it."""
+    admin_token = ADMIN_CONFIG.get("token")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled.")
+    sent_token = request.headers.get(ADMIN_CONFIG.get("token_header", "X-Admin-Token"), "")
+    if not hmac.compare_digest(sent_token.encode("utf-8"), admin_token.encode("utf-8")):
+        logger.warning(f"{endpoint_name}: Rejected request with a missing or wrong admin token.")
+        raise HTTPException(status_code=401, detail="Missing or invalid admin token.")
+
+def _model_variant_stats(app_state, model_manager):
+    loaded_variants = model_manager.loaded_variants()
+    return {
+        **model_manager.status(),
+        "loaded_variants": loaded_variants,
+        "routing": app_state.variant_policy.stats(model_manager.default_variant, loaded_variants),
+    }
+
+async def _load_variant(model_manager, variant: str, reload: bool, endpoint_name: str):
+    # Off the event loop: loading and warming up take seconds to minutes; requests keep being served meanwhile
+    try:
+        loaded = await asyncio.to_thread(model_manager.load_variant, variant, reload)
+    except UnknownModelVariantError as ue:
+        raise HTTPException(status_code=404, detail=str(ue))
+    if not loaded:
+        logger.error(f"{endpoint_name}: Model variant {variant} could not be loaded.")
+        raise HTTPException(status_code=500, detail=f"Model variant {variant} could not be loaded; see the server logs.")
+
+@app.get("/admin/models")
+async def admin_models(request: Request):
+    """Configured model variants, which are loaded, the default one and the load-based routing state."""
+    _require_admin(request, "/admin/models")
+    current_model_manager, _ = _get_ready_inference(request, "/admin/models")
+    return _model_variant_stats(request.app.state, current_model_manager)
+
+@app.post("/admin/models/{variant}/load")
+async def admin_load_model(variant: str, request: Request, reload: bool = False):
+    """
+    Loads a variant of MODEL_VARIANTS, or with ?reload=true loads it again (e.g. after replacing its GGUF file).
+    The new instance is swapped in once it is loaded and warm; requests running on the old one finish on it.
+    """
+    _require_admin(request, "/admin/models/load")
+    current_model_manager, _ = _get_ready_inference(request, "/admin/models/load")
+    start_time = time.time()
+    await _load_variant(current_model_manager, variant, reload, "/admin/models/load")
+    logger.info(f"/admin/models/load: Model variant {variant} {'reloaded' if reload else 'loaded'} in {time.time() - start_time:.2f} seconds.")
+    return {**_model_variant_stats(request.app.state, current_model_manager), "load_seconds": round(time.time() - start_time, 2)}
+
+@app.post("/admin/models/{variant}/activate")
+async def admin_activate_model(variant: str, request: Request):
+    """Hot swap: loads the variant if needed and makes it the default one for new requests."""
+    _require_admin(request, "/admin/models/activate")
+    current_model_manager, _ = _get_ready_inference(request, "/admin/models/activate")
+    await _load_variant(current_model_manager, variant, False, "/admin/models/activate")
+    try:
+        previous_variant = await asyncio.to_thread(current_model_manager.set_default_variant, variant)
+    except ValueError as ve:
+        raise HTTPException(status_code=409, detail=str(ve))
+    logger.info(f"/admin/models/activate: Default model variant is now {variant} (was {previous_variant}).")
+    return {**_model_variant_stats(request.app.state, current_model_manager), "previous_default_variant": previous_variant}
+
+@app.post("/admin/models/{variant}/unload")
+async def admin_unload_model(variant: str, request: Request):
+    """Unloads a variant to free its memory. 409 for the default variant (activate another one first)."""
+    _require_admin(request, "/admin/models/unload")
+    current_model_manager, _ = _get_ready_inference(request, "/admin/models/unload")
+    try:
+        unloaded = await asyncio.to_thread(current_model_manager.unload_variant, variant)
+    except UnknownModelVariantError as ue:
+        raise HTTPException(status_code=404, detail=str(ue))
+    except ValueError as ve:
+        raise HTTPException(status_code=409, detail=str(ve))
+    logger.info(f"/admin/models/unload: Model variant {variant} {'unloaded' if unloaded else 'was not loaded'}.")
+    return {**_model_variant_stats(request.app.state, current_model_manager), "unloaded": unloaded}
+
 # --- Health Check Endpoint (Good Practice) ---
 @app.get("/health")
 async def health_check(request: Request): 
     """
-    Checks if the API is running and the model is loaded.
+    Readiness check: 200 once the model is loaded and warmed up, otherwise 503 with the model status
+    (loading, warming or failed). Use /health/live for a liveness check.
     """
     model_is_loaded = getattr(request.app.state, 'model_loaded_successfully', False)
+    model_status = getattr(request.app.state, 'model_status', 'loading')
     
     if model_is_loaded:
         logger.info("/health: Health check successful, model is loaded.")
-        return {"status": "ok", "message": "Model is loaded and API is healthy."}
+        current_inference_queue = getattr(request.app.state, 'inference_queue', None)
+        queue_stats = current_inference_queue.stats() if current_inference_queue else None
+        current_model_manager = getattr(request.app.state, 'model_manager', None)
+        workers = current_model_manager.stats() if isinstance(current_model_manager, ModelWorkerPool) else None
+        current_response_cache = getattr(request.app.state, 'response_cache', None)
+        cache_stats = await asyncio.to_thread(current_response_cache.stats) if current_response_cache else None
+        tuning_profile = getattr(current_model_manager, 'tuning_profile', None) # Per worker in "workers" for the pool
+        current_session_store = getattr(request.app.state, 'session_store', None)
+        session_stats = await asyncio.to_thread(current_session_store.stats) if current_session_store else None
+        current_job_queue = getattr(request.app.state, 'job_queue', None)
+        job_stats = await asyncio.to_thread(current_job_queue.stats) if current_job_queue else None
+        model_stats = _model_variant_stats(request.app.state, current_model_manager)
+        return {"status": "ok", "model_status": model_status, "message": "Model is loaded and API is healthy.", "queue": queue_stats, "workers": workers, "cache": cache_stats, "tuning": tuning_profile, "sessions": session_stats, "jobs": job_stats, "models": model_stats}
+    elif model_status in ("loading", "warming"):
+        logger.info(f"/health: Model not ready yet (status: {model_status}).")
+        return JSONResponse(
+            status_code=503,
+            content={"status": model_status, "model_status": model_status, "message": f"Model is {model_status}."},
+            headers={"Retry-After": str(STARTUP_CONFIG.get("not_ready_retry_after_seconds", 5))},
+        )
     else:
-        logger.warning("/health: Health check failed, model not loaded.")
-        raise HTTPException(status_code=503, detail="Service Unavailable: Model not loaded or failed to load.")
+        logger.warning(f"/health: Health check failed, model not loaded (status: {model_status}).")
+        return JSONResponse(
+            status_code=503,
+            content={"status": model_status, "model_status": model_status, "message": "Service Unavailable: Model not loaded or failed to load."},
+        )
+
+@app.get("/health/live")
+async def liveness_check(request: Request):
+    """
+    Liveness check: 200 as long as the process serves requests, also while the model is still loading.
+    """
+    return {"status": "alive", "model_status": getattr(request.app.state, 'model_status', 'loading')}
+
+# --- Response Cache Statistics ---
+@app.get("/cache/stats")
+async def cache_stats(request: Request):
+    """
+    Hit / miss / coalesced counts, bytes saved and tier sizes of the response cache.
+    """
+    current_response_cache = getattr(request.app.state, 'response_cache', None)
+    if current_response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **(await asyncio.to_thread(current_response_cache.stats))}
+
+# --- Session Store Statistics ---
+@app.get("/sessions/stats")
+async def session_stats(request: Request):
+    """
+    Sessions, where their llama.cpp states are (memory / disk), bytes per tier and per session, and evictions.
+    """
+    current_session_store = getattr(request.app.state, 'session_store', None)
+    if current_session_store is None:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(current_session_store.stats)} # May spill states to disk
+
+# --- Prometheus Metrics ---
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """
+    Prometheus text format: request counts and durations, per-stage histograms (queue wait, prefill, decode per
+    token, ...), token counters, response cache results, model load time, the current queue depth, the session store
+    and the job queue.
+    """
+    if not METRICS_CONFIG.get("enabled", True):
+        raise HTTPException(status_code=404, detail="Metrics are disabled.")
+    current_inference_queue = getattr(request.app.state, 'inference_queue', None)
+    if current_inference_queue:
+        QUEUE_WAITING.set(current_inference_queue.waiting)
+        QUEUE_RUNNING.set(current_inference_queue.running)
+    current_session_store = getattr(request.app.state, 'session_store', None)
+    if current_session_store:
+        store_stats = await asyncio.to_thread(current_session_store.stats)
+        SESSIONS.set(store_stats["states_in_memory"], state="memory")
+        SESSIONS.set(store_stats["states_on_disk"], state="disk")
+        SESSIONS.set(store_stats["sessions"] - store_stats["states_in_memory"] - store_stats["states_on_disk"], state="none")
+        SESSION_STATE_BYTES.set(store_stats["memory_bytes"], tier="memory")
+        SESSION_STATE_BYTES.set(store_stats["disk_bytes"], tier="disk")
+    current_job_queue = getattr(request.app.state, 'job_queue', None)
+    if current_job_queue:
+        job_stats = await asyncio.to_thread(current_job_queue.stats)
+        for priority in {0, JOB_QUEUE_CONFIG.get("red_flag_priority", 10)} | set(job_stats["queued_by_priority"]):
+            JOB_QUEUE_DEPTH.set(job_stats["queued_by_priority"].get(priority, 0), priority=priority)
+        JOB_OLDEST_QUEUED_AGE_SECONDS.set(job_stats["oldest_queued_age_seconds"])
+        JOBS_RUNNING.set(job_stats["running"])
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # To run this (save as api_main.py):
 # uvicorn api_main:app --reload --host 0.0.0.0 --port 8000
\ No newline at end of file
@@ -0,0 +1,523 @@
+# batch_cli.py
+"""
+Offline report generation for a whole cohort: reads records from a JSONL file, generates a report for each one
+with the model (no HTTP server involved) and appends the results to an output JSONL file.
+
+Input lines are JSON objects with "user_input" (the same text as for /get_health_recommendations) and optionally
+"id", which is copied to the output. Output lines come in completion order, not input order:
+{"index", "id", "recommendations", "sections", "error", "prompt_tokens", "completion_tokens", "seconds"}
+where index is the 0-based line number in the input. Invalid records get an "error" line and count as done.
+
+The input is read lazily and only a bounded number of records is in flight, so memory does not grow with the
+file. Progress is saved in a checkpoint file next to the output; running the same command again after an
+interruption (Ctrl-C, SIGTERM, crash) continues where it stopped without generating finished records again.
+
+Examples:
+    python batch_cli.py cohort.jsonl reports.jsonl
+    python batch_cli.py cohort.jsonl reports.jsonl --workers 8 --threads-per-worker 4
+    python batch_cli.py cohort.jsonl reports.jsonl --batch-size 4   # continuous batching within each worker
+    python batch_cli.py cohort.jsonl reports.jsonl --restart        # ignore the checkpoint, start over
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config import MODEL_CONFIG, PROMPT_BUDGET_CONFIG, WORKER_POOL_CONFIG, BATCH_CLI_CONFIG
+from prompt_templates import PromptTemplates
+from section_budget import generation_max_tokens
+from utils import validate_input, format_response, parse_report_sections
+
+logger = logging.getLogger("batch_cli")
+
+CHECKPOINT_VERSION = 1
+
+
+def count_lines(path):
+    """Number of lines in the file, counted in 1 MB blocks (for the ETA; the records are not parsed)."""
+    lines = 0
+    last_block = b""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            lines += block.count(b"\n")
+            last_block = block
+    if last_block and not last_block.endswith(b"\n"):
+        lines += 1 # Last line without a newline
+    return lines
+
+
+def iter_input_lines(path, start_offset=0, start_index=0):
+    """Yields (index, end_offset, line) from start_offset on; end_offset is the byte offset after the line."""
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        offset, index = start_offset, start_index
+        for line in f:
+            offset += len(line)
+            yield index, offset, line
+            index += 1
+
+
+class Checkpoint:
+    """
+    Progress of a run. All records before `watermark` are done; done_above holds the finished records after it
+    (results arrive out of order, so it stays about as small as the number of records in flight). watermark_offset is
+    the input byte offset where record `watermark` starts, so a resumed run seeks there instead of re-reading the
+    input, and output_offset is how much of the output file the checkpoint covers.
+    """
+
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.watermark = 0
+        self.watermark_offset = 0
+        self.done_above = set()
+        self.output_offset = 0
+        self.counters = {"succeeded": 0, "failed": 0}
+        self._end_offsets = {} # index -> input offset after its line, for records read but not below the watermark yet
+
+    def load(self):
+        """Reads the checkpoint file. Returns False if there is none."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        if data.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Checkpoint {self.path} has an unknown version {data.get('version')}.")
+        if data["input_path"] != self.input_path:
+            raise ValueError(f"Checkpoint {self.path} belongs to {data['input_path']}, not {self.input_path}. "
+                             "Use another output file or --restart.")
+        self.watermark = data["watermark"]
+        self.watermark_offset = data["watermark_offset"]
+        self.done_above = set(data["done_above"])
+        self.output_offset = data["output_offset"]
+        self.counters.update(data["counters"])
+        return True
+
+    def save(self, output_offset):
+        # Written to a temporary file and renamed, so an interruption never leaves a half-written checkpoint
+        self.output_offset = output_offset
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "version": CHECKPOINT_VERSION,
+                "input_path": self.input_path,
+                "watermark": self.watermark,
+                "watermark_offset": self.watermark_offset,
+                "done_above": sorted(self.done_above),
+                "output_offset": self.output_offset,
+                "counters": self.counters,
+                "saved_at": time.time(),
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, index):
+        return index < self.watermark or index in self.done_above
+
+    def register(self, index, end_offset):
+        """Records where an input line ends, before it is processed (or skipped as done)."""
+        self._end_offsets[index] = end_offset
+        self._advance()
+
+    def mark_done(self, index):
+        self.done_above.add(index)
+        self._advance()
+
+    def _advance(self):
+        # Move the watermark over the contiguous run of finished records whose input offsets are known
+        while self.watermark in self.done_above and self.watermark in self._end_offsets:
+            self.done_above.discard(self.watermark)
+            self.watermark_offset = self._end_offsets.pop(self.watermark)
+            self.watermark += 1
+
+
+def recover_output(output_path, checkpoint):
+    """
+    Reconciles the output file with the checkpoint: results written after the last checkpoint are counted as done
+    (they are not generated again) and a partially written last line is cut off. Returns the output size to append at.
+    """
+    if not os.path.exists(output_path):
+        if checkpoint.output_offset > 0:
+            raise ValueError(f"The checkpoint covers {checkpoint.output_offset} bytes of {output_path}, but the file is gone. "
+                             "Use --restart to start over.")
+        return 0
+    output_size = os.path.getsize(output_path)
+    if output_size < checkpoint.output_offset:
+        raise ValueError(f"{output_path} is shorter than its checkpoint says; use --restart to start over.")
+    recovered = 0
+    valid_end = checkpoint.output_offset
+    with open(output_path, "rb") as f:
+        f.seek(checkpoint.output_offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break # Interrupted while writing this line
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            if not checkpoint.is_done(result["index"]):
+                checkpoint.mark_done(result["index"])
+                checkpoint.counters["failed" if result.get("error") else "succeeded"] += 1
+                recovered += 1
+            valid_end += len(line)
+    if valid_end < output_size:
+        logger.warning(f"Cutting off {output_size - valid_end} bytes of an incomplete result at the end of {output_path}.")
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_end)
+    if recovered:
+        logger.info(f"Recovered {recovered} results written after the last checkpoint.")
+    return valid_end
+
+
+def build_prompt(user_text, count_tokens):
+    """Same validation and prompt budgeting as the API (_build_prompt). Returns (prompt, error)."""
+    is_valid, error_msg = validate_input(user_text, min_length=50)
+    if not is_valid:
+        return None, f"Invalid input: {error_msg}"
+    try:
+        prompt_text, _ = PromptTemplates.build_prompt_within_budget(
+            PromptTemplates.format_user_input(user_text),
+            count_tokens,
+            n_ctx=MODEL_CONFIG.get("n_ctx", 2048),
+            max_tokens=generation_max_tokens(),
+            safety_margin_tokens=PROMPT_BUDGET_CONFIG.get("safety_margin_tokens", 32),
+        )
+    except ValueError as ve:
+        return None, f"Processing error: {str(ve)}"
+    return prompt_text, None
+
+
+def _result_line(index, record_id, recommendations=None, error=None, prompt_tokens=None, completion_tokens=None, seconds=None):
+    return {
+        "index": index,
+        "id": record_id,
+        "recommendations": recommendations,
+        "sections": parse_report_sections(recommendations) if recommendations else None,
+        "error": error,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "seconds": round(seconds, 3) if seconds is not None else None,
+    }
+
+
+def process_chunk(model_manager, chunk, batch_size):
+    """
+    Generates the reports for a chunk of (index, line) input records. Runs on an executor thread and blocks on the
+    model (an in-process ModelManager or a worker of the pool). Returns the result dicts.
+    """
+    results = []
+    to_generate = [] # (index, record_id, prompt)
+    for index, line in chunk:
+        record_id = None
+        try:
+            record = json.loads(line)
+            record_id = record.get("id") if isinstance(record, dict) else None
+            user_text = record.get("user_input") if isinstance(record, dict) else None
+            if not isinstance(user_text, str):
+                raise ValueError('the record has no "user_input" text')
+        except ValueError as ve:
+            results.append(_result_line(index, record_id, error=f"Invalid record: {str(ve)}"))
+            continue
+        prompt_text, error = build_prompt(user_text, model_manager.count_tokens)
+        if error:
+            results.append(_result_line(index, record_id, error=error))
+        else:
+            to_generate.append((index, record_id, prompt_text))
+
+    if batch_size > 1 and len(to_generate) > 1:
+        # One call decodes the whole chunk as parallel sequences; results come back as they finish
+        finished = set()
+        try:
+            for result in model_manager.generate_batch([prompt_text for _, _, prompt_text in to_generate]):
+                index, record_id, _ = to_generate[result["index"]]
+                finished.add(result["index"])
+                results.append(_result_line(
+                    index, record_id,
+                    recommendations=format_response(result["text"]) if result["error"] is None else None,
+                    error=result["error"],
+                    prompt_tokens=result["prompt_tokens"],
+                    completion_tokens=result["completion_tokens"],
+                    seconds=result["seconds"],
+                ))
+        except Exception as e:
+            logger.error(f"Batch of records {to_generate[0][0]}..{to_generate[-1][0]}: generation failed: {str(e)}")
+            for position, (index, record_id, _) in enumerate(to_generate):
+                if position not in finished:
+                    results.append(_result_line(index, record_id, error=str(e)))
+        return results
+
+    for index, record_id, prompt_text in to_generate:
+        started_at = time.perf_counter()
+        try:
+            raw_response, stats = model_manager.generate_response_with_stats(prompt_text)
+        except Exception as e:
+            logger.error(f"Record {index}: generation failed: {str(e)}")
+            results.append(_result_line(index, record_id, error=str(e), seconds=time.perf_counter() - started_at))
+            continue
+        results.append(_result_line(
+            index, record_id,
+            recommendations=format_response(raw_response),
+            prompt_tokens=stats.get("prompt_tokens"),
+            completion_tokens=stats.get("completion_tokens"),
+            seconds=time.perf_counter() - started_at,
+        ))
+    return results
+
+
+class ProgressReporter:
+    """Logs done / total, records per second over the recent window and the ETA every progress_seconds."""
+
+    def __init__(self, total, already_done, progress_seconds, rate_window_seconds):
+        self.total = total
+        self.done = already_done
+        self.progress_seconds = progress_seconds
+        self.rate_window_seconds = rate_window_seconds
+        self.started_at = time.monotonic()
+        self.processed = 0 # In this run
+        self._samples = deque([(self.started_at, 0)]) # (time, processed)
+        self._last_report = self.started_at
+
+    def add(self, count):
+        self.done += count
+        self.processed += count
+        now = time.monotonic()
+        self._samples.append((now, self.processed))
+        while len(self._samples) > 2 and self._samples[1][0] < now - self.rate_window_seconds:
+            self._samples.popleft()
+        if now - self._last_report >= self.progress_seconds:
+            self._last_report = now
+            self.report()
+
+    def rate(self):
+        (first_at, first_processed), (last_at, last_processed) = self._samples[0], self._samples[-1]
+        return (last_processed - first_processed) / (last_at - first_at) if last_at > first_at else 0.0
+
+    def report(self):
+        rate = self.rate()
+        remaining = max(0, self.total - self.done)
+        eta = _format_duration(remaining / rate) if rate > 0 else "unknown"
+        percent = f" ({100 * self.done / self.total:.1f}%)" if self.total else ""
+        logger.info(f"{self.done}/{self.total} records{percent}, {rate:.2f} records/s, ETA {eta}.")
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def load_model(num_workers, threads_per_worker):
+    """In-process ModelManager for one worker, otherwise a ModelWorkerPool. Returns the instance or None."""
+    if num_workers > 1:
+        from worker_pool import ModelWorkerPool
+        pool = ModelWorkerPool(
+            num_workers,
+            threads_per_worker=threads_per_worker,
+            pin_cpus=WORKER_POOL_CONFIG.get("pin_cpus", True),
+            startup_timeout_seconds=WORKER_POOL_CONFIG.get("startup_timeout_seconds", 600),
+        )
+        if pool.start():
+            return pool
+        pool.shutdown()
+        return None
+    from model_manager import ModelManager
+    llama_overrides = {"n_threads": threads_per_worker, "n_threads_batch": threads_per_worker} if threads_per_worker else None
+    model_manager = ModelManager(llama_overrides=llama_overrides)
+    return model_manager if model_manager.load_model() else None
+
+
+def plan_workers(num_workers=None, threads_per_worker=None):
+    """
+    Workers and threads per worker that use every physical core: without num_workers one worker per
+    BATCH_CLI_CONFIG["threads_per_worker"] cores; without threads_per_worker the cores split evenly.
+    """
+    from worker_pool import available_cpus, physical_core_cpus
+    cores = len(physical_core_cpus(available_cpus()))
+    if num_workers is None:
+        num_workers = max(1, cores // (threads_per_worker or BATCH_CLI_CONFIG.get("threads_per_worker", 4)))
+    return num_workers, threads_per_worker or max(1, cores // num_workers)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _lock_run(checkpoint_path):
+    """
+    Takes an exclusive lock next to the checkpoint, so a second run over the same output fails instead of
+    writing duplicate results. Returns the open lock file (the lock lasts until it is closed).
+    """
+    lock_file = open(f"{checkpoint_path}.lock", "w")
+    try:
+        import fcntl
+    except ImportError: # Not available on Windows; runs are not guarded there
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise ValueError(f"Another run is already writing {checkpoint_path}.")
+    return lock_file
+
+
+def run(args):
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.json"
+    lock_file = _lock_run(checkpoint_path)
+    try:
+        return _run_locked(args, checkpoint_path)
+    finally:
+        lock_file.close()
+
+
+def _run_locked(args, checkpoint_path):
+    if args.restart:
+        for path in (args.output, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+    checkpoint = Checkpoint(checkpoint_path, args.input)
+    if checkpoint.load():
+        logger.info(f"Resuming from {checkpoint_path}: records before {checkpoint.watermark} are done.")
+    recover_output(args.output, checkpoint)
+
+    total = count_lines(args.input)
+    already_done = checkpoint.watermark + len(checkpoint.done_above)
+    if already_done >= total:
+        logger.info(f"All {total} records of {args.input} are done already.")
+        return 0
+    logger.info(f"{args.input}: {total} records, {total - already_done} to generate.")
+
+    num_workers, threads_per_worker = plan_workers(args.workers, args.threads_per_worker)
+    model_manager = load_model(num_workers, threads_per_worker)
+    if model_manager is None:
+        logger.error("Model failed to load, see the log above.")
+        return 1
+    # A single in-process llama.cpp context must not be used by two threads; the pool queues calls per worker
+    max_in_flight = num_workers * args.in_flight_per_worker if num_workers > 1 else 1
+    logger.info(f"Generating with {num_workers} worker(s) x {threads_per_worker} threads, {max_in_flight} call(s) in flight, "
+                f"batch size {args.batch_size}.")
+
+    progress = ProgressReporter(total, already_done, args.progress_seconds, args.rate_window_seconds)
+    previous_sigterm = signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="batch")
+    pending = set()
+    interrupted = False
+    output = open(args.output, "ab") # recover_output cut off a partially written last line
+    last_checkpoint = time.monotonic()
+
+    def collect(futures):
+        for future in futures:
+            results = future.result() # process_chunk reports per-record errors in the results, it does not raise
+            for result in results:
+                output.write(json.dumps(result).encode("utf-8") + b"\n")
+                checkpoint.mark_done(result["index"])
+                checkpoint.counters["failed" if result["error"] else "succeeded"] += 1
+            progress.add(len(results))
+        if time.monotonic() - last_checkpoint >= args.checkpoint_seconds:
+            save_checkpoint()
+
+    def save_checkpoint():
+        nonlocal last_checkpoint
+        # The results must be on disk before the checkpoint says they are
+        output.flush()
+        os.fsync(output.fileno())
+        checkpoint.save(output.tell())
+        last_checkpoint = time.monotonic()
+
+    try:
+        chunk = []
+        for index, end_offset, line in iter_input_lines(args.input, checkpoint.watermark_offset, checkpoint.watermark):
+            checkpoint.register(index, end_offset)
+            if checkpoint.is_done(index):
+                continue
+            if not line.strip():
+                # Empty lines (e.g. a trailing newline) count as done without an output line
+                checkpoint.mark_done(index)
+                progress.add(1)
+                continue
+            chunk.append((index, line))
+            if len(chunk) < args.batch_size:
+                continue
+            while len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending.add(executor.submit(process_chunk, model_manager, chunk, args.batch_size))
+            chunk = []
+        if chunk:
+            pending.add(executor.submit(process_chunk, model_manager, chunk, args.batch_size))
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+    except KeyboardInterrupt:
+        interrupted = True
+        logger.warning("Interrupted: finishing the records in flight and saving the checkpoint...")
+        for future in pending:
+            future.cancel()
+        finished = [future for future in pending if not future.cancelled()]
+        wait(finished)
+        collect(finished)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        save_checkpoint()
+        output.close()
+        signal.signal(signal.SIGTERM, previous_sigterm)
+        if hasattr(model_manager, "shutdown"):
+            model_manager.shutdown()
+
+    progress.report()
+    elapsed = time.monotonic() - progress.started_at
+    logger.info(
+        f"{'Stopped' if interrupted else 'Finished'}: {progress.processed} records in {_format_duration(elapsed)} "
+        f"({progress.processed / elapsed if elapsed > 0 else 0.0:.2f} records/s); in total {checkpoint.counters['succeeded']} "
+        f"succeeded, {checkpoint.counters['failed']} failed. Results in {args.output}."
+    )
+    if interrupted:
+        logger.info("Run the same command again to continue.")
+        return 130
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate health reports for every record of a JSONL file (resumable).")
+    parser.add_argument("input", help='JSONL file, one {"user_input": ..., "id": ...} object per line')
+    parser.add_argument("output", help="JSONL file the results are appended to")
+    parser.add_argument("--workers", type=int, default=BATCH_CLI_CONFIG.get("num_workers"),
+                        help="Model worker processes (default: one per --threads-per-worker physical cores)")
+    parser.add_argument("--threads-per-worker", type=int,
+                        help="Threads per worker (default: the physical cores split evenly over the workers)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_CLI_CONFIG.get("batch_size", 1),
+                        help="Records per model call; >1 decodes them as parallel sequences")
+    parser.add_argument("--in-flight-per-worker", type=int, default=BATCH_CLI_CONFIG.get("in_flight_per_worker", 2))
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: OUTPUT.checkpoint.json)")
+    parser.add_argument("--checkpoint-seconds", type=float, default=BATCH_CLI_CONFIG.get("checkpoint_seconds", 10))
+    parser.add_argument("--progress-seconds", type=float, default=BATCH_CLI_CONFIG.get("progress_seconds", 15))
+    parser.add_argument("--rate-window-seconds", type=float, default=BATCH_CLI_CONFIG.get("rate_window_seconds", 120))
+    parser.add_argument("--restart", action="store_true", help="Delete the output and checkpoint and start over")
+    parser.add_argument("--verbose", action="store_true", help="Keep the model's INFO logs")
+    args = parser.parse_args(argv)
+    if args.batch_size < 1 or any(value is not None and value < 1 for value in (args.workers, args.threads_per_worker)):
+        parser.error("--workers, --threads-per-worker and --batch-size must be at least 1")
+    if not os.path.exists(args.input):
+        parser.error(f"Input file {args.input} does not exist")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if not args.verbose:
+        # ModelManager logs every generation at INFO; keep only the progress
+        logging.getLogger().setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+    try:
+        return run(args)
+    except ValueError as ve:
+        logger.error(str(ve))
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# batch_decoder.py
+import logging
+import time
+
+import numpy as np
+import llama_cpp
+
+logger = logging.getLogger(__name__)
+
+
+def sample_token(logits, recent_tokens, rng, temperature, top_p, top_k, repeat_penalty):
+    """
+    Mirrors the Llama.sample chain (repetition penalty, top-k, top-p, temperature) in NumPy, per sequence.
+    Draws exactly one value from rng per call (none at temperature 0), which SpeculativeDecoder relies on.
+    """
+    if repeat_penalty != 1.0 and recent_tokens:
+        penalized = np.unique(np.asarray(recent_tokens, dtype=np.int64))
+        values = logits[penalized]
+        logits[penalized] = np.where(values > 0, values / repeat_penalty, values * repeat_penalty)
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    k = min(top_k, logits.shape[0]) if top_k > 0 else logits.shape[0]
+    candidates = np.argpartition(-logits, k - 1)[:k]
+    candidates = candidates[np.argsort(-logits[candidates])]
+    candidate_logits = logits[candidates].astype(np.float64)
+    probs = np.exp(candidate_logits - candidate_logits[0])
+    probs /= probs.sum()
+    keep = int(np.searchsorted(np.cumsum(probs), top_p) + 1)
+    candidates, candidate_logits = candidates[:keep], candidate_logits[:keep]
+    scaled = candidate_logits / temperature
+    probs = np.exp(scaled - scaled.max())
+    probs /= probs.sum()
+    return int(candidates[rng.choice(len(candidates), p=probs)])
+
+
+class BatchDecoder:
+    """
+    Continuous batching over one extra llama.cpp context that shares the weights of an already loaded Llama.
+
+    Up to `n_parallel` prompts are decoded at the same time as separate sequences: every llama_decode() call
+    carries one new token for each generating sequence plus prefill chunks for newly admitted ones, so the
+    weight reads of a decode step are shared by all sequences. The common prompt prefix (the static system
+    prompt) is evaluated once into its own sequence and copied into each slot with llama_kv_cache_seq_cp,
+    which shares the KV cells instead of recomputing them. As soon as a sequence finishes its slot is given
+    to the next waiting prompt.
+    """
+
+    def __init__(self, llama, n_parallel=4, n_ctx=8192, n_batch=512, seed=42):
+        self.llama = llama
+        self.n_parallel = max(1, int(n_parallel))
+        self.n_batch = n_batch
+        self.seed = seed
+        self.n_vocab = llama.n_vocab()
+        self.prefix_seq_id = self.n_parallel # Sequence ids 0..n_parallel-1 are the slots
+
+        ctx_params = llama_cpp.llama_context_default_params()
+        ctx_params.seed = seed
+        ctx_params.n_ctx = n_ctx
+        ctx_params.n_batch = n_batch
+        ctx_params.n_threads = llama.context_params.n_threads
+        ctx_params.n_threads_batch = llama.context_params.n_threads_batch
+        ctx_params.f16_kv = llama.context_params.f16_kv
+        ctx_params.logits_all = False
+        self.ctx = llama_cpp.llama_new_context_with_model(llama.model, ctx_params)
+        if self.ctx is None:
+            raise RuntimeError("Failed to create the llama.cpp context for batch decoding")
+        self.n_ctx = llama_cpp.llama_n_ctx(self.ctx)
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0)
+        self._prefix_tokens = []
+        logger.info(f"BatchDecoder ready: {self.n_parallel} parallel sequences, n_ctx={self.n_ctx}, n_batch={n_batch}.")
+
+    def close(self):
+        # Must run before the Llama that owns the weights is freed
+        if self.batch is not None:
+            llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+        if self.ctx is not None:
+            llama_cpp.llama_free(self.ctx)
+            self.ctx = None
+
+    # --- Low-level helpers ---
+
+    def _decode(self, entries):
+        """Runs one llama_decode over entries: (token, pos, seq_id, wants_logits). Batch index i = entries[i]."""
+        for i, (token, pos, seq_id, wants_logits) in enumerate(entries):
+            self.batch.token[i] = token
+            self.batch.pos[i] = pos
+            self.batch.seq_id[i] = seq_id
+            self.batch.logits[i] = 1 if wants_logits else 0
+        self.batch.n_tokens = len(entries)
+        return_code = llama_cpp.llama_decode(self.ctx, self.batch)
+        if return_code != 0:
+            raise RuntimeError(
+                f"llama_decode returned {return_code} (KV cache full? lower BATCH_CONFIG n_parallel or raise n_ctx)"
+            )
+
+    def _logits(self, batch_index):
+        pointer = llama_cpp.llama_get_logits_ith(self.ctx, batch_index)
+        return np.ctypeslib.as_array(pointer, shape=(self.n_vocab,)).copy()
+
+    def _ensure_prefix(self, prefix_tokens):
+        """Evaluates the shared prefix into its own sequence once; re-evaluates only if it changed."""
+        if prefix_tokens == self._prefix_tokens:
+            return
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, self.prefix_seq_id, -1, -1)
+        for start in range(0, len(prefix_tokens), self.n_batch):
+            chunk = prefix_tokens[start:start + self.n_batch]
+            self._decode([(token, start + i, self.prefix_seq_id, False) for i, token in enumerate(chunk)])
+        self._prefix_tokens = list(prefix_tokens)
+        logger.info(f"BatchDecoder: shared prefix evaluated ({len(prefix_tokens)} tokens).")
+
+    # --- Public API ---
+
+    def run(self, prompts, shared_prefix, max_tokens=400, temperature=0.1, top_p=0.85, top_k=40,
+            repeat_penalty=1.1, stop=None, last_n_tokens=64, logits_processor_factory=None):
+        """
+        Generates a completion for every prompt and yields result dicts as sequences finish (not in input order):
+        {"index", "text", "error", "prompt_tokens", "completion_tokens", "seconds"}.
+        logits_processor_factory() (optional) makes one logits processor per sequence, applied before sampling.
+        """
+        stop_sequences = [s.encode("utf-8") for s in (stop or [])]
+        eos_token = self.llama.token_eos()
+        prefix_tokens = self.llama.tokenize(shared_prefix.encode("utf-8")) if shared_prefix else []
+        self._ensure_prefix(prefix_tokens)
+
+        pending = list(enumerate(prompts))
+        pending.reverse() # pop() from the end keeps input order for admission
+        slots = [None] * self.n_parallel
+        rng = np.random.default_rng(self.seed)
+
+        while pending or any(slots):
+            # Admit waiting prompts into free slots
+            for slot_id in range(self.n_parallel):
+                if slots[slot_id] is not None or not pending:
+                    continue
+                index, prompt = pending.pop()
+                tokens = self.llama.tokenize(prompt.encode("utf-8"))
+                if len(tokens) + max_tokens > self.n_ctx:
+                    yield {"index": index, "text": None, "error": f"Prompt too long ({len(tokens)} tokens) for the batch context.",
+                           "prompt_tokens": len(tokens), "completion_tokens": 0, "seconds": 0.0}
+                    continue
+                shared = llama_cpp.Llama.longest_token_prefix(prefix_tokens, tokens[:-1])
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, slot_id, -1, -1)
+                if shared:
+                    llama_cpp.llama_kv_cache_seq_cp(self.ctx, self.prefix_seq_id, slot_id, 0, shared)
+                slots[slot_id] = {
+                    "index": index,
+                    "to_prefill": tokens[shared:],
+                    "n_past": shared,
+                    "prompt_tokens": len(tokens),
+                    "recent": list(tokens[-last_n_tokens:]),
+                    "tokens": tokens,
+                    "generated": [],
+                    "processor": logits_processor_factory() if logits_processor_factory else None,
+                    "started_at": time.time(),
+                }
+
+            # Build one batch: a decode token for every generating slot, then prefill chunks while room is left
+            entries = []
+            logits_owner = {} # batch index -> slot id
+            for slot_id, slot in enumerate(slots):
+                if slot is not None and not slot["to_prefill"]:
+                    # The token sampled last round goes into the KV cache now
+                    logits_owner[len(entries)] = slot_id
+                    entries.append((slot["generated"][-1], slot["n_past"], slot_id, True))
+                    slot["n_past"] += 1
+            for slot_id, slot in enumerate(slots):
+                if slot is None or not slot["to_prefill"] or len(entries) >= self.n_batch:
+                    continue
+                take = slot["to_prefill"][:self.n_batch - len(entries)]
+                for i, token in enumerate(take):
+                    is_last = len(take) == len(slot["to_prefill"]) and i == len(take) - 1
+                    if is_last:
+                        logits_owner[len(entries)] = slot_id
+                    entries.append((token, slot["n_past"] + i, slot_id, is_last))
+                slot["to_prefill"] = slot["to_prefill"][len(take):]
+                slot["n_past"] += len(take)
+            if not entries:
+                continue
+
+            try:
+                self._decode(entries)
+            except RuntimeError as e:
+                logger.error(f"BatchDecoder: {str(e)}")
+                for slot_id, slot in enumerate(slots):
+                    if slot is not None:
+                        yield self._result(slot, None, str(e))
+                        llama_cpp.llama_kv_cache_seq_rm(self.ctx, slot_id, -1, -1)
+                        slots[slot_id] = None
+                continue
+            for batch_index, slot_id in logits_owner.items():
+                slot = slots[slot_id]
+                logits = self._logits(batch_index)
+                if slot["processor"] is not None:
+                    logits = slot["processor"](np.asarray(slot["tokens"] + slot["generated"], dtype=np.intc), logits)
+                token = sample_token(logits, slot["recent"][-last_n_tokens:], rng,
+                                     temperature, top_p, top_k, repeat_penalty)
+                finished = token == eos_token
+                if not finished:
+                    slot["generated"].append(token)
+                    slot["recent"].append(token)
+                text = self.llama.detokenize(slot["generated"])
+                stop_at = min((text.index(s) for s in stop_sequences if s in text), default=None)
+                if stop_at is not None:
+                    text = text[:stop_at]
+                    finished = True
+                if len(slot["generated"]) >= max_tokens:
+                    finished = True
+                if finished:
+                    yield self._result(slot, text.decode("utf-8", errors="ignore").strip(), None)
+                    llama_cpp.llama_kv_cache_seq_rm(self.ctx, slot_id, -1, -1)
+                    slots[slot_id] = None
+
+    @staticmethod
+    def _result(slot, text, error):
+        return {
+            "index": slot["index"],
+            "text": text,
+            "error": error,
+            "prompt_tokens": slot["prompt_tokens"],
+            "completion_tokens": len(slot["generated"]),
+            "seconds": round(time.time() - slot["started_at"], 3),
+        }
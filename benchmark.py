@@ -0,0 +1,507 @@
+# benchmark.py
+"""
+Latency / throughput benchmark for the API.
+
+Drives /get_health_recommendations (json), /get_health_recommendations/stream (stream) and
+/get_health_recommendations/batch (batch, --batch-items records per request) at the given concurrency levels, either in-process (the FastAPI app is started here, no server needed) or against a
+running server over HTTP. Without a GGUF file at MODEL_PATH the deterministic fake model in fake_llama.py
+is used, so the benchmark also runs offline / in CI.
+
+Examples:
+    python benchmark.py --output bench.json
+    python benchmark.py --concurrency 1,2,4 --requests 32 --endpoints stream
+    python benchmark.py --endpoints batch --batch-items 8 --concurrency 1
+    python benchmark.py --sweep n_threads=2,4,8 --sweep max_tokens=200,400 --output sweep.json
+    python benchmark.py --mode http --url http://localhost:8000
+    python benchmark.py --baseline bench_baseline.json   # exits with 1 if the run regressed (for CI)
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from config import (MODEL_CONFIG, MODEL_PATH, PREFIX_CACHE_CONFIG, WORKER_POOL_CONFIG, RESPONSE_CACHE_CONFIG,
+                    BENCHMARK_CONFIG)
+
+logger = logging.getLogger("benchmark")
+
+ENDPOINT_PATHS = {
+    "json": "/get_health_recommendations",
+    "stream": "/get_health_recommendations/stream",
+    "batch": "/get_health_recommendations/batch",
+}
+
+# Keys of MODEL_CONFIG that --sweep accepts
+SWEEPABLE_KEYS = ("n_threads", "n_batch", "n_ctx", "max_tokens", "speculative_decoding", "speculative_num_pred_tokens")
+
+
+def sample_inputs(count):
+    """Distinct but similar inputs (the example record with varied numbers) so no request repeats another."""
+    from utils import create_example_data
+    base = create_example_data()["full_input"]
+    inputs = []
+    for i in range(count):
+        inputs.append(
+            base.replace("Steps per day: 7,850", f"Steps per day: {4000 + 137 * i:,}")
+                .replace("Fasting: 95 mg/dL", f"Fasting: {88 + i % 40} mg/dL")
+        )
+    return inputs
+
+
+# --- Clients ---
+
+class InProcessClient:
+    """
+    Calls the ASGI app directly. httpx's ASGITransport only returns once the whole body is done, which
+    would hide the time to first token, so this small driver timestamps every body chunk itself.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def post(self, path, payload, on_chunk):
+        body = json.dumps(payload).encode("utf-8")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode("utf-8"),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        request_sent = False
+        response_done = asyncio.Event()
+        status = {}
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await response_done.wait() # The client stays connected until the response is complete
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body":
+                if message.get("body"):
+                    on_chunk(message["body"], time.perf_counter())
+                if not message.get("more_body", False):
+                    response_done.set()
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            response_done.set()
+        return status.get("code", 500)
+
+    async def close(self):
+        pass
+
+
+class HttpClient:
+    def __init__(self, base_url, timeout_seconds):
+        try:
+            import httpx
+        except ImportError:
+            sys.exit("--mode http needs httpx (pip install httpx)")
+        self.client = httpx.AsyncClient(base_url=base_url, timeout=timeout_seconds)
+
+    async def post(self, path, payload, on_chunk):
+        async with self.client.stream("POST", path, json=payload) as response:
+            async for chunk in response.aiter_bytes():
+                on_chunk(chunk, time.perf_counter())
+            return response.status_code
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# --- One request ---
+
+def _parse_sse(text):
+    """Returns [(event, data_dict)] for the complete events in text."""
+    events = []
+    for block in text.split("\n\n"):
+        event, data = None, None
+        for line in block.split("\n"):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        if event:
+            events.append((event, data))
+    return events
+
+
+async def run_request(client, endpoint, user_input):
+    """One request; for the batch endpoint user_input is a list of inputs sent as one batch."""
+    chunks = []
+    started = time.perf_counter()
+    if endpoint == "batch":
+        payload = {"items": [{"user_input": text} for text in user_input]}
+    else:
+        payload = {"user_input": user_input}
+    try:
+        status = await client.post(ENDPOINT_PATHS[endpoint], payload, lambda chunk, at: chunks.append((chunk, at)))
+    except Exception as e:
+        return {"status": None, "ok": False, "rejected": False, "error": str(e), "latency": time.perf_counter() - started}
+    finished = time.perf_counter()
+    body = b"".join(chunk for chunk, _ in chunks).decode("utf-8", errors="replace")
+    result = {"status": status, "latency": finished - started, "ttft": None, "rejected": status in (429, 503),
+              "ok": status == 200, "error": None if status == 200 else body[:200]}
+
+    if status == 200 and endpoint == "json":
+        data = json.loads(body)
+        result["ttft"] = result["latency"] # The whole report arrives at once
+        result["queue_wait"] = data.get("queue_wait_seconds", 0.0)
+    elif status == 200 and endpoint == "stream":
+        seen = ""
+        for chunk, at in chunks:
+            seen += chunk.decode("utf-8", errors="replace")
+            if result["ttft"] is None and "event: token" in seen:
+                result["ttft"] = at - started
+        for event, data in _parse_sse(body):
+            if event == "done":
+                result["done"] = data
+                result["queue_wait"] = data.get("queue_wait_seconds", 0.0)
+            elif event == "error":
+                result["ok"] = False
+                result["rejected"] = data.get("status_code") in (429, 503)
+                result["error"] = data.get("detail")
+        if "done" not in result and result["ok"]:
+            result["ok"] = False
+            result["error"] = "Stream ended without a done event"
+    elif status == 200 and endpoint == "batch":
+        result["ttft"] = chunks[0][1] - started if chunks else None # First finished report
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = [line for line in lines if "index" in line]
+        failure = next((line for line in lines if "status_code" in line), None) # Queue full / timed out
+        if failure is not None:
+            result["ok"] = False
+            result["rejected"] = failure["status_code"] in (429, 503)
+            result["error"] = failure.get("error")
+        result["items"] = len(items)
+        result["completion_tokens"] = sum(line.get("completion_tokens") or 0 for line in items)
+    return result
+
+
+# --- One run (endpoint x concurrency) ---
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.asarray(values, dtype=np.float64), [50, 95, 99])
+    return {"p50": round(float(p50), 4), "p95": round(float(p95), 4), "p99": round(float(p99), 4)}
+
+
+def summarize(results, wall_seconds):
+    ok = [r for r in results if r["ok"]]
+    summary = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(sum(1 for r in results if not r["ok"] and not r["rejected"]) / len(results), 4),
+        "rejection_rate": round(sum(1 for r in results if r["rejected"]) / len(results), 4),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(ok) / wall_seconds, 4) if wall_seconds > 0 else None,
+        "latency_seconds": _percentiles([r["latency"] for r in ok]),
+        "ttft_seconds": _percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "queue_wait_seconds": _percentiles([r.get("queue_wait", 0.0) for r in ok]),
+    }
+    done_events = [r["done"] for r in ok if r.get("done")]
+    if done_events:
+        # Prefill rate: the prompt tokens really evaluated over the prefill time alone, as llama.cpp reports them.
+        # Tokens restored from the prefix KV state, the restore itself and the queue wait are not part of it, so
+        # requests with and without a prefix hit measure the same thing; prefilled_tokens shows how much was left.
+        prefill_rates = [
+            d["prefilled_tokens"] / d["prefill_seconds"]
+            for d in done_events
+            if d.get("prefilled_tokens") and d.get("prefill_seconds")
+        ]
+        decode_rates = [d["tokens_per_second"] for d in done_events if d.get("tokens_per_second")]
+        summary["prefilled_tokens"] = _percentiles([d["prefilled_tokens"] for d in done_events if d.get("prefilled_tokens") is not None])
+        summary["prefill_tokens_per_second"] = _percentiles(prefill_rates)
+        summary["decode_tokens_per_second"] = _percentiles(decode_rates)
+        summary["generated_tokens_per_second"] = round(sum(d["total_tokens"] for d in done_events) / wall_seconds, 2)
+    batches = [r for r in ok if "items" in r]
+    if batches and wall_seconds > 0:
+        summary["reports_per_second"] = round(sum(r["items"] for r in batches) / wall_seconds, 4)
+        summary["generated_tokens_per_second"] = round(sum(r["completion_tokens"] for r in batches) / wall_seconds, 2)
+    return summary
+
+
+async def run_level(client, endpoint, concurrency, inputs):
+    """Closed loop: `concurrency` clients send the inputs back to back until all are done."""
+    remaining = iter(inputs)
+    results = []
+
+    async def user():
+        for user_input in remaining:
+            results.append(await run_request(client, endpoint, user_input))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return summarize(results, time.perf_counter() - started)
+
+
+async def run_all_levels(client, endpoints, concurrency_levels, requests_per_run, overrides, batch_items):
+    runs = []
+    for endpoint in endpoints:
+        for concurrency in concurrency_levels:
+            logger.info(f"Running {endpoint} x concurrency {concurrency} ({requests_per_run} requests), overrides {overrides}...")
+            if endpoint == "batch":
+                inputs = sample_inputs(requests_per_run * batch_items)
+                inputs = [inputs[i:i + batch_items] for i in range(0, len(inputs), batch_items)]
+            else:
+                inputs = sample_inputs(requests_per_run)
+            metrics = await run_level(client, endpoint, concurrency, inputs)
+            runs.append({
+                "key": run_key(endpoint, concurrency, overrides, batch_items if endpoint == "batch" else None),
+                "endpoint": endpoint,
+                "concurrency": concurrency,
+                "model_config_overrides": overrides,
+                "metrics": metrics,
+            })
+    return runs
+
+
+def run_key(endpoint, concurrency, overrides, batch_items=None):
+    parts = [endpoint, f"c{concurrency}"] + ([f"b{batch_items}"] if batch_items else [])
+    parts += [f"{key}={value}" for key, value in sorted(overrides.items())]
+    return "|".join(parts)
+
+
+# --- Model selection ---
+
+def use_fake_model(costs):
+    """Makes ModelManager build a FakeLlama (and FakeBatchDecoder) instead of loading a GGUF file."""
+    import model_manager
+    from fake_llama import FakeLlama, FakeBatchDecoder
+    placeholder = tempfile.NamedTemporaryFile(prefix="fake-model-", suffix=".gguf", delete=False)
+    placeholder.close()
+    model_manager.Llama = functools.partial(FakeLlama, costs=costs)
+    model_manager.BatchDecoder = FakeBatchDecoder
+    # llama.cpp's timings come from the context, which the fake does not have; it keeps its own
+    model_manager.ModelManager._reset_llama_timings = lambda self: self.model.reset_timings()
+    model_manager.ModelManager._read_llama_timings = lambda self: self.model.get_timings()
+    model_manager.MODEL_PATH = placeholder.name
+    PREFIX_CACHE_CONFIG["enabled"] = False # Uses llama.cpp state APIs; the fake reuses the common prefix itself
+    WORKER_POOL_CONFIG["num_workers"] = 1 # Spawned workers would load the real model
+    return placeholder.name
+
+
+async def run_in_process(args, sweep, fake_costs):
+    import api_main
+    all_runs = []
+    original_config = dict(MODEL_CONFIG)
+    try:
+        for overrides in sweep:
+            MODEL_CONFIG.clear()
+            MODEL_CONFIG.update(original_config)
+            MODEL_CONFIG.update(overrides)
+            async with api_main.lifespan(api_main.app):
+                # The model loads (and warms up) in the background; measure only once it is ready
+                while api_main.app.state.model_status in ("loading", "warming"):
+                    await asyncio.sleep(0.05)
+                if not getattr(api_main.app.state, "model_loaded_successfully", False):
+                    sys.exit("Model failed to load, see the log above.")
+                client = InProcessClient(api_main.app)
+                all_runs += await run_all_levels(client, args.endpoints, args.concurrency, args.requests, overrides,
+                                                 args.batch_items)
+    finally:
+        MODEL_CONFIG.clear()
+        MODEL_CONFIG.update(original_config)
+    return all_runs
+
+
+async def run_over_http(args):
+    client = HttpClient(args.url, args.timeout)
+    try:
+        return await run_all_levels(client, args.endpoints, args.concurrency, args.requests, {}, args.batch_items)
+    finally:
+        await client.close()
+
+
+# --- Baseline comparison ---
+
+def compare_to_baseline(runs, baseline, max_regression):
+    """Returns a list of regression messages (empty = no regression). Runs missing from the baseline are skipped."""
+    baseline_runs = {run["key"]: run["metrics"] for run in baseline.get("runs", [])}
+    regressions = []
+    for run in runs:
+        before = baseline_runs.get(run["key"])
+        if before is None:
+            continue
+        after = run["metrics"]
+        p95_before, p95_after = before["latency_seconds"]["p95"], after["latency_seconds"]["p95"]
+        if p95_before and p95_after and p95_after > p95_before * (1 + max_regression):
+            regressions.append(f"{run['key']}: p95 latency {p95_before:.3f}s -> {p95_after:.3f}s")
+        rps_before, rps_after = before.get("throughput_rps"), after.get("throughput_rps")
+        if rps_before and rps_after is not None and rps_after < rps_before * (1 - max_regression):
+            regressions.append(f"{run['key']}: throughput {rps_before:.3f} -> {rps_after:.3f} req/s")
+        failures_before = before["error_rate"] + before["rejection_rate"]
+        failures_after = after["error_rate"] + after["rejection_rate"]
+        if failures_after > failures_before + 0.01:
+            regressions.append(f"{run['key']}: error + rejection rate {failures_before:.2%} -> {failures_after:.2%}")
+    return regressions
+
+
+# --- CLI ---
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse_sweep(sweep_args):
+    """["n_threads=2,4", "max_tokens=200"] -> [{"n_threads": 2, "max_tokens": 200}, {"n_threads": 4, ...}]"""
+    axes = []
+    for item in sweep_args or []:
+        key, _, values = item.partition("=")
+        if key not in SWEEPABLE_KEYS or not values:
+            sys.exit(f"--sweep expects KEY=V1,V2,... with KEY one of {', '.join(SWEEPABLE_KEYS)}; got '{item}'")
+        axes.append([(key, _parse_value(value)) for value in values.split(",")])
+    return [dict(combination) for combination in itertools.product(*axes)] if axes else [{}]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_table(runs):
+    header = f"{'run':<40} {'ok':>5} {'rej%':>6} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'ttft50':>8} {'req/s':>8} {'prefill t/s':>11} {'decode t/s':>10}"
+    print(header)
+    print("-" * len(header))
+    for run in runs:
+        m = run["metrics"]
+        prefill = (m.get("prefill_tokens_per_second") or {}).get("p50")
+        decode = (m.get("decode_tokens_per_second") or {}).get("p50")
+        fmt = lambda v: f"{v:.3f}" if isinstance(v, (int, float)) else "-"
+        print(
+            f"{run['key']:<40} {m['succeeded']:>5} {m['rejection_rate'] * 100:>6.1f} {m['error_rate'] * 100:>6.1f} "
+            f"{fmt(m['latency_seconds']['p50']):>8} {fmt(m['latency_seconds']['p95']):>8} {fmt(m['latency_seconds']['p99']):>8} "
+            f"{fmt(m['ttft_seconds']['p50']):>8} {fmt(m['throughput_rps']):>8} {fmt(prefill):>11} {fmt(decode):>10}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency / throughput benchmark for the Health Advisor API.")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server for --mode http")
+    parser.add_argument("--model", choices=["auto", "fake", "real"], default="auto",
+                        help="auto = real model if MODEL_PATH exists, otherwise the fake (in-process only)")
+    parser.add_argument("--endpoints", default=",".join(BENCHMARK_CONFIG.get("endpoints", ["json", "stream"])))
+    parser.add_argument("--concurrency", default=",".join(str(c) for c in BENCHMARK_CONFIG.get("concurrency", [1, 4])))
+    parser.add_argument("--requests", type=int, default=BENCHMARK_CONFIG.get("requests_per_run", 16), help="Requests per run")
+    parser.add_argument("--batch-items", type=int, default=BENCHMARK_CONFIG.get("batch_items", 8), help="Records per batch endpoint request")
+    parser.add_argument("--sweep", action="append", help=f"KEY=V1,V2 over MODEL_CONFIG ({', '.join(SWEEPABLE_KEYS)}); repeatable")
+    parser.add_argument("--fake-prefill-ms", type=float, help="Fake model prefill cost per token (ms)")
+    parser.add_argument("--fake-decode-ms", type=float, help="Fake model decode cost per token (ms)")
+    parser.add_argument("--with-cache", action="store_true", help="Keep the response cache on (off by default, it would hide the model)")
+    parser.add_argument("--timeout", type=float, default=600, help="HTTP timeout per request (seconds)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier --output file; exit with 1 if this run is worse")
+    parser.add_argument("--max-regression", type=float, default=BENCHMARK_CONFIG.get("max_regression", 0.15))
+    parser.add_argument("--verbose", action="store_true", help="Keep the API's INFO logs")
+    args = parser.parse_args(argv)
+
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    for endpoint in args.endpoints:
+        if endpoint not in ENDPOINT_PATHS:
+            parser.error(f"Unknown endpoint '{endpoint}', choose from {', '.join(ENDPOINT_PATHS)}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    sweep = parse_sweep(args.sweep)
+    if args.mode == "http" and sweep != [{}]:
+        parser.error("--sweep only works in-process; restart the server with other settings instead")
+
+    fake_costs = dict(BENCHMARK_CONFIG.get("fake_costs", {}))
+    if args.fake_prefill_ms is not None:
+        fake_costs["prefill_seconds_per_token"] = args.fake_prefill_ms / 1000
+    if args.fake_decode_ms is not None:
+        fake_costs["decode_seconds_per_token"] = args.fake_decode_ms / 1000
+
+    meta = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "mode": args.mode,
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "model_config": dict(MODEL_CONFIG),
+    }
+
+    if args.mode == "http":
+        meta["url"] = args.url
+        runs = asyncio.run(run_over_http(args))
+    else:
+        model = args.model
+        if model == "auto":
+            model = "real" if os.path.exists(MODEL_PATH) else "fake"
+        if model == "real" and not os.path.exists(MODEL_PATH):
+            sys.exit(f"--model real but no GGUF file at {MODEL_PATH}")
+        meta["model"] = model
+        if model == "fake":
+            meta["fake_costs"] = fake_costs
+            placeholder = use_fake_model(fake_costs)
+        else:
+            meta["model_path"] = MODEL_PATH
+            placeholder = None
+        if not args.with_cache:
+            RESPONSE_CACHE_CONFIG["enabled"] = False
+        if not args.verbose:
+            # api_main configures INFO logging on import; keep only the benchmark's own progress
+            import api_main # noqa: F401
+            logging.getLogger().setLevel(logging.WARNING)
+            logger.setLevel(logging.INFO)
+        try:
+            runs = asyncio.run(run_in_process(args, sweep, fake_costs))
+        finally:
+            if placeholder:
+                os.remove(placeholder)
+
+    print_table(runs)
+    report = {"meta": meta, "runs": runs}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(runs, baseline, args.max_regression)
+        if regressions:
+            print(f"Regressions against {args.baseline} (tolerance {args.max_regression:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions against {args.baseline}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
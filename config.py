@@ -15,6 +15,216 @@ MODEL_CONFIG = {
     "max_tokens": 400,  # Reduced for speed
     "top_p": 0.85,  # Faster sampling
     "repeat_penalty": 1.1,
+    "use_mmap": True,  # Map the GGUF file instead of reading it: fast start, page cache shared between processes
+    "use_mlock": False,  # Lock the weights in RAM so they are never paged out (needs RLIMIT_MEMLOCK / IPC_LOCK)
+    # Prompt-lookup speculative decoding (see speculative_decoder.py): guesses the next tokens from earlier text
+    # in the prompt / output and verifies them in one batch. Same output as plain decoding, no draft model needed.
+    "speculative_decoding": False,
+    "speculative_ngram_size": 3,  # Longest n-gram looked up (falls back to shorter ones)
+    "speculative_num_pred_tokens": 8,  # Max drafted tokens per step; 0 = plain decoding through the same sampler
+    # Tokens of the first report generated both ways when the decoder is created; drafting stays off if they differ
+    "speculative_check_tokens": 64,
+}
+
+# GGUF variants the server can serve (see model_variants.ModelVariantRegistry), e.g. other quantizations or sizes of
+# the model. Each loaded variant has its own llama.cpp context; with mmap the weights of all of them share the page
+# cache. Variants must share the tokenizer and chat template (Llama 3), since the prompt is built and sized once.
+MODEL_VARIANTS = {
+    "q4_k_m": {"path": None, "preload": True},  # path None = MODEL_PATH
+    # "q3_k_l": {"path": os.path.join(os.path.dirname(MODEL_PATH), "Llama-3.2-1B-Instruct-Q3_K_L.gguf"), "preload": True},
+}
+
+# Load-aware tiering (see model_variants.VariantRoutingPolicy): while the inference queue is deep or the p95 latency
+# of recent reports is high, requests go to the next faster variant; when the load falls they return to the default.
+# Tier changes are at least min_tier_seconds apart, so the routing does not flap.
+MODEL_ROUTING_CONFIG = {
+    "default_variant": "q4_k_m",
+    "fallback_variants": [],  # Faster variants, in order, e.g. ["q3_k_l"]; only loaded ones are used
+    "queue_depth_high": 4,  # Requests waiting or running from which the next faster tier is used
+    "queue_depth_low": 1,  # ... and up to which the next better tier is used again
+    "p95_latency_high_seconds": 30.0,
+    "p95_latency_low_seconds": 15.0,
+    "latency_window_seconds": 120,  # Reports (queue wait + generation) that count for the p95
+    "min_latency_samples": 5,  # Fewer samples in the window: decide on the queue depth alone
+    "min_tier_seconds": 30,
+}
+
+# Admin endpoints (/admin/models: load, reload, activate and unload variants at runtime). Disabled unless a token is
+# set; requests must send it in the header below.
+ADMIN_CONFIG = {
+    "token": os.environ.get("HEALTH_ADVISOR_ADMIN_TOKEN"),
+    "token_header": "X-Admin-Token",
+}
+
+# Hardware-aware tuning (see hardware_tuner.py), opt-in. When enabled, ModelManager.load_model probes n_threads,
+# n_threads_batch and n_batch on this machine before loading, uses the fastest values for its model (MODEL_CONFIG
+# itself is not changed) and saves them keyed by CPU model + usable CPUs + GGUF file; later startups on the same
+# hardware reuse the saved profile.
+AUTOTUNE_CONFIG = {
+    "enabled": False,
+    "profile_path": None,  # None = tuning_profiles.json next to MODEL_PATH
+    "recalibrate": False,  # True = probe again even if a profile is saved
+    "n_threads": None,  # Candidate lists; None = half the physical cores, all physical cores, all logical CPUs
+    "n_threads_batch": None,
+    "n_batch": [128, 256, 512],
+    "probe_prompt_tokens": 256,  # Prompt tokens per prefill probe
+    "probe_decode_tokens": 32,  # Single-token evals per decode probe
+    "probe_repeats": 2,  # Best of N per setting
+}
+
+# Startup (see api_main.lifespan): the model loads in the background while /health reports "loading", then a
+# short warmup generation faults in the weights and sets up the KV cache ("warming") before it reports "ready".
+STARTUP_CONFIG = {
+    "background_load": True,  # False = block startup until the model is loaded and warm
+    "warmup_enabled": True,
+    "warmup_max_tokens": 16,  # Tokens generated by the warmup request
+    "not_ready_retry_after_seconds": 5,  # Retry-After sent with 503 while loading / warming
+}
+
+# Reuse of the KV state for the static system prompt (see ModelManager.prepare_prefix_cache)
+PREFIX_CACHE_CONFIG = {
+    "enabled": True,
+    "persist_to_disk": True,  # Keep a snapshot next to MODEL_PATH so restarts skip the prefill too
+    "cache_dir": None,  # None = same directory as MODEL_PATH
+}
+
+# Admission queue in front of the inference executor (see inference_queue.InferenceQueue)
+QUEUE_CONFIG = {
+    "max_queue_size": 8,  # Requests allowed to wait while the model is busy; more are rejected
+    "full_status_code": 429,  # 429 (Too Many Requests) or 503 (Service Unavailable) when the queue is full
+    "retry_after_seconds": 15,  # Sent as Retry-After on rejections
+    "request_deadline_seconds": 120,  # Queued requests older than this are dropped before generation starts
+    "disconnect_poll_seconds": 0.5,  # How often waiting requests check whether their client is still there
+}
+
+# Multi-process inference (see worker_pool.ModelWorkerPool). With num_workers = 1 the API keeps a single
+# in-process ModelManager. With more, each worker is its own process with its own llama.cpp context; the GGUF
+# weights are mmap'ed, so the page cache is shared and RSS does not multiply.
+WORKER_POOL_CONFIG = {
+    "num_workers": 1,
+    "threads_per_worker": None,  # None = split the available cores evenly between the workers
+    "pin_cpus": True,  # Give every worker a disjoint set of cores (CPU affinity), one thread per core
+    "startup_timeout_seconds": 600,  # Max time to wait for all workers to load the model
+}
+
+# Cache for generated reports (see response_cache.ResponseCache). Output is effectively deterministic at
+# temperature 0.1, so repeated identical inputs are answered from the cache instead of the model.
+RESPONSE_CACHE_CONFIG = {
+    "enabled": True,
+    "memory_max_entries": 512,
+    "memory_max_bytes": 32 * 1024 * 1024,
+    "ttl_seconds": 24 * 3600,
+    "sqlite_path": os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "responses.sqlite3"),  # None = memory only
+    "sqlite_max_entries": 100000,
+}
+
+# Follow-up questions on a report (see session_store.SessionStore and POST /sessions/{session_id}/follow_up). After a
+# report the llama.cpp state (KV cache of prompt + report) is kept per session, so a follow-up only prefills the new
+# question. States of a 1B model are roughly 32 KB per token (tens of MB per session): the least recently used ones
+# move from memory to disk_dir, and beyond disk_max_bytes the session falls back to re-prefilling its text.
+# Sessions are opt-in per request (create_session in the request body), so other reports never pay for the copy.
+SESSION_CONFIG = {
+    "enabled": False,
+    "max_sessions": 1000,  # Sessions (conversation text + state) kept at all; the least recently used are removed
+    "ttl_seconds": 1800,  # Sessions unused for this long expire
+    "memory_max_bytes": 512 * 1024 * 1024,  # llama.cpp states kept in memory
+    "disk_dir": os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "sessions"),  # None = no spill
+    "disk_max_bytes": 4 * 1024 * 1024 * 1024,
+    "followup_max_tokens": 200,
+    "max_question_characters": 2000,
+}
+
+# Asynchronous jobs (see job_queue.JobQueue and POST /jobs): submit, then poll GET /jobs/{job_id} or get a callback.
+# The queue is a SQLite file, so queued jobs survive restarts; jobs run on the same model slots as the synchronous
+# endpoints. Inputs with red flags (health_input_parser.RED_FLAG_COMBINATIONS) are scheduled first.
+JOB_QUEUE_CONFIG = {
+    "enabled": True,
+    "sqlite_path": os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "jobs.sqlite3"),  # None = memory only
+    "runners": None,  # Jobs generated at the same time; None = one per model instance (WORKER_POOL_CONFIG["num_workers"])
+    "poll_seconds": 1.0,  # How often idle runners look for jobs (a submission wakes them right away)
+    "max_queued_jobs": 10000,  # Submissions beyond this are rejected with 429
+    "job_ttl_seconds": 3600,  # Jobs not started within this expire
+    "result_ttl_seconds": 24 * 3600,  # Finished jobs and their idempotency keys are kept this long
+    "max_attempts": 2,  # Generation failures / restarts while running before a job fails
+    "red_flag_priority": 10,  # Priority of red-flag inputs; everything else has 0
+    "callback_timeout_seconds": 10,
+    "callback_max_attempts": 3,
+    # Hosts callback_url may name. Empty = any host whose addresses are all public (no loopback, private, link-local
+    # or metadata addresses); checked on submission and again before every delivery attempt
+    "callback_allowed_hosts": [],
+}
+
+# Wearable tracking data (see tracking_summary.py and POST /tracking/summary): JSON / NDJSON / CSV time series of
+# steps, blood pressure, glucose and screen time are streamed into per-metric arrays and summarized with NumPy into a
+# fixed-size text block for the prompt, however long the history.
+TRACKING_CONFIG = {
+    "max_samples": 5000000,  # Per upload (8 bytes per value and timestamp, so about 80 MB); more gets 413
+    "max_record_bytes": 64 * 1024,  # Longest single CSV line / JSON record
+    "recent_days": 7,  # Window of the "last N days" means
+    "max_reported_errors": 5,  # Skipped records described in the response
+}
+
+# Batch endpoint (see batch_decoder.BatchDecoder): prompts decoded concurrently as sequences of one extra context.
+# The KV cache is shared by all sequences, so n_ctx must hold the system prompt once plus
+# n_parallel x (user part + max_tokens).
+BATCH_CONFIG = {
+    "n_parallel": 4,
+    "n_ctx": 8192,
+    "n_batch": 512,
+    "max_items": 256,  # Per request
+    "seed": 42,  # Sampling seed, batch runs are reproducible
+}
+
+# Structured report generation (see section_budget.SectionBudgetProcessor): the report starts with section 1, every
+# section gets its own token budget (the sentence in progress may finish, then the next header is forced), and
+# generation stops as soon as section 7 is complete. The whole report, headers included, stays within
+# MODEL_CONFIG["max_tokens"]: a sentence only gets its grace tokens while the later sections still fit.
+STRUCTURED_OUTPUT_CONFIG = {
+    "enabled": True,
+    # Content tokens per section: 300, plus about 70 for the 7 headers, leaves ~30 of the 400 max_tokens for grace
+    "section_token_budgets": {1: 45, 2: 45, 3: 30, 4: 55, 5: 45, 6: 45, 7: 35},
+    "sentence_grace_tokens": 24,  # Extra tokens a section may use to finish its last sentence
+    "min_section_tokens": 8,  # Section 7 is not considered complete before this many tokens
+}
+
+# Prompt size control (see PromptTemplates.build_prompt_within_budget): prompt tokens + max_tokens must fit n_ctx.
+# Over budget, the reasoning clues are dropped first, then the reference ranges, then the middle of the input.
+PROMPT_BUDGET_CONFIG = {
+    "safety_margin_tokens": 32,  # Headroom for tokenizer differences at chunk borders
+    "max_input_characters": 20000,  # Longer user_input is rejected (422); about 5000 tokens, more than n_ctx holds
+}
+
+# Prometheus metrics on /metrics (see metrics.py). Clients can opt in to a per-request timing breakdown by sending
+# the request header below (any value); the JSON endpoint then answers with a Server-Timing header (ms per stage)
+# and the streaming endpoint adds "server_timing" to its done event.
+METRICS_CONFIG = {
+    "enabled": True,
+    "timing_header_enabled": True,
+    "timing_request_header": "X-Timing",
+}
+
+# Defaults for benchmark.py. The fake model (fake_llama.FakeLlama) is used when MODEL_PATH does not exist.
+BENCHMARK_CONFIG = {
+    "concurrency": [1, 4],  # Concurrent clients per run
+    "requests_per_run": 16,
+    "endpoints": ["json", "stream"],  # /get_health_recommendations and /get_health_recommendations/stream ("batch" too)
+    "batch_items": 8,  # Records per /get_health_recommendations/batch request
+    "max_regression": 0.15,  # --baseline: fail if p95 latency / throughput get this much worse (fraction)
+    "fake_costs": {
+        "prefill_seconds_per_token": 0.0005,
+        "decode_seconds_per_token": 0.02,
+    },
+}
+
+# Defaults for batch_cli.py (offline reports for a JSONL file of records, resumable via a checkpoint file)
+BATCH_CLI_CONFIG = {
+    "num_workers": None,  # Model worker processes; None = one per threads_per_worker physical cores
+    "threads_per_worker": 4,
+    "batch_size": 1,  # Records per model call; >1 decodes them as parallel sequences (continuous batching, BATCH_CONFIG)
+    "in_flight_per_worker": 2,  # Calls queued per worker, so a worker never waits for the next one
+    "checkpoint_seconds": 10,  # How often the output is flushed and the checkpoint written
+    "progress_seconds": 15,  # How often records/s and the ETA are logged
+    "rate_window_seconds": 120,  # Records/s (and so the ETA) over this recent window
 }
 
 # App configuration
@@ -0,0 +1,284 @@
+# fake_llama.py
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Stand-in for llama_cpp.Llama used by benchmark.py when no GGUF file is available (or with --fake).
+# It implements the part of the Llama API that ModelManager uses (call with/without stream, tokenize,
+# detokenize, reset/eval/generate, n_tokens/input_ids, n_vocab), with the signatures of the pinned
+# llama-cpp-python (0.2.11) so calls it does not accept fail here too, and spends time like a CPU model would:
+#   prefill: prefill_seconds_per_token per new prompt token (+ batch_overhead_seconds per n_batch chunk)
+#   decode:  decode_seconds_per_token per generated token
+# both scaled by reference_threads / n_threads over the parallel fraction (Amdahl), so sweeping
+# n_threads / n_batch / n_ctx / max_tokens changes the timings in a plausible direction.
+# Like llama-cpp-python it only prefills the tokens after the longest common prefix with the previous
+# prompt, so the static system prompt is cheap after the first request. Output is deterministic.
+# llama.cpp's per-context timings (llama_get_timings) are kept in get_timings(); FakeBatchDecoder stands in
+# for batch_decoder.BatchDecoder, which needs a real llama.cpp context.
+
+FAKE_LLAMA_DEFAULTS = {
+    "prefill_seconds_per_token": 0.0005,
+    "decode_seconds_per_token": 0.02,
+    "batch_overhead_seconds": 0.002,
+    "reference_threads": 4,
+    "parallel_fraction": 0.9,
+}
+
+# Canned 7-part report the fake "generates"; repeated if max_tokens asks for more
+FAKE_REPORT = """**1. Short-Term Risks** Your blood pressure of 120/80 mmHg is in the normal range, so there is no immediate cardiovascular concern, but the mild chest pain you mention should be watched closely.
+
+**2. Long-Term Risks (Chronic)** With about 7,850 steps per day you are somewhat active, and your fasting glucose of 95 mg/dL is normal, which keeps your diabetes risk low for now.
+
+**3. Warnings** No immediate critical warnings based on the current data, although chest pain that returns or worsens needs prompt evaluation.
+
+**4. Advice** You should reduce your 9.7 hours of daily screen time by adding short movement breaks every hour, which also helps your afternoon fatigue.
+
+**5. Food Recommendations** Oats, lentils and leafy greens will keep your post-meal glucose of 135 mg/dL stable and support heart health.
+
+**6. Exercise Recommendations** Add two sessions of light resistance training per week to your walking to improve insulin sensitivity and joint stability.
+
+**7. Early Detection & Preventive Care** Check your blood pressure monthly and repeat fasting glucose and a lipid panel once a year.
+"""
+
+TOKEN_BYTES = 4 # Every token is a chunk of up to 4 bytes of text
+N_VOCAB = (TOKEN_BYTES + 1) << 32 # Token ids are below this (see tokenize); no fake code path sizes arrays by it
+
+
+class FakeLlama:
+    def __init__(self, model_path=None, n_ctx=2048, n_threads=None, n_threads_batch=None, n_batch=512,
+                 costs=None, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.n_threads = n_threads or FAKE_LLAMA_DEFAULTS["reference_threads"]
+        self.n_threads_batch = n_threads_batch or self.n_threads
+        self.n_batch = max(1, n_batch)
+        self.costs = {**FAKE_LLAMA_DEFAULTS, **(costs or {})}
+        self.n_tokens = 0
+        self.input_ids = np.zeros(n_ctx, dtype=np.int64)
+        self.prefilled_tokens = 0 # Totals, for checking that prefix reuse works
+        self.generated_tokens = 0
+        self.reset_timings()
+        self._report_tokens = self.tokenize(FAKE_REPORT.encode("utf-8"))
+        logger.info(f"FakeLlama ready (n_ctx={n_ctx}, n_threads={self.n_threads}, n_batch={self.n_batch}, costs={self.costs}).")
+
+    # --- Timing model ---
+
+    def _thread_scale(self, n_threads):
+        parallel = self.costs["parallel_fraction"]
+        return (1 - parallel) + parallel * self.costs["reference_threads"] / max(1, n_threads)
+
+    def _prefill_seconds(self, n_new_tokens):
+        chunks = -(-n_new_tokens // self.n_batch)
+        seconds = n_new_tokens * self.costs["prefill_seconds_per_token"] + chunks * self.costs["batch_overhead_seconds"]
+        return seconds * self._thread_scale(self.n_threads_batch)
+
+    def _decode_seconds(self):
+        return self.costs["decode_seconds_per_token"] * self._thread_scale(self.n_threads)
+
+    # --- Llama API subset ---
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return N_VOCAB
+
+    def token_eos(self):
+        return 2 # Never generated; the canned report ends by max_tokens or a stop string
+
+    def tokenize(self, text, add_bos=True):
+        # Token id = byte length in the top bits + the bytes; detokenize() inverts it exactly
+        tokens = [1] if add_bos else []
+        for start in range(0, len(text), TOKEN_BYTES):
+            chunk = text[start:start + TOKEN_BYTES]
+            tokens.append((len(chunk) << 32) | int.from_bytes(chunk, "big"))
+        return tokens
+
+    def detokenize(self, tokens):
+        pieces = []
+        for token in tokens:
+            length = token >> 32
+            if length:
+                pieces.append((token & 0xFFFFFFFF).to_bytes(length, "big"))
+        return b"".join(pieces)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError(f"Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}")
+        # Like llama.cpp, a single-token eval is a decode step (n_threads), anything longer a prompt batch (n_threads_batch)
+        if len(tokens) == 1:
+            self._spend(self._decode_seconds(), "eval", 1)
+        else:
+            self._spend(self._prefill_seconds(len(tokens)), "p_eval", len(tokens))
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+        self.prefilled_tokens += len(tokens)
+
+    def generate(self, tokens, top_k=40, top_p=0.95, temp=0.80, repeat_penalty=1.1, reset=True,
+                 frequency_penalty=0.0, presence_penalty=0.0, tfs_z=1.0, mirostat_mode=0, mirostat_tau=5.0,
+                 mirostat_eta=0.1, logits_processor=None, stopping_criteria=None, grammar=None):
+        # Like Llama.generate: evaluates tokens after the longest common prefix (reset=True), then yields
+        # FAKE_REPORT's tokens; each one is evaluated only when the next one is requested
+        if reset:
+            self._prefill(tokens)
+        else:
+            self.eval(tokens)
+        i = 0
+        while True:
+            token = self._report_tokens[1 + i % (len(self._report_tokens) - 1)]
+            self.generated_tokens += 1
+            yield token
+            self.eval([token])
+            i += 1
+
+    # --- llama.cpp timings (llama_reset_timings / llama_get_timings; benchmark.use_fake_model wires them up) ---
+
+    def reset_timings(self):
+        self._timings = {"t_p_eval_ms": 0.0, "n_p_eval": 0, "t_eval_ms": 0.0, "n_eval": 0}
+
+    def get_timings(self):
+        return dict(self._timings)
+
+    def _spend(self, seconds, kind, n_tokens):
+        time.sleep(seconds)
+        self._timings[f"t_{kind}_ms"] += seconds * 1000
+        self._timings[f"n_{kind}"] += n_tokens
+
+    def _prefill(self, prompt_tokens):
+        # At least the last prompt token is always evaluated, as in llama-cpp-python
+        limit = min(self.n_tokens, len(prompt_tokens) - 1)
+        mismatches = np.flatnonzero(self.input_ids[:limit] != np.asarray(prompt_tokens[:limit], dtype=np.int64))
+        reusable = int(mismatches[0]) if len(mismatches) else limit
+        self.n_tokens = reusable
+        self.eval(prompt_tokens[reusable:])
+
+    def _generate(self, prompt, max_tokens, stop, structured=False):
+        prompt_tokens = self.tokenize(prompt.encode("utf-8"))
+        max_tokens = max_tokens if max_tokens and max_tokens > 0 else self._n_ctx - len(prompt_tokens)
+        if structured:
+            # A SectionBudgetProcessor ends the report after section 7; the fake stops at the end of FAKE_REPORT
+            max_tokens = min(max_tokens, len(self._report_tokens) - 1)
+        if len(prompt_tokens) + max_tokens > self._n_ctx:
+            max_tokens = self._n_ctx - len(prompt_tokens)
+        self._prefill(prompt_tokens)
+        text = ""
+        for i in range(max(0, max_tokens)):
+            token = self._report_tokens[1 + i % (len(self._report_tokens) - 1)] # FAKE_REPORT is ASCII, no split characters
+            self._spend(self._decode_seconds(), "eval", 1)
+            self.generated_tokens += 1
+            piece = self.detokenize([token]).decode("utf-8")
+            text += piece
+            if any(s in text for s in (stop or [])):
+                return
+            yield piece
+
+    def __call__(self, prompt, max_tokens=16, stream=False, stop=None, logits_processor=None, **kwargs):
+        pieces = self._generate(prompt, max_tokens, stop, structured=logits_processor is not None)
+        if stream:
+            return ({"choices": [{"text": piece, "index": 0, "finish_reason": None}]} for piece in pieces)
+        text = ""
+        completion_tokens = 0
+        prompt_tokens = len(self.tokenize(prompt.encode("utf-8")))
+        for piece in pieces:
+            text += piece
+            completion_tokens += 1
+        return {
+            "choices": [{"text": text, "index": 0, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+
+class FakeBatchDecoder:
+    """
+    Stand-in for batch_decoder.BatchDecoder on a FakeLlama, so the batch endpoint and batch_cli --batch-size run
+    offline. Same run() interface and scheduling: up to n_parallel sequences, the shared prefix is prefilled once,
+    and every step is one llama_decode carrying a token per generating sequence plus prefill chunks of newly
+    admitted ones. A step costs one decode token (the weights are read once for all sequences) plus the prefill
+    cost of its other tokens. Every sequence "generates" FAKE_REPORT.
+    """
+
+    def __init__(self, llama, n_parallel=4, n_ctx=8192, n_batch=512, seed=42):
+        self.llama = llama
+        self.n_parallel = max(1, int(n_parallel))
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.seed = seed
+        self._prefix_tokens = []
+        logger.info(f"FakeBatchDecoder ready: {self.n_parallel} parallel sequences, n_ctx={n_ctx}, n_batch={n_batch}.")
+
+    def close(self):
+        pass
+
+    def _step(self, n_decode, n_prefill):
+        llama = self.llama
+        seconds = llama._decode_seconds() if n_decode else 0.0
+        # The other sequences' decode tokens only add compute, like prompt tokens in the same batch
+        seconds += max(0, n_decode - 1) * llama.costs["prefill_seconds_per_token"] * llama._thread_scale(llama.n_threads_batch)
+        if n_prefill:
+            seconds += llama._prefill_seconds(n_prefill)
+        time.sleep(seconds)
+        llama.prefilled_tokens += n_prefill
+
+    def run(self, prompts, shared_prefix, max_tokens=400, temperature=0.1, top_p=0.85, top_k=40,
+            repeat_penalty=1.1, stop=None, last_n_tokens=64, logits_processor_factory=None):
+        """Yields {"index", "text", "error", "prompt_tokens", "completion_tokens", "seconds"} as sequences finish."""
+        llama = self.llama
+        report_tokens = llama._report_tokens[1:]
+        if logits_processor_factory is not None:
+            max_tokens = min(max_tokens, len(report_tokens)) # Structured mode ends after section 7
+        prefix_tokens = llama.tokenize(shared_prefix.encode("utf-8")) if shared_prefix else []
+        if prefix_tokens != self._prefix_tokens:
+            self._step(0, len(prefix_tokens))
+            self._prefix_tokens = list(prefix_tokens)
+
+        pending = list(enumerate(prompts))
+        pending.reverse()
+        slots = [None] * self.n_parallel
+        while pending or any(slots):
+            for slot_id in range(self.n_parallel):
+                if slots[slot_id] is not None or not pending:
+                    continue
+                index, prompt = pending.pop()
+                tokens = llama.tokenize(prompt.encode("utf-8"))
+                if len(tokens) + max_tokens > self.n_ctx:
+                    yield {"index": index, "text": None, "error": f"Prompt too long ({len(tokens)} tokens) for the batch context.",
+                           "prompt_tokens": len(tokens), "completion_tokens": 0, "seconds": 0.0}
+                    continue
+                shared = 0
+                while shared < min(len(prefix_tokens), len(tokens) - 1) and prefix_tokens[shared] == tokens[shared]:
+                    shared += 1
+                slots[slot_id] = {"index": index, "to_prefill": len(tokens) - shared, "prompt_tokens": len(tokens),
+                                  "generated": 0, "text": b"", "started_at": time.time()}
+
+            generating = [slot for slot in slots if slot is not None and not slot["to_prefill"]]
+            n_decode, n_prefill = len(generating), 0
+            for slot in slots:
+                if slot is None or not slot["to_prefill"] or n_decode + n_prefill >= self.n_batch:
+                    continue
+                take = min(slot["to_prefill"], self.n_batch - n_decode - n_prefill)
+                slot["to_prefill"] -= take
+                n_prefill += take
+                if not slot["to_prefill"]:
+                    generating.append(slot) # Its last prompt token's logits give the first generated token
+            self._step(n_decode, n_prefill)
+
+            for slot_id, slot in enumerate(slots):
+                if slot is None or slot not in generating:
+                    continue
+                slot["text"] += llama.detokenize([report_tokens[slot["generated"] % len(report_tokens)]])
+                slot["generated"] += 1
+                llama.generated_tokens += 1
+                stop_at = min((slot["text"].index(s.encode("utf-8")) for s in (stop or []) if s.encode("utf-8") in slot["text"]), default=None)
+                if stop_at is not None or slot["generated"] >= max_tokens:
+                    text = slot["text"][:stop_at] if stop_at is not None else slot["text"]
+                    yield {"index": slot["index"], "text": text.decode("utf-8", errors="ignore").strip(), "error": None,
+                           "prompt_tokens": slot["prompt_tokens"], "completion_tokens": slot["generated"],
+                           "seconds": round(time.time() - slot["started_at"], 3)}
+                    slots[slot_id] = None
@@ -0,0 +1,226 @@
+# hardware_tuner.py
+import hashlib
+import json
+import logging
+import os
+import platform
+import time
+
+from worker_pool import available_cpus, physical_core_cpus
+
+logger = logging.getLogger(__name__)
+
+# Opt-in calibration of n_threads / n_threads_batch / n_batch (see AUTOTUNE_CONFIG and ModelManager.load_model).
+# Short probes run on the real model over a small grid of settings:
+#   decode:  single-token evals (llama.cpp runs them on n_threads)  -> best n_threads
+#   prefill: one prompt eval in n_batch chunks (on n_threads_batch) -> best (n_threads_batch, n_batch)
+# The two grids are probed separately, so the number of probe contexts is their sum, not their product.
+# The winning profile is saved in a JSON file keyed by CPU model, usable CPUs and GGUF file, so later
+# startups on the same hardware reuse it without probing.
+
+PROFILE_FILE_VERSION = 1
+
+
+def _read_cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.lower().startswith(("model name", "hardware", "cpu model")):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine() or "unknown"
+
+
+def _read_cache_topology():
+    # Linux sysfs: one entry per cache level/type of cpu0, e.g. {"L1d": "48K", "L2": "2048K", "L3": "36864K"}
+    caches = {}
+    for index_path in sorted(_cache_index_paths()):
+        try:
+            with open(os.path.join(index_path, "level")) as f:
+                level = f.read().strip()
+            with open(os.path.join(index_path, "type")) as f:
+                cache_type = f.read().strip()
+            with open(os.path.join(index_path, "size")) as f:
+                size = f.read().strip()
+        except OSError:
+            continue
+        suffix = {"Data": "d", "Instruction": "i"}.get(cache_type, "")
+        caches[f"L{level}{suffix}"] = size
+    return caches
+
+
+def _cache_index_paths():
+    cache_dir = "/sys/devices/system/cpu/cpu0/cache"
+    try:
+        return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.startswith("index")]
+    except OSError:
+        return []
+
+
+def detect_cpu_info():
+    """CPU model, logical CPUs usable by this process, physical cores among them and the cache sizes."""
+    cpus = available_cpus()
+    return {
+        "cpu_model": _read_cpu_model(),
+        "machine": platform.machine(),
+        "logical_cpus": len(cpus),
+        "physical_cores": len(physical_core_cpus(cpus)),
+        "caches": _read_cache_topology(),
+    }
+
+
+def default_thread_candidates(cpu_info):
+    """Half the physical cores, all physical cores and all logical CPUs (SMT), deduplicated."""
+    physical_cores = cpu_info["physical_cores"]
+    return sorted({max(1, physical_cores // 2), physical_cores, cpu_info["logical_cpus"]})
+
+
+def profile_key(cpu_info, model_path):
+    """Key of a saved profile: CPU model, usable CPUs (affinity / worker slice) and the GGUF file's identity."""
+    hasher = hashlib.sha256()
+    hasher.update(cpu_info["cpu_model"].encode("utf-8"))
+    hasher.update(f"{cpu_info['logical_cpus']}:{cpu_info['physical_cores']}".encode("utf-8"))
+    hasher.update(os.path.basename(model_path).encode("utf-8"))
+    try:
+        model_stat = os.stat(model_path)
+        hasher.update(str(model_stat.st_size).encode("utf-8"))
+    except OSError:
+        pass
+    return hasher.hexdigest()[:16]
+
+
+def load_profile(profile_path, key):
+    """Returns the saved profile for key, or None if there is none (or the file is unreadable)."""
+    if not os.path.exists(profile_path):
+        return None
+    try:
+        with open(profile_path) as f:
+            stored = json.load(f)
+        if stored.get("version") != PROFILE_FILE_VERSION:
+            return None
+        return stored.get("profiles", {}).get(key)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read tuning profiles from {profile_path}: {str(e)}")
+        return None
+
+
+def save_profile(profile_path, key, profile):
+    """Adds / replaces the profile for key; other machines' profiles in the same file are kept."""
+    try:
+        stored = {"version": PROFILE_FILE_VERSION, "profiles": {}}
+        if os.path.exists(profile_path):
+            try:
+                with open(profile_path) as f:
+                    existing = json.load(f)
+                if existing.get("version") == PROFILE_FILE_VERSION:
+                    stored = existing
+            except ValueError:
+                pass
+        stored["profiles"][key] = profile
+        os.makedirs(os.path.dirname(os.path.abspath(profile_path)), exist_ok=True)
+        tmp_path = f"{profile_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, profile_path) # Atomic; pool workers calibrating at the same time may race, last one wins
+        logger.info(f"Tuning profile {key} saved to {profile_path}")
+    except OSError as e:
+        logger.warning(f"Could not save tuning profile to {profile_path}: {str(e)}")
+
+
+def _close_model(model):
+    if hasattr(model, "close"):
+        model.close()
+
+
+def _probe_prefill(model, tokens, repeats):
+    best_seconds = None
+    for _ in range(repeats):
+        model.reset()
+        started_at = time.perf_counter()
+        model.eval(tokens)
+        seconds = time.perf_counter() - started_at
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+    return len(tokens) / best_seconds if best_seconds else 0.0
+
+
+def _probe_decode(model, tokens, decode_tokens, repeats):
+    # A short context first, then one token per eval like the decode loop (sampling is not part of the probe)
+    context_tokens, step_tokens = tokens[:16], tokens[16:16 + decode_tokens]
+    best_seconds = None
+    for _ in range(repeats):
+        model.reset()
+        model.eval(context_tokens)
+        started_at = time.perf_counter()
+        for token in step_tokens:
+            model.eval([token])
+        seconds = time.perf_counter() - started_at
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+    return len(step_tokens) / best_seconds if best_seconds else 0.0
+
+
+def calibrate(create_model, probe_text, cpu_info, n_ctx, thread_candidates=None, threads_batch_candidates=None,
+              batch_candidates=(128, 256, 512), probe_prompt_tokens=256, probe_decode_tokens=32, probe_repeats=2):
+    """
+    Probes the settings grid and returns the profile dict (n_threads, n_threads_batch, n_batch, the measured
+    tokens per second and every probe result). create_model(n_threads=, n_threads_batch=, n_batch=) must return
+    a Llama-like object with tokenize / reset / eval; probe_text supplies the tokens (a representative prompt).
+    """
+    thread_candidates = list(thread_candidates or default_thread_candidates(cpu_info))
+    threads_batch_candidates = list(threads_batch_candidates or thread_candidates)
+    batch_candidates = [n_batch for n_batch in batch_candidates if n_batch <= n_ctx] or [min(512, n_ctx)]
+    started_at = time.perf_counter()
+    probes = []
+
+    # Decode: n_threads only; the batch settings do not matter for single-token evals
+    best_decode = None
+    for n_threads in thread_candidates:
+        model = create_model(n_threads=n_threads, n_threads_batch=n_threads, n_batch=max(batch_candidates))
+        try:
+            tokens = model.tokenize(probe_text.encode("utf-8"))
+            model.eval(tokens[:16]) # Fault in the weights before timing anything
+            tokens_per_second = _probe_decode(model, tokens, probe_decode_tokens, probe_repeats)
+        finally:
+            _close_model(model)
+        probes.append({"probe": "decode", "n_threads": n_threads, "tokens_per_second": round(tokens_per_second, 2)})
+        logger.info(f"Tuning probe decode n_threads={n_threads}: {tokens_per_second:.1f} tokens/s")
+        if best_decode is None or tokens_per_second > best_decode[1]:
+            best_decode = (n_threads, tokens_per_second)
+
+    # Prefill: n_threads_batch x n_batch; n_batch is a context parameter, so one context per pair
+    best_prefill = None
+    for n_batch in batch_candidates:
+        for n_threads_batch in threads_batch_candidates:
+            model = create_model(n_threads=best_decode[0], n_threads_batch=n_threads_batch, n_batch=n_batch)
+            try:
+                tokens = model.tokenize(probe_text.encode("utf-8"))[:min(probe_prompt_tokens, n_ctx - 1)]
+                model.eval(tokens[:16])
+                tokens_per_second = _probe_prefill(model, tokens, probe_repeats)
+            finally:
+                _close_model(model)
+            probes.append({"probe": "prefill", "n_threads_batch": n_threads_batch, "n_batch": n_batch,
+                           "tokens_per_second": round(tokens_per_second, 2)})
+            logger.info(f"Tuning probe prefill n_threads_batch={n_threads_batch} n_batch={n_batch}: {tokens_per_second:.1f} tokens/s")
+            if best_prefill is None or tokens_per_second > best_prefill[2]:
+                best_prefill = (n_threads_batch, n_batch, tokens_per_second)
+
+    return {
+        "n_threads": best_decode[0],
+        "n_threads_batch": best_prefill[0],
+        "n_batch": best_prefill[1],
+        "decode_tokens_per_second": round(best_decode[1], 2),
+        "prefill_tokens_per_second": round(best_prefill[2], 2),
+        "cpu": cpu_info,
+        "calibrated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "calibration_seconds": round(time.perf_counter() - started_at, 2),
+        "probes": probes,
+    }
+
+
+def profile_summary(profile, source):
+    """The part of a profile shown on /health and in the log (without the individual probes)."""
+    if profile is None:
+        return None
+    summary = {key: value for key, value in profile.items() if key != "probes"}
+    summary["source"] = source # "calibrated" or "saved"
+    return summary
@@ -0,0 +1,52 @@
+# health_input_parser.py
+import re
+
+# Deterministic (regex only, no model call) detection of what the free-text health input talks about.
+# PromptTemplates uses the result to include only the relevant reference ranges and reasoning clues.
+
+# Metrics that have a reference block in PromptTemplates.REFERENCE_BLOCKS
+METRIC_PATTERNS = {
+    "fever": [r"\bfever", r"\btemp(erature)?\b", r"\d\s*°\s*[fc]\b", r"\bpyrexi"],
+    "glucose": [r"\bglucose\b", r"\bblood sugar\b", r"\bsugar\b", r"\bdiabet", r"\bhba1c\b", r"\ba1c\b",
+                r"\bfasting\b", r"\bpost[- ]?meal\b", r"\binsulin\b"],
+    "cholesterol": [r"\bcholesterol\b", r"\bldl\b", r"\bhdl\b", r"\blipid", r"\btriglycerides?\b"],
+    "steps": [r"\bsteps?\b", r"\bwalk(s|ed|ing)?\b", r"\bsedentary\b", r"\bexercis"],
+    "blood_pressure": [r"\bblood pressure\b", r"\bbp\b", r"\bmm\s*hg\b", r"\bhypertensi",
+                       r"\b\d{2,3}\s*/\s*\d{2,3}\b"],
+    "weight": [r"\bweight\b", r"\bbmi\b", r"\b\d+(\.\d+)?\s*(kg|kgs|lbs?|pounds)\b", r"\bobes", r"\boverweight\b"],
+}
+
+# Symptoms and lifestyle signals that only appear in reasoning clues
+SIGNAL_PATTERNS = {
+    "chest_pain": [r"\bchest (pain|tightness|pressure)\b"],
+    "shortness_of_breath": [r"\bshortness of breath\b", r"\bshort of breath\b", r"\bbreathless", r"\bdyspn"],
+    "fatigue": [r"\bfatigue", r"\btired", r"\bexhaust", r"\bletharg"],
+    "hydration": [r"\bhydrat", r"\bwater intake\b", r"\bthirst"],
+    "screen_time": [r"\bscreen\b", r"\bscreen[- ]time\b"],
+    "sleep": [r"\bsleep", r"\bslept\b", r"\binsomnia\b"],
+}
+
+_COMPILED_PATTERNS = {
+    name: re.compile("|".join(patterns), re.IGNORECASE)
+    for name, patterns in {**METRIC_PATTERNS, **SIGNAL_PATTERNS}.items()
+}
+
+
+def detect_health_signals(user_input):
+    """Returns the set of metric / signal names (keys of METRIC_PATTERNS and SIGNAL_PATTERNS) found in user_input."""
+    if not user_input:
+        return set()
+    return {name for name, pattern in _COMPILED_PATTERNS.items() if pattern.search(user_input)}
+
+
+# Combinations of signals that make an input urgent (same red flag as the reasoning clue in PromptTemplates);
+# the job queue schedules such inputs first. All signals of a combination must be present.
+RED_FLAG_COMBINATIONS = [
+    ("chest_pain", "shortness_of_breath"),
+]
+
+
+def detect_red_flags(user_input):
+    """Returns the red flags found in user_input as names like "chest_pain+shortness_of_breath" (empty if none)."""
+    signals = detect_health_signals(user_input)
+    return ["+".join(combination) for combination in RED_FLAG_COMBINATIONS if signals.issuperset(combination)]
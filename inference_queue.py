@@ -0,0 +1,165 @@
+# inference_queue.py
+import asyncio
+import collections
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the admission queue has no free slot. The endpoint maps it to 429/503 + Retry-After."""
+    def __init__(self, queue_depth, retry_after_seconds):
+        super().__init__(f"Inference queue is full ({queue_depth} requests waiting or running).")
+        self.queue_depth = queue_depth
+        self.retry_after_seconds = retry_after_seconds
+
+
+class QueueDeadlineExceededError(Exception):
+    """Raised when a request waited in the queue longer than its deadline."""
+    def __init__(self, waited_seconds, retry_after_seconds):
+        super().__init__(f"Request waited {waited_seconds:.2f}s in the inference queue and hit its deadline.")
+        self.waited_seconds = waited_seconds
+        self.retry_after_seconds = retry_after_seconds
+
+
+class ClientDisconnectedError(Exception):
+    """Raised when the client went away while its request was still queued."""
+    pass
+
+
+class InferenceQueue:
+    """
+    Runs blocking model calls on a dedicated executor so the event loop stays responsive (/health etc.),
+    and puts a bounded admission queue in front of it.
+
+    - `concurrency` calls run at the same time (1 per model instance, since a llama.cpp context is not thread safe).
+    - At most `max_queue_size` further requests may wait; anything beyond that is rejected immediately.
+    - Slots go to waiting requests strictly in arrival order (FIFO).
+    - Waiting requests are dropped when their deadline passes or their client disconnects,
+      so no generation is started for a response nobody will read.
+    """
+
+    def __init__(self, concurrency=1, max_queue_size=8, retry_after_seconds=15,
+                 request_deadline_seconds=120, disconnect_poll_seconds=0.5):
+        self.concurrency = max(1, int(concurrency))
+        self.max_queue_size = max(0, int(max_queue_size))
+        self.retry_after_seconds = retry_after_seconds
+        self.request_deadline_seconds = request_deadline_seconds
+        self.disconnect_poll_seconds = disconnect_poll_seconds
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="inference")
+        # Free slots, and the futures of the requests waiting for one (oldest first); _grant_next() hands a freed
+        # slot to the oldest waiter, so a request that checks its deadline / client never loses its place
+        self._free_slots = self.concurrency
+        self._waiters = collections.deque()
+        self.waiting = 0
+        self.running = 0
+        # Counters for capacity planning (exposed via stats())
+        self.total_admitted = 0
+        self.total_rejected = 0
+        self.total_expired = 0
+        self.total_disconnected = 0
+        self.last_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def stats(self):
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "concurrency": self.concurrency,
+            "max_queue_size": self.max_queue_size,
+            "total_admitted": self.total_admitted,
+            "total_rejected": self.total_rejected,
+            "total_expired": self.total_expired,
+            "total_disconnected": self.total_disconnected,
+            "last_wait_seconds": round(self.last_wait_seconds, 3),
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
+
+    def check_capacity(self):
+        """Raises QueueFullError if a new request would be rejected right now; otherwise returns the queue depth."""
+        queue_depth = self.waiting + self.running
+        if queue_depth >= self.concurrency + self.max_queue_size:
+            self.total_rejected += 1
+            logger.warning(f"Inference queue full: waiting={self.waiting}, running={self.running}. Rejecting request.")
+            raise QueueFullError(queue_depth, self.retry_after_seconds)
+        return queue_depth
+
+    async def run(self, func, *args, is_disconnected=None, deadline_seconds=None):
+        """
+        Waits for a free slot, then runs func(*args) on the executor.
+        `is_disconnected` is an optional coroutine function (e.g. Request.is_disconnected).
+        Returns (result, queue_info) where queue_info has the queue depth at admission (requests waiting or
+        running ahead of this one) and the time spent waiting for a slot.
+        """
+        queue_depth = self.check_capacity() # Requests already in flight ahead of this one
+
+        deadline_seconds = self.request_deadline_seconds if deadline_seconds is None else deadline_seconds
+        enqueued_at = time.monotonic()
+        self.waiting += 1
+        self.total_admitted += 1
+        waiter = None
+        try:
+            if self._free_slots > 0 and not self._waiters:
+                self._free_slots -= 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                await self._wait_for_slot(waiter, enqueued_at, deadline_seconds, is_disconnected)
+        except BaseException:
+            if waiter is not None:
+                if waiter.done() and not waiter.cancelled():
+                    self._grant_next() # The slot arrived just now; pass it on to the next request
+                else:
+                    waiter.cancel()
+                    self._waiters.remove(waiter)
+            raise
+        finally:
+            self.waiting -= 1
+
+        wait_seconds = time.monotonic() - enqueued_at
+        self.last_wait_seconds = wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, func, *args)
+        except BaseException:
+            self._release_slot()
+            raise
+        # The slot is freed when the model call really finishes, not when this coroutine is cancelled,
+        # otherwise a cancelled request would let a second call into the same llama.cpp context.
+        future.add_done_callback(lambda _: self._release_slot())
+        result = await asyncio.shield(future)
+        return result, {"queue_depth": queue_depth, "queue_wait_seconds": wait_seconds}
+
+    async def _wait_for_slot(self, waiter, enqueued_at, deadline_seconds, is_disconnected):
+        # asyncio.wait() does not cancel the waiter on a timeout, so the request keeps its place in the queue
+        while True:
+            done, _ = await asyncio.wait({waiter}, timeout=self.disconnect_poll_seconds)
+            if done:
+                return
+            waited = time.monotonic() - enqueued_at
+            if deadline_seconds and waited >= deadline_seconds:
+                self.total_expired += 1
+                raise QueueDeadlineExceededError(waited, self.retry_after_seconds)
+            if is_disconnected is not None and await is_disconnected():
+                self.total_disconnected += 1
+                raise ClientDisconnectedError("Client disconnected while waiting for inference.")
+
+    def _grant_next(self):
+        """Hands a free slot to the oldest waiting request, or keeps it free if nobody waits."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self._free_slots += 1
+
+    def _release_slot(self):
+        self.running -= 1
+        self._grant_next()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,238 @@
+# job_queue.py
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import JOBS_FINISHED, JOB_QUEUE_WAIT_SECONDS
+from response_cache import normalize_user_input
+
+logger = logging.getLogger(__name__)
+
+# Job lifecycle: queued -> running -> succeeded | failed; queued jobs not started before expires_at -> expired.
+# A job that was running when the process stopped is queued again on the next start (until max_attempts).
+
+JOB_COLUMNS = ("id", "idempotency_key", "input_hash", "user_input", "priority", "red_flags", "status", "attempts",
+               "callback_url", "callback_status", "result", "error", "created_at", "started_at", "finished_at",
+               "expires_at")
+
+
+class JobQueueFullError(Exception):
+    """Raised when max_queued_jobs jobs are already waiting. The endpoint maps it to 429."""
+    def __init__(self, queued_jobs):
+        super().__init__(f"Job queue is full ({queued_jobs} jobs queued).")
+        self.queued_jobs = queued_jobs
+
+
+class IdempotencyConflictError(Exception):
+    """Raised when an idempotency key is reused for a different input. The endpoint maps it to 409."""
+    pass
+
+
+class JobQueue:
+    """
+    Persistent priority queue of report jobs in SQLite (one API process per database file).
+    claim_next() hands out the queued job with the highest priority, oldest first; submissions with an
+    idempotency key that is already known return the existing job instead of queueing a second one.
+    All methods are thread safe; they run SQLite queries, so the API calls them off the event loop.
+    """
+
+    def __init__(self, sqlite_path=None, job_ttl_seconds=3600, result_ttl_seconds=24 * 3600, max_attempts=2,
+                 max_queued_jobs=10000):
+        self.job_ttl_seconds = job_ttl_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.max_attempts = max(1, int(max_attempts))
+        self.max_queued_jobs = max_queued_jobs
+        self._lock = threading.Lock()
+        if sqlite_path:
+            os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, idempotency_key TEXT UNIQUE, input_hash TEXT NOT NULL, user_input TEXT NOT NULL, "
+            "priority INTEGER NOT NULL, red_flags TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+            "callback_url TEXT, callback_status TEXT, result TEXT, error TEXT, created_at REAL NOT NULL, "
+            "started_at REAL, finished_at REAL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs(status, priority DESC, created_at)")
+        self._requeue_interrupted()
+        logger.info(f"Job queue: {'SQLite at ' + sqlite_path if sqlite_path else 'in memory'}, {self._count('queued')} jobs queued.")
+
+    @staticmethod
+    def input_hash(user_input, callback_url=None):
+        return hashlib.sha256(f"{callback_url or ''}\n{normalize_user_input(user_input)}".encode("utf-8")).hexdigest()
+
+    def _requeue_interrupted(self):
+        # Jobs that were running when the previous process stopped: try again, or give up after max_attempts
+        with self._lock:
+            now = time.time()
+            requeued = self._db.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running' AND attempts < ?",
+                (self.max_attempts,),
+            ).rowcount
+            failed = self._db.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE status = 'running'",
+                (now, "Interrupted by a server restart too many times."),
+            ).rowcount
+        if requeued or failed:
+            logger.info(f"Job queue: {requeued} interrupted jobs queued again, {failed} failed after {self.max_attempts} attempts.")
+
+    def _count(self, status):
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def _row_to_job(self, row):
+        job = dict(zip(JOB_COLUMNS, row))
+        job["red_flags"] = json.loads(job["red_flags"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _get(self, job_id):
+        row = self._db.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def _expire_and_purge(self, now):
+        expired = self._db.execute(
+            "UPDATE jobs SET status = 'expired', finished_at = ? WHERE status = 'queued' AND expires_at <= ?", (now, now)
+        ).rowcount
+        if expired:
+            JOBS_FINISHED.inc(expired, status="expired")
+            logger.info(f"Job queue: {expired} jobs expired before they could start.")
+        self._db.execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed', 'expired') AND finished_at <= ?",
+            (now - self.result_ttl_seconds,),
+        )
+
+    # --- Public API ---
+
+    def submit(self, user_input, priority=0, red_flags=(), idempotency_key=None, callback_url=None):
+        """
+        Queues a job and returns (job, created). With a known idempotency_key the existing job is returned
+        (created False); reusing a key for a different input raises IdempotencyConflictError.
+        """
+        input_hash = self.input_hash(user_input, callback_url)
+        now = time.time()
+        with self._lock:
+            self._expire_and_purge(now)
+            if idempotency_key is not None:
+                row = self._db.execute(
+                    f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE idempotency_key = ?", (idempotency_key,)
+                ).fetchone()
+                if row is not None:
+                    job = self._row_to_job(row)
+                    if job["input_hash"] != input_hash:
+                        raise IdempotencyConflictError(f"Idempotency key {idempotency_key!r} was already used for a different request.")
+                    return job, False
+            queued_jobs = self._count("queued")
+            if queued_jobs >= self.max_queued_jobs:
+                raise JobQueueFullError(queued_jobs)
+            job_id = uuid.uuid4().hex
+            self._db.execute(
+                "INSERT INTO jobs (id, idempotency_key, input_hash, user_input, priority, red_flags, status, attempts, "
+                "callback_url, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?)",
+                (job_id, idempotency_key, input_hash, user_input, priority, json.dumps(list(red_flags)), callback_url,
+                 now, now + self.job_ttl_seconds),
+            )
+            return self._get(job_id), True
+
+    def claim_next(self):
+        """Marks the next job (highest priority, then oldest) as running and returns it, or None if none is queued."""
+        now = time.time()
+        with self._lock:
+            self._expire_and_purge(now) # Both statements use the status index, cheap enough for every claim
+            row = self._db.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY priority DESC, created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?", (now, row[0])
+            )
+            job = self._get(row[0])
+        JOB_QUEUE_WAIT_SECONDS.observe(now - job["created_at"], priority=job["priority"])
+        return job
+
+    def release(self, job_id, count_attempt=False):
+        """Puts a running job back in the queue (e.g. the model was busy or the server is shutting down)."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, attempts = attempts - ? WHERE id = ? AND status = 'running'",
+                (0 if count_attempt else 1, job_id),
+            )
+
+    def complete(self, job_id, result):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'succeeded', finished_at = ?, result = ?, error = NULL WHERE id = ?",
+                (time.time(), json.dumps(result), job_id),
+            )
+        JOBS_FINISHED.inc(status="succeeded")
+
+    def fail(self, job_id, error, retry=False):
+        """Records a failed attempt. With retry the job is queued again while it has attempts left. Returns its status."""
+        with self._lock:
+            attempts = self._db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if retry and attempts is not None and attempts[0] < self.max_attempts:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'queued', started_at = NULL, error = ? WHERE id = ?", (error, job_id)
+                )
+                return "queued"
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?", (time.time(), error, job_id)
+            )
+        JOBS_FINISHED.inc(status="failed")
+        return "failed"
+
+    def expire(self, job_id):
+        """Marks a running job as expired (it hit its deadline waiting for the model)."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'expired', finished_at = ? WHERE id = ?", (time.time(), job_id)
+            )
+        JOBS_FINISHED.inc(status="expired")
+
+    def set_callback_status(self, job_id, callback_status):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET callback_status = ? WHERE id = ?", (callback_status, job_id))
+
+    def get(self, job_id):
+        """Returns the job dict (result parsed from JSON) plus its queue_position while queued, or None."""
+        with self._lock:
+            job = self._get(job_id)
+            if job is None:
+                return None
+            job["queue_position"] = None
+            if job["status"] == "queued":
+                job["queue_position"] = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+                    "(priority > ? OR (priority = ? AND created_at < ?))",
+                    (job["priority"], job["priority"], job["created_at"]),
+                ).fetchone()[0]
+            return job
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            by_status = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            queued_by_priority = dict(self._db.execute(
+                "SELECT priority, COUNT(*) FROM jobs WHERE status = 'queued' GROUP BY priority").fetchall())
+            oldest_queued_at = self._db.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        return {
+            "queued": by_status.get("queued", 0),
+            "running": by_status.get("running", 0),
+            "succeeded": by_status.get("succeeded", 0),
+            "failed": by_status.get("failed", 0),
+            "expired": by_status.get("expired", 0),
+            "queued_by_priority": queued_by_priority,
+            "oldest_queued_age_seconds": round(now - oldest_queued_at, 3) if oldest_queued_at else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,287 @@
+# metrics.py
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus text-format (0.0.4) metrics, so /metrics needs no extra dependency.
+# All metrics are process-wide and thread safe (executor threads and pool receive threads update them).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Per-token decode time; CPU decode of a 1B model is roughly 10-100 ms per token
+TOKEN_BUCKETS = (0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+# Session llama.cpp states: about 32 KB per token for a 1B model, so a few MB to a few hundred MB
+SIZE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 4, 16, 32, 64, 128, 256, 512, 1024))
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {} # label values tuple -> value (or histogram state)
+        if not self.label_names:
+            self._values[()] = self._empty_value() # Unlabelled metrics are exported as 0 from the start
+
+    def _empty_value(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.extend(self._render_sample(label_values, value))
+        return lines
+
+    def _render_sample(self, label_values, value):
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, label_names)
+
+    def _empty_value(self):
+        return {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._empty_value()
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def _render_sample(self, label_values, state):
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            labels = _format_labels(self.label_names, label_values, [("le", _format_value(upper_bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = [] # Callables run before rendering (e.g. to refresh gauges from live state)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in list(self._collectors):
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "health_advisor_requests_total", "Requests by endpoint and HTTP status.", ("endpoint", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "health_advisor_request_duration_seconds", "End-to-end request time (successful requests).", ("endpoint",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "health_advisor_stage_duration_seconds",
+    "Time per request stage: validate, prompt_build, tokenize, queue_wait, prefix_restore, session_restore, prefill, decode"
+    " (generate when llama.cpp gives no split), format. prompt_build includes tokenize.",
+    ("stage",)))
+QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "health_advisor_queue_wait_seconds", "Time requests waited in the admission queue for the model."))
+PREFILL_SECONDS = REGISTRY.register(Histogram(
+    "health_advisor_prefill_seconds", "Prompt evaluation time per generation (after the prefix KV restore)."))
+DECODE_SECONDS_PER_TOKEN = REGISTRY.register(Histogram(
+    "health_advisor_decode_seconds_per_token", "Average decode time per generated token, per generation.",
+    buckets=TOKEN_BUCKETS))
+PROMPT_TOKENS = REGISTRY.register(Counter(
+    "health_advisor_prompt_tokens_total", "Prompt tokens sent to the model (including the cached system prompt)."))
+PREFILLED_TOKENS = REGISTRY.register(Counter(
+    "health_advisor_prefilled_tokens_total", "Prompt tokens the model actually evaluated (not restored from the KV cache)."))
+COMPLETION_TOKENS = REGISTRY.register(Counter(
+    "health_advisor_completion_tokens_total", "Tokens generated by the model."))
+SPECULATIVE_DRAFTED_TOKENS = REGISTRY.register(Counter(
+    "health_advisor_speculative_drafted_tokens_total", "Tokens drafted by prompt-lookup speculative decoding."))
+SPECULATIVE_ACCEPTED_TOKENS = REGISTRY.register(Counter(
+    "health_advisor_speculative_accepted_tokens_total", "Drafted tokens that matched the model's own choice."))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "health_advisor_response_cache_lookups_total", "Response cache results: hit, coalesced or miss.", ("result",)))
+MODEL_LOAD_SECONDS = REGISTRY.register(Gauge(
+    "health_advisor_model_load_seconds", "Time it took to load the model (all workers) at startup."))
+MODEL_WARMUP_SECONDS = REGISTRY.register(Gauge(
+    "health_advisor_model_warmup_seconds", "Time the warmup generation took at startup."))
+QUEUE_WAITING = REGISTRY.register(Gauge(
+    "health_advisor_queue_waiting", "Requests currently waiting for the model."))
+QUEUE_RUNNING = REGISTRY.register(Gauge(
+    "health_advisor_queue_running", "Requests currently being generated."))
+SESSIONS = REGISTRY.register(Gauge(
+    "health_advisor_sessions", "Follow-up sessions by where their llama.cpp state is: memory, disk or none (text only).",
+    ("state",)))
+SESSION_STATE_BYTES = REGISTRY.register(Gauge(
+    "health_advisor_session_state_bytes", "Bytes of session llama.cpp states, by tier (memory, disk).", ("tier",)))
+SESSION_STATE_SIZE_BYTES = REGISTRY.register(Histogram(
+    "health_advisor_session_state_size_bytes", "Size of one session's llama.cpp state when it is saved.",
+    buckets=SIZE_BUCKETS))
+SESSION_EVICTIONS = REGISTRY.register(Counter(
+    "health_advisor_session_evictions_total",
+    "Session store evictions: spilled (state moved to disk), dropped (state removed, the text is re-prefilled),"
+    " removed (whole session, max_sessions) and expired.",
+    ("reason",)))
+SESSION_FOLLOW_UPS = REGISTRY.register(Counter(
+    "health_advisor_session_follow_ups_total",
+    "Follow-up turns by how the conversation was resumed: kv_state (only the question prefilled) or full_prefill.",
+    ("resume",)))
+
+JOB_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "health_advisor_job_queue_depth", "Queued jobs by priority (red-flag inputs have the higher one).", ("priority",)))
+JOB_OLDEST_QUEUED_AGE_SECONDS = REGISTRY.register(Gauge(
+    "health_advisor_job_oldest_queued_age_seconds", "Age of the oldest job still waiting to start."))
+JOBS_RUNNING = REGISTRY.register(Gauge(
+    "health_advisor_jobs_running", "Jobs currently being generated."))
+JOB_QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "health_advisor_job_queue_wait_seconds", "Time from submission until a job started, by priority.", ("priority",),
+    buckets=DEFAULT_BUCKETS + (300.0, 900.0, 1800.0, 3600.0)))
+JOBS_FINISHED = REGISTRY.register(Counter(
+    "health_advisor_jobs_finished_total", "Finished jobs by status: succeeded, failed or expired.", ("status",)))
+JOB_CALLBACKS = REGISTRY.register(Counter(
+    "health_advisor_job_callbacks_total", "Job completion callbacks by result: delivered or failed.", ("result",)))
+TRACKING_SAMPLES = REGISTRY.register(Counter(
+    "health_advisor_tracking_samples_total", "Wearable tracking samples ingested by /tracking/summary, by metric.", ("metric",)))
+TRACKING_RECORDS_SKIPPED = REGISTRY.register(Counter(
+    "health_advisor_tracking_records_skipped_total", "Tracking records skipped as invalid (bad value, unknown metric, ...)."))
+MODEL_VARIANT_REPORTS = REGISTRY.register(Counter(
+    "health_advisor_model_variant_reports_total", "Reports generated by the model, by GGUF variant.", ("variant",)))
+MODEL_VARIANT_TIER = REGISTRY.register(Gauge(
+    "health_advisor_model_variant_tier", "Current routing tier: 0 = default variant, higher = faster fallback variant."))
+MODEL_VARIANT_TIER_CHANGES = REGISTRY.register(Counter(
+    "health_advisor_model_variant_tier_changes_total", "Routing tier changes: down (to a faster variant) or up.", ("direction",)))
+
+
+def record_generation_stats(stats):
+    """
+    Records the token counts and prefill / decode rates from a ModelManager.generate_response_with_stats dict
+    (missing / None values are skipped). The stage durations go through StageTimer.add_generation_stats.
+    """
+    if stats.get("prompt_tokens"):
+        PROMPT_TOKENS.inc(stats["prompt_tokens"])
+    if stats.get("prefilled_tokens") is not None:
+        PREFILLED_TOKENS.inc(stats["prefilled_tokens"])
+    if stats.get("completion_tokens"):
+        COMPLETION_TOKENS.inc(stats["completion_tokens"])
+    if stats.get("prefill_seconds") is not None:
+        PREFILL_SECONDS.observe(stats["prefill_seconds"])
+    if stats.get("decode_seconds") is not None and stats.get("completion_tokens"):
+        DECODE_SECONDS_PER_TOKEN.observe(stats["decode_seconds"] / stats["completion_tokens"])
+    if stats.get("speculative"):
+        SPECULATIVE_DRAFTED_TOKENS.inc(stats["speculative"]["drafted_tokens"])
+        SPECULATIVE_ACCEPTED_TOKENS.inc(stats["speculative"]["accepted_tokens"])
+
+
+class StageTimer:
+    """Collects the stage durations of one request (for the histograms and the Server-Timing header)."""
+
+    def __init__(self):
+        self.stages = {} # stage name -> seconds, in the order the stages first ran
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        if seconds is not None:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def timed(self, name, func):
+        """Wraps func so every call adds to stage `name` (e.g. the tokenizer calls during prompt building)."""
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def add_generation_stats(self, stats):
+        self.add("prefix_restore", stats.get("prefix_restore_seconds"))
+        if stats.get("prefill_seconds") is not None and stats.get("decode_seconds") is not None:
+            self.add("prefill", stats["prefill_seconds"])
+            self.add("decode", stats["decode_seconds"])
+        else:
+            self.add("generate", stats.get("generation_seconds")) # No split available (e.g. the fake model)
+
+    def observe_all(self):
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, stage=name)
+
+    def as_milliseconds(self):
+        return {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+
+    def server_timing_header(self):
+        # Server-Timing durations are in milliseconds; browsers show them in the network panel
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items())
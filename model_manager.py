@@ -1,18 +1,52 @@
 # model_manager.py
+import glob
+import hashlib
+import json
 import logging
 import os # Ensure os is imported if used for CUDA_AVAILABLE check etc.
+import pickle
+import time
+import llama_cpp # Low-level bindings, used to restore the prefix KV state without copying the full scores matrix
 from llama_cpp import Llama
-from config import MODEL_PATH, MODEL_CONFIG 
+from config import MODEL_PATH, MODEL_CONFIG, PREFIX_CACHE_CONFIG, BATCH_CONFIG, AUTOTUNE_CONFIG, STRUCTURED_OUTPUT_CONFIG, SESSION_CONFIG
+from prompt_templates import PromptTemplates
+from batch_decoder import BatchDecoder
+from speculative_decoder import SpeculativeDecoder
+from section_budget import SectionBudgetProcessor, generation_max_tokens
+import hardware_tuner
 
 # Ensure logger is configured (FastAPI might do this, but good for standalone testing too)
 logging.basicConfig(level=logging.INFO) 
 logger = logging.getLogger(__name__) # Use __name__ for module-specific logger
 
 class ModelManager:
-    def __init__(self):
+    def __init__(self, model_path=None, variant=None, autotune=None, llama_overrides=None):
+        """
+        One llama.cpp model. model_path defaults to MODEL_PATH; variant is its name in MODEL_VARIANTS (for logs);
+        autotune overrides AUTOTUNE_CONFIG["enabled"] (see model_variants.ModelVariantRegistry). llama_overrides are
+        Llama settings of this instance that win over MODEL_CONFIG and the tuning profile (e.g. a worker's n_threads).
+        """
         logger.info("ModelManager __init__ called.")
         self.model = None
-        self.model_path = MODEL_PATH
+        self.model_path = model_path or MODEL_PATH
+        self.variant = variant
+        self.autotune = AUTOTUNE_CONFIG.get("enabled", False) if autotune is None else autotune
+        self.llama_overrides = dict(llama_overrides or {})
+        # Snapshot of the KV state after evaluating PromptTemplates.get_static_prefix() (see prepare_prefix_cache)
+        self.prefix_snapshot = None
+        # Second context on the same weights for continuous batching, created on first use (see generate_batch)
+        self.batch_decoder = None
+        # Prompt-lookup speculative decoding on the main context, created on first use (see MODEL_CONFIG), and
+        # whether it reproduced plain decoding (see _get_speculative_decoder)
+        self.speculative_decoder = None
+        self._speculative_matches_plain = False
+        # Hardware tuning profile applied at load time (see apply_tuning_profile), for /health, and the Llama
+        # settings taken from it. They only apply to this instance; MODEL_CONFIG (and every fingerprint and cache
+        # key derived from it) stays as configured.
+        self.tuning_profile = None
+        self.tuned_settings = {}
+        # Reused buffer for llama_copy_state_data when saving session states (see _capture_session_state)
+        self._session_state_buffer = None
         logger.info(f"ModelManager __init__ completed. self.model is {self.model}. self.model_path is {self.model_path}")
         # Verify MODEL_PATH exists right away
         if not os.path.exists(self.model_path):
@@ -29,24 +63,20 @@ class ModelManager:
 
         try:
             if self.model is None:
-                logger.info(f"Attempting to load Llama model from path: {self.model_path}")
+                logger.info(f"Attempting to load Llama model from path: {self.model_path} (variant {self.variant or 'default'})")
                 if not os.path.exists(self.model_path):
                     logger.error(f"Llama model file not found at path: {self.model_path}")
                     return False # Cannot load if file doesn't exist
                 
+                if self.autotune:
+                    self.apply_tuning_profile()
+
                 # Ensure MODEL_CONFIG has all necessary keys Llama is expecting
-                logger.info(f"Using MODEL_CONFIG: {MODEL_CONFIG}")
-
-                self.model = Llama(
-                    model_path=self.model_path,
-                    n_ctx=MODEL_CONFIG.get("n_ctx", 2048), # Use .get for safety
-                    n_threads=MODEL_CONFIG.get("n_threads", None), # None might mean auto
-                    n_batch=MODEL_CONFIG.get("n_batch", 512),
-                    # n_gpu_layers=1 if os.environ.get("CUDA_AVAILABLE") == "True" else 0, # Example for gpu layers
-                    n_gpu_layers=MODEL_CONFIG.get("n_gpu_layers", 0), # Add to config or handle
-                    verbose=False # Keep verbose False for cleaner logs unless debugging Llama internals
-                )
+                logger.info(f"Using MODEL_CONFIG: {MODEL_CONFIG}, tuned settings: {self.tuned_settings}, overrides: {self.llama_overrides}")
+
+                self.model = Llama(**self._llama_kwargs())
                 logger.info("Llama model loaded successfully into self.model.")
+                self.prepare_prefix_cache()
             else:
                 logger.info("Model was already loaded.")
             return True
@@ -57,23 +87,610 @@ class ModelManager:
             logger.error(f"General error during model loading: {str(e)}", exc_info=True) # exc_info=True will give you the full traceback for the original error
             return False
 
+    def _llama_kwargs(self, **overrides):
+        """
+        Llama constructor arguments from MODEL_CONFIG (read at call time), then this instance's tuned settings and
+        llama_overrides; overrides win over all of them (tuning probes).
+        """
+        kwargs = dict(
+            model_path=self.model_path,
+            n_ctx=MODEL_CONFIG.get("n_ctx", 2048), # Use .get for safety
+            n_threads=MODEL_CONFIG.get("n_threads", None), # None might mean auto
+            n_threads_batch=MODEL_CONFIG.get("n_threads_batch", None), # None = llama.cpp default (half the CPUs); set by the worker pool / tuning
+            n_batch=MODEL_CONFIG.get("n_batch", 512),
+            # n_gpu_layers=1 if os.environ.get("CUDA_AVAILABLE") == "True" else 0, # Example for gpu layers
+            n_gpu_layers=MODEL_CONFIG.get("n_gpu_layers", 0), # Add to config or handle
+            use_mmap=MODEL_CONFIG.get("use_mmap", True),
+            use_mlock=MODEL_CONFIG.get("use_mlock", False),
+            verbose=False # Keep verbose False for cleaner logs unless debugging Llama internals
+        )
+        kwargs.update(self.tuned_settings)
+        kwargs.update(self.llama_overrides)
+        kwargs.update(overrides)
+        return kwargs
+
+    def apply_tuning_profile(self):
+        """
+        Loads the saved tuning profile for this CPU + GGUF file, or calibrates one (see hardware_tuner.calibrate),
+        and uses its n_threads / n_threads_batch / n_batch for this instance (self.tuned_settings). Settings fixed by
+        llama_overrides are neither probed nor replaced. Failures are logged and leave the settings as configured.
+        Returns the profile summary (also kept in self.tuning_profile).
+        """
+        try:
+            cpu_info = hardware_tuner.detect_cpu_info()
+            key = hardware_tuner.profile_key(cpu_info, self.model_path)
+            fixed_threads = self.llama_overrides.get("n_threads")
+            fixed_threads_batch = self.llama_overrides.get("n_threads_batch")
+            if fixed_threads or fixed_threads_batch:
+                key = f"{key}-t{fixed_threads}-{fixed_threads_batch}" # A profile probed under these thread counts
+            profile_path = AUTOTUNE_CONFIG.get("profile_path") or os.path.join(
+                os.path.dirname(os.path.abspath(self.model_path)), "tuning_profiles.json")
+            profile = None if AUTOTUNE_CONFIG.get("recalibrate", False) else hardware_tuner.load_profile(profile_path, key)
+            source = "saved"
+            if profile is None:
+                logger.info(f"No tuning profile for {cpu_info['cpu_model']} ({cpu_info['physical_cores']} cores) and this model, calibrating...")
+                from utils import create_example_data
+                profile = hardware_tuner.calibrate(
+                    lambda **params: Llama(**self._llama_kwargs(**params)),
+                    PromptTemplates.create_health_advisor_prompt(create_example_data()["full_input"]),
+                    cpu_info,
+                    n_ctx=MODEL_CONFIG.get("n_ctx", 2048),
+                    thread_candidates=[fixed_threads] if fixed_threads else AUTOTUNE_CONFIG.get("n_threads"),
+                    threads_batch_candidates=[fixed_threads_batch] if fixed_threads_batch else AUTOTUNE_CONFIG.get("n_threads_batch"),
+                    batch_candidates=AUTOTUNE_CONFIG.get("n_batch") or (128, 256, 512),
+                    probe_prompt_tokens=AUTOTUNE_CONFIG.get("probe_prompt_tokens", 256),
+                    probe_decode_tokens=AUTOTUNE_CONFIG.get("probe_decode_tokens", 32),
+                    probe_repeats=AUTOTUNE_CONFIG.get("probe_repeats", 2),
+                )
+                hardware_tuner.save_profile(profile_path, key, profile)
+                source = "calibrated"
+            self.tuned_settings = {
+                setting: profile[setting] for setting in ("n_threads", "n_threads_batch", "n_batch")
+                if setting not in self.llama_overrides
+            }
+            self.tuning_profile = hardware_tuner.profile_summary(profile, source)
+            logger.info(
+                f"Tuning profile {key} ({source}): n_threads={profile['n_threads']}, n_threads_batch={profile['n_threads_batch']}, "
+                f"n_batch={profile['n_batch']}; prefill {profile['prefill_tokens_per_second']} tokens/s, "
+                f"decode {profile['decode_tokens_per_second']} tokens/s on {cpu_info['cpu_model']}."
+            )
+        except Exception as e:
+            logger.warning(f"Hardware tuning failed, keeping the configured settings: {str(e)}", exc_info=True)
+            self.tuning_profile = None
+            self.tuned_settings = {}
+        return self.tuning_profile
+
     def generate_response(self, prompt):
+        return self.generate_response_with_stats(prompt)[0]
+
+    def warmup(self, max_tokens=16):
+        """
+        Runs one short generation on a representative prompt so the first real request does not pay for
+        page faults on the mmap'ed weights, the first KV cache / compute buffer allocations or the prefix restore.
+        Returns the seconds it took.
+        """
+        if not hasattr(self, 'model') or self.model is None:
+            raise ValueError("Model not loaded. Cannot warm up.")
+        from utils import create_example_data
+        prompt = PromptTemplates.create_health_advisor_prompt(create_example_data()["full_input"])
+        started_at = time.perf_counter()
+        self._restore_prefix_state(prompt)
+        self.model(prompt, **{**self._completion_kwargs(), "max_tokens": max_tokens})
+        warmup_seconds = time.perf_counter() - started_at
+        logger.info(f"Warmup generation ({max_tokens} tokens) finished in {warmup_seconds:.2f} seconds.")
+        return warmup_seconds
+
+    def generate_response_with_stats(self, prompt):
+        """
+        Same as generate_response, but returns (text, stats) with the token counts llama.cpp reports (usage)
+        and where the time went: prefix_restore_seconds, prefill_seconds, decode_seconds, generation_seconds.
+        prefilled_tokens is the part of the prompt that was really evaluated (not restored from the KV cache).
+        Values llama.cpp cannot provide are None.
+        """
         if not hasattr(self, 'model') or self.model is None:
             logger.error("generate_response: Model not loaded or 'model' attribute missing.")
             raise ValueError("Model not loaded. Cannot generate response.")
         
         logger.info("generate_response called with prompt.")
         try:
+            started_at = time.perf_counter()
+            # Put the pre-evaluated system prompt back into the context; Llama.generate() then
+            # only prefills the tokens after the longest common prefix (the user-specific part).
+            self._restore_prefix_state(prompt)
+            restored_at = time.perf_counter()
+            decoder = self._get_speculative_decoder(prompt) if MODEL_CONFIG.get("speculative_decoding", False) else None
+            if decoder is not None:
+                text = "".join(decoder.generate(prompt, **self._speculative_kwargs()))
+                stats = dict(decoder.stats, prefix_restore_seconds=restored_at - started_at,
+                             generation_seconds=time.perf_counter() - restored_at)
+                self._log_speculative_stats(stats)
+                return text.strip(), stats
+            self._reset_llama_timings()
             response = self.model( # This is where self.model is used
                 prompt,
-                max_tokens=MODEL_CONFIG.get("max_tokens", 150),
-                temperature=MODEL_CONFIG.get("temperature", 0.7),
-                top_p=MODEL_CONFIG.get("top_p", 0.95),
-                repeat_penalty=MODEL_CONFIG.get("repeat_penalty", 1.1),
-                stop=["</s>", "<|end|>", "\n\nUser:", "\n\nHuman:"] # Common stop tokens
+                **self._report_kwargs()
             )
+            finished_at = time.perf_counter()
             logger.info("Response generated by Llama model.")
-            return response['choices'][0]['text'].strip()
+            usage = response.get('usage', {})
+            timings = self._read_llama_timings()
+            stats = {
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "prefilled_tokens": timings["n_p_eval"] if timings else None,
+                "prefix_restore_seconds": restored_at - started_at,
+                "prefill_seconds": timings["t_p_eval_ms"] / 1000 if timings else None,
+                "decode_seconds": timings["t_eval_ms"] / 1000 if timings else None,
+                "generation_seconds": finished_at - restored_at,
+            }
+            return response['choices'][0]['text'].strip(), stats
         except Exception as e:
             logger.error(f"Error during model inference (generate_response): {str(e)}", exc_info=True)
-            raise Exception(f"Error generating response from Llama model: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Error generating response from Llama model: {str(e)}")
+
+    def _reset_llama_timings(self):
+        # llama.cpp keeps per-context counters for prompt eval vs eval; start them from zero for this call
+        ctx = getattr(self.model, 'ctx', None)
+        if ctx is not None and hasattr(llama_cpp, 'llama_reset_timings'):
+            llama_cpp.llama_reset_timings(ctx)
+
+    def _read_llama_timings(self):
+        """Returns llama.cpp's prompt-eval / eval timings of the context, or None if they are not available."""
+        ctx = getattr(self.model, 'ctx', None)
+        if ctx is None or not hasattr(llama_cpp, 'llama_get_timings'):
+            return None
+        try:
+            timings = llama_cpp.llama_get_timings(ctx)
+            return {
+                "t_p_eval_ms": timings.t_p_eval_ms,
+                "n_p_eval": timings.n_p_eval,
+                "t_eval_ms": timings.t_eval_ms,
+                "n_eval": timings.n_eval,
+            }
+        except Exception as e:
+            logger.debug(f"llama.cpp timings not available: {str(e)}")
+            return None
+
+    def generate_response_stream(self, prompt):
+        """
+        Same as generate_response, but yields the text pieces as llama.cpp produces them (stream=True).
+        Closing the generator early stops the generation. When it runs to the end, the generator returns the
+        prefill stats (StopIteration.value): prompt_tokens, prefilled_tokens, prefix_restore_seconds, prefill_seconds
+        (None where llama.cpp cannot provide them).
+        """
+        if not hasattr(self, 'model') or self.model is None:
+            logger.error("generate_response_stream: Model not loaded or 'model' attribute missing.")
+            raise ValueError("Model not loaded. Cannot generate response.")
+
+        logger.info("generate_response_stream called with prompt.")
+        try:
+            started_at = time.perf_counter()
+            self._restore_prefix_state(prompt)
+            prefix_restore_seconds = time.perf_counter() - started_at
+            decoder = self._get_speculative_decoder(prompt) if MODEL_CONFIG.get("speculative_decoding", False) else None
+            if decoder is not None:
+                try:
+                    yield from decoder.generate(prompt, **self._speculative_kwargs())
+                finally:
+                    self._log_speculative_stats(decoder.stats)
+                stats = decoder.stats
+                prompt_tokens, prefilled_tokens, prefill_seconds = stats["prompt_tokens"], stats["prefilled_tokens"], stats["prefill_seconds"]
+            else:
+                self._reset_llama_timings()
+                for chunk in self.model(prompt, stream=True, **self._report_kwargs()):
+                    text = chunk['choices'][0]['text']
+                    if text:
+                        yield text
+                timings = self._read_llama_timings()
+                prompt_tokens = self.count_tokens(prompt)
+                prefilled_tokens = timings["n_p_eval"] if timings else None
+                prefill_seconds = timings["t_p_eval_ms"] / 1000 if timings else None
+            logger.info("Streamed response generated by Llama model.")
+            return {
+                "prompt_tokens": prompt_tokens,
+                "prefilled_tokens": prefilled_tokens,
+                "prefix_restore_seconds": prefix_restore_seconds,
+                "prefill_seconds": prefill_seconds,
+            }
+        except GeneratorExit:
+            logger.info("generate_response_stream: consumer stopped the stream early.")
+            raise
+        except Exception as e:
+            logger.error(f"Error during model inference (generate_response_stream): {str(e)}", exc_info=True)
+            raise Exception(f"Error generating response from Llama model: {str(e)}")
+
+    def generate_batch(self, prompts):
+        """
+        Generates completions for many prompts at once with continuous batching (BatchDecoder) and yields
+        result dicts as they finish: {"index", "text", "error", "prompt_tokens", "completion_tokens", "seconds"}.
+        """
+        if not hasattr(self, 'model') or self.model is None:
+            logger.error("generate_batch: Model not loaded or 'model' attribute missing.")
+            raise ValueError("Model not loaded. Cannot generate response.")
+
+        if self.batch_decoder is None:
+            self.batch_decoder = BatchDecoder(
+                self.model,
+                n_parallel=BATCH_CONFIG.get("n_parallel", 4),
+                n_ctx=BATCH_CONFIG.get("n_ctx", 8192),
+                n_batch=BATCH_CONFIG.get("n_batch", 512),
+                seed=BATCH_CONFIG.get("seed", 42),
+            )
+        logger.info(f"generate_batch called with {len(prompts)} prompts.")
+        kwargs = self._completion_kwargs()
+        structured = STRUCTURED_OUTPUT_CONFIG.get("enabled", False)
+        yield from self.batch_decoder.run(
+            prompts,
+            PromptTemplates.get_static_prefix(),
+            max_tokens=generation_max_tokens(),
+            temperature=kwargs["temperature"],
+            top_p=kwargs["top_p"],
+            repeat_penalty=kwargs["repeat_penalty"],
+            stop=kwargs["stop"],
+            logits_processor_factory=(lambda: SectionBudgetProcessor(self.model)) if structured else None,
+        )
+
+    def _get_speculative_decoder(self, prompt):
+        """
+        Creates the SpeculativeDecoder on first use, or again if its MODEL_CONFIG settings changed. A new decoder
+        first generates speculative_check_tokens tokens of prompt both ways (see matches_plain_decoding); if they
+        differ, this returns None and the model decodes without drafting until the settings change.
+        """
+        settings = (
+            MODEL_CONFIG.get("speculative_ngram_size", 3),
+            MODEL_CONFIG.get("speculative_num_pred_tokens", 8),
+        )
+        decoder = self.speculative_decoder
+        if decoder is None or (decoder.ngram_size, decoder.num_pred_tokens) != settings:
+            if decoder is not None:
+                decoder.close()
+            self.speculative_decoder = SpeculativeDecoder(
+                self.model, ngram_size=settings[0], num_pred_tokens=settings[1]
+            )
+            self._speculative_matches_plain = self._check_speculative_decoder(prompt)
+        return self.speculative_decoder if self._speculative_matches_plain else None
+
+    def _check_speculative_decoder(self, prompt):
+        check_tokens = MODEL_CONFIG.get("speculative_check_tokens", 64)
+        if check_tokens <= 0:
+            return True
+        kwargs = self._speculative_kwargs()
+        sampling = {key: kwargs[key] for key in ("temperature", "top_p", "repeat_penalty")}
+        structured = STRUCTURED_OUTPUT_CONFIG.get("enabled", False)
+        matches, mismatch_at = self.speculative_decoder.matches_plain_decoding(
+            prompt, max_tokens=check_tokens,
+            logits_processor_factory=(
+                lambda: llama_cpp.LogitsProcessorList([SectionBudgetProcessor(self.model)])
+            ) if structured else None,
+            **sampling,
+        )
+        if matches:
+            logger.info(f"Speculative decoding: the first {check_tokens} tokens match plain decoding.")
+        else:
+            logger.warning(
+                f"Speculative decoding: token {mismatch_at} differs from plain decoding, drafting stays off "
+                f"for this model."
+            )
+        return matches
+
+    def _speculative_kwargs(self):
+        kwargs = self._report_kwargs()
+        keys = ("max_tokens", "temperature", "top_p", "repeat_penalty", "stop", "logits_processor")
+        return {key: kwargs[key] for key in keys if key in kwargs}
+
+    def _log_speculative_stats(self, stats):
+        if not stats:
+            return
+        speculative = stats["speculative"]
+        logger.info(
+            f"Speculative decoding: {stats['completion_tokens']} tokens in {speculative['verify_steps']} steps, "
+            f"{speculative['accepted_tokens']}/{speculative['drafted_tokens']} drafted tokens accepted "
+            f"(rate {speculative['acceptance_rate']}), estimated decode speedup {speculative['decode_speedup']}x."
+        )
+
+    def count_tokens(self, text):
+        """Number of tokens the model's tokenizer produces for text (tokenized the same way as in generation)."""
+        if not hasattr(self, 'model') or self.model is None:
+            raise ValueError("Model not loaded. Cannot count tokens.")
+        return len(self.model.tokenize(text.encode("utf-8")))
+
+    def _report_kwargs(self):
+        """
+        _completion_kwargs for a full report. In structured mode (STRUCTURED_OUTPUT_CONFIG) max_tokens comes from the
+        section budgets and a fresh SectionBudgetProcessor steers the generation section by section.
+        """
+        kwargs = self._completion_kwargs()
+        kwargs["max_tokens"] = generation_max_tokens()
+        if STRUCTURED_OUTPUT_CONFIG.get("enabled", False):
+            kwargs["logits_processor"] = llama_cpp.LogitsProcessorList([SectionBudgetProcessor(self.model)])
+        return kwargs
+
+    def _completion_kwargs(self):
+        """Sampling settings shared by all generation paths, read from MODEL_CONFIG at call time."""
+        return {
+            "max_tokens": MODEL_CONFIG.get("max_tokens", 150),
+            "temperature": MODEL_CONFIG.get("temperature", 0.7),
+            "top_p": MODEL_CONFIG.get("top_p", 0.95),
+            "repeat_penalty": MODEL_CONFIG.get("repeat_penalty", 1.1),
+            "stop": ["</s>", "<|end|>", "\n\nUser:", "\n\nHuman:"], # Common stop tokens
+        }
+
+    # --- Follow-up sessions ---
+
+    def generate_response_for_session(self, prompt):
+        """
+        generate_response_with_stats, plus the state to continue the conversation from:
+        (text, stats, session_state) with session_state = {"text", "tokens", "llama_state", "fingerprint"}
+        (see session_store.SessionStore). Captured right after the report, while the context still holds it.
+        """
+        text, stats = self.generate_response_with_stats(prompt)
+        return text, stats, self._capture_session_state(prompt + text)
+
+    def generate_followup(self, session_state, turn_text):
+        """
+        Continues a session with turn_text (PromptTemplates.create_follow_up_turn) and returns
+        (answer, stats, new session_state). If the session's llama.cpp state can be restored only turn_text is
+        prefilled (stats["session_resume"] == "kv_state"); otherwise the whole conversation text is ("full_prefill").
+        """
+        if not hasattr(self, 'model') or self.model is None:
+            logger.error("generate_followup: Model not loaded or 'model' attribute missing.")
+            raise ValueError("Model not loaded. Cannot generate response.")
+
+        max_tokens = SESSION_CONFIG.get("followup_max_tokens", 200)
+        conversation_text = session_state["text"] + turn_text
+        # Both paths continue the same tokens: the conversation tokenized like a report prompt. Llama.generate()
+        # evaluates only what follows the longest common prefix with the context, i.e. turn_text after a restore.
+        prompt = self.model.tokenize(conversation_text.encode("utf-8"))
+        if len(prompt) + max_tokens > self.model.n_ctx():
+            raise ValueError(f"Conversation too long ({len(prompt)} tokens) for another answer of up to {max_tokens} tokens.")
+        started_at = time.perf_counter()
+        if self._restore_session_state(session_state):
+            resume = "kv_state"
+            session_tokens = session_state["tokens"]
+            reused = llama_cpp.Llama.longest_token_prefix(session_tokens, prompt)
+            if reused < len(session_tokens):
+                logger.warning(f"Session state holds other tokens than the conversation from token {reused} of "
+                               f"{len(session_tokens)} on, re-evaluating from there.")
+        else:
+            resume = "full_prefill"
+            self._restore_prefix_state(conversation_text) # The conversation starts with the system prompt
+        restored_at = time.perf_counter()
+        try:
+            self._reset_llama_timings()
+            answer, completion_tokens = self._continue_tokens(prompt, max_tokens)
+        except Exception as e:
+            logger.error(f"Error during model inference (generate_followup): {str(e)}", exc_info=True)
+            raise Exception(f"Error generating response from Llama model: {str(e)}")
+        finished_at = time.perf_counter()
+        timings = self._read_llama_timings()
+        stats = {
+            "prompt_tokens": len(prompt),
+            "completion_tokens": completion_tokens,
+            "prefilled_tokens": timings["n_p_eval"] if timings else None,
+            "session_restore_seconds": restored_at - started_at,
+            "prefill_seconds": timings["t_p_eval_ms"] / 1000 if timings else None,
+            "decode_seconds": timings["t_eval_ms"] / 1000 if timings else None,
+            "generation_seconds": finished_at - restored_at,
+            "session_resume": resume,
+        }
+        logger.info(f"Follow-up answered ({resume}, {stats['prefilled_tokens']} tokens prefilled) in {finished_at - started_at:.2f} seconds.")
+        return answer.strip(), stats, self._capture_session_state(conversation_text + answer)
+
+    def _continue_tokens(self, prompt_tokens, max_tokens):
+        """
+        Samples up to max_tokens after prompt_tokens with Llama.generate() and _completion_kwargs' settings, stopping
+        at EOS or a stop string like Llama.__call__. Returns (text, completion token count).
+        """
+        kwargs = self._completion_kwargs()
+        stop_sequences = [s.encode("utf-8") for s in kwargs["stop"]]
+        eos_token = self.model.token_eos()
+        text = b""
+        completion_tokens = 0
+        tokens = self.model.generate(prompt_tokens, top_p=kwargs["top_p"], temp=kwargs["temperature"],
+                                     repeat_penalty=kwargs["repeat_penalty"])
+        try:
+            for token in tokens:
+                if token == eos_token:
+                    break
+                completion_tokens += 1
+                scanned = len(text)
+                text += self.model.detokenize([token])
+                # Only a stop string that ends in the new piece can be new
+                stop_at = min((at for at in (text.find(s, max(0, scanned - len(s) + 1)) for s in stop_sequences)
+                               if at >= 0), default=None)
+                if stop_at is not None:
+                    text = text[:stop_at]
+                    break
+                if completion_tokens >= max_tokens:
+                    break
+        finally:
+            tokens.close()
+        return text.decode("utf-8", errors="ignore"), completion_tokens
+
+    def _session_fingerprint(self):
+        # A state only fits a context of the same model file, MODEL_CONFIG and llama.cpp version
+        return self._prefix_fingerprint("")
+
+    def _capture_session_state(self, conversation_text):
+        """The conversation so far plus the llama.cpp state holding it; llama_state is None if it cannot be copied."""
+        session_state = {"text": conversation_text, "tokens": None, "llama_state": None, "fingerprint": self._session_fingerprint()}
+        ctx = getattr(self.model, 'ctx', None)
+        if ctx is None: # E.g. the fake model; follow-ups then prefill the text
+            return session_state
+        try:
+            # The context holds the conversation except the last sampled token, which was never evaluated. Evaluate
+            # what is missing so the state holds exactly the tokens a full prefill of conversation_text would.
+            tokens = self.model.tokenize(conversation_text.encode("utf-8"))
+            reusable = llama_cpp.Llama.longest_token_prefix(self.model.input_ids[:self.model.n_tokens].tolist(), tokens)
+            llama_cpp.llama_kv_cache_seq_rm(ctx, -1, reusable, -1)
+            self.model.n_tokens = reusable
+            self.model.eval(tokens[reusable:])
+            # Like _capture_prefix_snapshot without the scores matrix; every follow-up evaluates new tokens,
+            # so the last logits row is not needed either
+            state_size = int(llama_cpp.llama_get_state_size(ctx))
+            if self._session_state_buffer is None or len(self._session_state_buffer) != state_size:
+                self._session_state_buffer = (llama_cpp.c_uint8 * state_size)()
+            n_bytes = int(llama_cpp.llama_copy_state_data(ctx, self._session_state_buffer))
+            if n_bytes > state_size:
+                raise RuntimeError("Failed to copy llama state data for the session")
+            session_state["tokens"] = tokens
+            session_state["llama_state"] = llama_cpp.ctypes.string_at(self._session_state_buffer, n_bytes)
+        except Exception as e:
+            logger.warning(f"Could not capture session state, follow-ups will prefill the conversation: {str(e)}")
+        return session_state
+
+    def _restore_session_state(self, session_state):
+        """Loads a session's llama.cpp state into the context. Returns False if it is missing or does not fit."""
+        llama_state, tokens = session_state.get("llama_state"), session_state.get("tokens")
+        if llama_state is None or not tokens or getattr(self.model, 'ctx', None) is None:
+            return False
+        if session_state.get("fingerprint") != self._session_fingerprint():
+            logger.info("Session state was saved with another model or MODEL_CONFIG, prefilling the conversation instead.")
+            return False
+        state_buffer = (llama_cpp.c_uint8 * len(llama_state)).from_buffer_copy(llama_state)
+        if llama_cpp.llama_set_state_data(self.model.ctx, state_buffer) != len(llama_state):
+            self.model.reset()
+            logger.warning("Failed to restore session state, prefilling the conversation instead.")
+            return False
+        self.model.input_ids[:len(tokens)] = tokens
+        self.model.n_tokens = len(tokens)
+        return True
+
+    # --- Static prompt prefix KV cache ---
+
+    def _prefix_fingerprint(self, prefix_text):
+        """Hash of everything the prefix KV state depends on: template text, MODEL_CONFIG and the GGUF file."""
+        hasher = hashlib.sha256()
+        hasher.update(prefix_text.encode("utf-8"))
+        hasher.update(json.dumps(MODEL_CONFIG, sort_keys=True, default=str).encode("utf-8"))
+        hasher.update(os.path.abspath(self.model_path).encode("utf-8"))
+        try:
+            model_stat = os.stat(self.model_path)
+            hasher.update(f"{model_stat.st_size}:{model_stat.st_mtime_ns}".encode("utf-8"))
+        except OSError:
+            pass
+        hasher.update(getattr(llama_cpp, "__version__", "").encode("utf-8"))
+        return hasher.hexdigest()[:16]
+
+    def _prefix_cache_path(self, fingerprint):
+        cache_dir = PREFIX_CACHE_CONFIG.get("cache_dir") or os.path.dirname(os.path.abspath(self.model_path))
+        return os.path.join(cache_dir, f"{os.path.basename(self.model_path)}.prefix-{fingerprint}.state")
+
+    def prepare_prefix_cache(self):
+        """
+        Evaluates PromptTemplates.get_static_prefix() once and keeps the resulting llama.cpp state in memory
+        (and on disk next to MODEL_PATH if enabled). Returns True if a usable snapshot is available.
+        Failures are logged and only disable the optimisation; generation still works without it.
+        """
+        if not PREFIX_CACHE_CONFIG.get("enabled", False) or self.model is None:
+            self.prefix_snapshot = None
+            return False
+
+        prefix_text = PromptTemplates.get_static_prefix()
+        fingerprint = self._prefix_fingerprint(prefix_text)
+        try:
+            prefix_tokens = self.model.tokenize(prefix_text.encode("utf-8"))
+            snapshot = self._load_prefix_snapshot_from_disk(fingerprint, prefix_tokens)
+            if snapshot is None:
+                logger.info(f"Evaluating static prompt prefix ({len(prefix_tokens)} tokens) for KV state reuse...")
+                self.model.reset()
+                self.model.eval(prefix_tokens)
+                snapshot = self._capture_prefix_snapshot(fingerprint, prefix_text, prefix_tokens)
+                self._save_prefix_snapshot_to_disk(snapshot)
+            self.prefix_snapshot = snapshot
+            logger.info(f"Prefix KV state ready: {len(prefix_tokens)} tokens, {snapshot['llama_state_size']} bytes, fingerprint {fingerprint}.")
+            return True
+        except Exception as e:
+            logger.error(f"Could not prepare prefix KV state, continuing without it: {str(e)}", exc_info=True)
+            self.prefix_snapshot = None
+            return False
+
+    def _capture_prefix_snapshot(self, fingerprint, prefix_text, prefix_tokens):
+        # Same as Llama.save_state(), but without copying the n_ctx x n_vocab scores matrix;
+        # only the logits row of the last prefix token is needed to continue from here.
+        state_size = llama_cpp.llama_get_state_size(self.model.ctx)
+        state_buffer = (llama_cpp.c_uint8 * int(state_size))()
+        n_bytes = int(llama_cpp.llama_copy_state_data(self.model.ctx, state_buffer))
+        if n_bytes > int(state_size):
+            raise RuntimeError("Failed to copy llama state data for the prompt prefix")
+        llama_state = (llama_cpp.c_uint8 * n_bytes)()
+        llama_cpp.ctypes.memmove(llama_state, state_buffer, n_bytes)
+        return {
+            "fingerprint": fingerprint,
+            "prefix_text": prefix_text,
+            "tokens": list(prefix_tokens),
+            "last_logits": self.model.scores[len(prefix_tokens) - 1, :].copy(),
+            "llama_state": llama_state,
+            "llama_state_size": n_bytes,
+        }
+
+    def _save_prefix_snapshot_to_disk(self, snapshot):
+        if not PREFIX_CACHE_CONFIG.get("persist_to_disk", False):
+            return
+        cache_path = self._prefix_cache_path(snapshot["fingerprint"])
+        try:
+            on_disk = dict(snapshot, llama_state=bytes(snapshot["llama_state"]))
+            tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(on_disk, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path) # Atomic, so a concurrent reader never sees half a file
+            logger.info(f"Prefix KV state saved to {cache_path}")
+            # Snapshots for an older template / config can never match again
+            pattern = self._prefix_cache_path("*")
+            for stale_path in glob.glob(pattern):
+                if stale_path != cache_path and ".tmp-" not in stale_path:
+                    os.remove(stale_path)
+                    logger.info(f"Removed stale prefix KV state {stale_path}")
+        except OSError as e:
+            logger.warning(f"Could not persist prefix KV state to {cache_path}: {str(e)}")
+
+    def _load_prefix_snapshot_from_disk(self, fingerprint, prefix_tokens):
+        if not PREFIX_CACHE_CONFIG.get("persist_to_disk", False):
+            return None
+        cache_path = self._prefix_cache_path(fingerprint)
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot.get("fingerprint") != fingerprint or snapshot.get("tokens") != list(prefix_tokens):
+                logger.warning(f"Prefix KV state at {cache_path} does not match the current prompt, rebuilding.")
+                return None
+            raw_state = snapshot["llama_state"]
+            snapshot["llama_state"] = (llama_cpp.c_uint8 * len(raw_state)).from_buffer_copy(raw_state)
+            logger.info(f"Prefix KV state loaded from {cache_path}")
+            return snapshot
+        except Exception as e:
+            logger.warning(f"Could not read prefix KV state from {cache_path}, rebuilding: {str(e)}")
+            return None
+
+    def _restore_prefix_state(self, prompt):
+        """Loads the prefix snapshot into the context if the prompt starts with it and the context does not hold it already."""
+        snapshot = self.prefix_snapshot
+        if snapshot is None or not PREFIX_CACHE_CONFIG.get("enabled", False):
+            return False
+
+        # Template or MODEL_CONFIG changed since the snapshot was taken -> rebuild it
+        current_prefix = PromptTemplates.get_static_prefix()
+        if snapshot["prefix_text"] != current_prefix or snapshot["fingerprint"] != self._prefix_fingerprint(current_prefix):
+            logger.info("Static prompt prefix or MODEL_CONFIG changed, invalidating prefix KV state.")
+            if not self.prepare_prefix_cache():
+                return False
+            snapshot = self.prefix_snapshot
+
+        if not prompt.startswith(snapshot["prefix_text"]):
+            return False
+
+        prefix_tokens = snapshot["tokens"]
+        n_prefix = len(prefix_tokens)
+        if self.model.n_tokens >= n_prefix and self.model.input_ids[:n_prefix].tolist() == prefix_tokens:
+            return True # The live context still starts with the prefix (e.g. the previous request used it)
+
+        self.model.input_ids[:n_prefix] = prefix_tokens
+        self.model.scores[n_prefix - 1, :] = snapshot["last_logits"]
+        if llama_cpp.llama_set_state_data(self.model.ctx, snapshot["llama_state"]) != snapshot["llama_state_size"]:
+            self.model.reset()
+            raise RuntimeError("Failed to restore prefix KV state")
+        self.model.n_tokens = n_prefix
+        logger.info(f"Restored prefix KV state ({n_prefix} tokens), only the user-specific suffix will be prefilled.")
+        return True
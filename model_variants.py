@@ -0,0 +1,270 @@
+# model_variants.py
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from config import MODEL_VARIANTS, MODEL_ROUTING_CONFIG, STARTUP_CONFIG
+from metrics import MODEL_VARIANT_TIER, MODEL_VARIANT_TIER_CHANGES
+from model_manager import ModelManager
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownModelVariantError(Exception):
+    """Raised for a variant name that is not in MODEL_VARIANTS. The admin endpoints map it to 404."""
+    pass
+
+
+class ModelVariantRegistry:
+    """
+    The loaded GGUF variants of the model (MODEL_VARIANTS), one ModelManager each. Exposes the ModelManager
+    interface with an extra `variant` argument (None = the default variant) and adds "model_variant" to the stats.
+
+    Loading or reloading a variant builds and warms up a new ModelManager first and only then swaps it in, so calls
+    that are already running finish on the old instance and nothing in flight is dropped. Every variant keeps its
+    own llama.cpp context; the caller (InferenceQueue / worker process) still runs one generation at a time.
+    """
+
+    def __init__(self, variants=None, default_variant=None, llama_overrides=None):
+        self.variants = MODEL_VARIANTS if variants is None else variants
+        self.llama_overrides = dict(llama_overrides or {}) # Passed to every ModelManager (e.g. a worker's n_threads)
+        self.default_variant = default_variant or MODEL_ROUTING_CONFIG.get("default_variant") or next(iter(self.variants))
+        self._managers = {} # variant name -> loaded ModelManager
+        self._lock = threading.Lock() # Guards _managers / default_variant; never held while loading
+        self._load_lock = threading.Lock() # One load at a time, the weights of two variants are enough in memory
+
+    @property
+    def tuning_profile(self):
+        manager = self._managers.get(self.default_variant)
+        return manager.tuning_profile if manager is not None else None
+
+    def load_model(self):
+        """Loads the default variant and all variants with "preload". Returns True if the default one loaded."""
+        if self.default_variant not in self.variants:
+            logger.error(f"Default model variant {self.default_variant!r} is not in MODEL_VARIANTS {sorted(self.variants)}.")
+            return False
+        if not self.load_variant(self.default_variant, warmup=False): # The caller warms up (STARTUP_CONFIG)
+            return False
+        for name, spec in self.variants.items():
+            if name != self.default_variant and spec.get("preload", False):
+                if not self.load_variant(name, warmup=False):
+                    logger.error(f"Model variant {name} failed to load, serving without it.")
+        return True
+
+    def load_variant(self, name, reload=False, warmup=True):
+        """
+        Loads variant `name` (again, with reload) and swaps it in once it is ready. Returns False if the model could
+        not be loaded; the previously loaded instance, if any, then stays in service.
+        """
+        if name not in self.variants:
+            raise UnknownModelVariantError(f"Unknown model variant {name!r}; configured: {sorted(self.variants)}.")
+        with self._load_lock:
+            if name in self._managers and not reload:
+                logger.info(f"Model variant {name} is already loaded.")
+                return True
+            started_at = time.perf_counter()
+            # Only the default variant tunes for this machine; the others reuse its tuned settings
+            default_manager = self._managers.get(self.default_variant)
+            tuned_settings = default_manager.tuned_settings if default_manager is not None and name != self.default_variant else {}
+            manager = ModelManager(model_path=self.variants[name].get("path"), variant=name,
+                                   autotune=None if name == self.default_variant else False,
+                                   llama_overrides={**tuned_settings, **self.llama_overrides})
+            if not manager.load_model():
+                logger.error(f"Model variant {name} could not be loaded from {manager.model_path}.")
+                return False
+            if warmup and STARTUP_CONFIG.get("warmup_enabled", True):
+                try:
+                    manager.warmup(STARTUP_CONFIG.get("warmup_max_tokens", 16))
+                except Exception as e:
+                    logger.warning(f"Warmup of model variant {name} failed, swapping it in anyway: {str(e)}")
+            with self._lock:
+                replaced = self._managers.get(name)
+                self._managers[name] = manager
+        logger.info(
+            f"Model variant {name} {'reloaded' if replaced is not None else 'loaded'} in "
+            f"{time.perf_counter() - started_at:.2f} seconds from {manager.model_path}."
+        )
+        return True
+
+    def unload_variant(self, name):
+        """Removes a loaded variant (calls still running on it finish). Returns False if it was not loaded."""
+        if name not in self.variants:
+            raise UnknownModelVariantError(f"Unknown model variant {name!r}; configured: {sorted(self.variants)}.")
+        with self._lock:
+            if name == self.default_variant:
+                raise ValueError(f"Model variant {name} is the default variant; activate another one before unloading it.")
+            manager = self._managers.pop(name, None)
+        if manager is not None:
+            logger.info(f"Model variant {name} unloaded.")
+        return manager is not None
+
+    def set_default_variant(self, name):
+        """Makes a loaded variant the default one (served when no variant is requested)."""
+        with self._lock:
+            if name not in self._managers:
+                raise ValueError(f"Model variant {name} is not loaded.")
+            previous, self.default_variant = self.default_variant, name
+        logger.info(f"Default model variant changed from {previous} to {name}.")
+        return previous
+
+    def loaded_variants(self):
+        with self._lock:
+            return sorted(self._managers)
+
+    def status(self):
+        with self._lock:
+            return {
+                "default_variant": self.default_variant,
+                "variants": {
+                    name: {
+                        "loaded": name in self._managers,
+                        "model_path": self._managers[name].model_path if name in self._managers else spec.get("path"),
+                    }
+                    for name, spec in self.variants.items()
+                },
+            }
+
+    def _resolve(self, variant):
+        """Returns (name, ModelManager) for `variant`; unknown or unloaded variants fall back to the default."""
+        with self._lock:
+            if variant is not None and variant not in self._managers:
+                logger.warning(f"Model variant {variant} is not loaded, using {self.default_variant}.")
+                variant = None
+            name = variant or self.default_variant
+            manager = self._managers.get(name)
+        if manager is None:
+            raise ValueError("Model not loaded. Cannot generate response.")
+        return name, manager
+
+    # --- ModelManager interface ---
+
+    def generate_response(self, prompt, variant=None):
+        return self.generate_response_with_stats(prompt, variant)[0]
+
+    def generate_response_with_stats(self, prompt, variant=None):
+        name, manager = self._resolve(variant)
+        text, stats = manager.generate_response_with_stats(prompt)
+        stats["model_variant"] = name
+        return text, stats
+
+    def generate_response_for_session(self, prompt, variant=None):
+        name, manager = self._resolve(variant)
+        text, stats, session_state = manager.generate_response_for_session(prompt)
+        stats["model_variant"] = name
+        return text, stats, session_state
+
+    def generate_followup(self, session_state, turn_text, variant=None):
+        # A state saved by another variant does not match its fingerprint, so that follow-up prefills the text
+        name, manager = self._resolve(variant)
+        answer, stats, new_session_state = manager.generate_followup(session_state, turn_text)
+        stats["model_variant"] = name
+        return answer, stats, new_session_state
+
+    def generate_response_stream(self, prompt, variant=None):
+        name, manager = self._resolve(variant)
+        stats = yield from manager.generate_response_stream(prompt)
+        return dict(stats, model_variant=name) if stats is not None else None
+
+    def generate_batch(self, prompts, variant=None):
+        name, manager = self._resolve(variant)
+        for result in manager.generate_batch(prompts):
+            yield dict(result, model_variant=name)
+
+    def warmup(self, max_tokens=16):
+        """Warms up every loaded variant. Returns the total seconds."""
+        with self._lock:
+            managers = list(self._managers.values())
+        return sum(manager.warmup(max_tokens) for manager in managers)
+
+    def count_tokens(self, text):
+        # The variants are quantizations of the same model and share its tokenizer
+        return self._resolve(None)[1].count_tokens(text)
+
+
+class VariantRoutingPolicy:
+    """
+    Picks the variant for the next report from the load (MODEL_ROUTING_CONFIG). The tiers are the default variant
+    followed by the fallback variants, fastest last. While the queue depth or the p95 latency of recent reports is
+    over its high mark the policy moves one tier down (faster); once both are at or under their low marks it moves one
+    tier back up. Tier changes are at least min_tier_seconds apart and start a fresh latency window, so every tier is
+    judged on its own latencies.
+    """
+
+    def __init__(self, routing_config=None):
+        routing_config = MODEL_ROUTING_CONFIG if routing_config is None else routing_config
+        self.fallback_variants = list(routing_config.get("fallback_variants", []))
+        self.queue_depth_high = routing_config.get("queue_depth_high", 4)
+        self.queue_depth_low = routing_config.get("queue_depth_low", 1)
+        self.p95_latency_high_seconds = routing_config.get("p95_latency_high_seconds", 30.0)
+        self.p95_latency_low_seconds = routing_config.get("p95_latency_low_seconds", 15.0)
+        self.latency_window_seconds = routing_config.get("latency_window_seconds", 120)
+        self.min_latency_samples = routing_config.get("min_latency_samples", 5)
+        self.min_tier_seconds = routing_config.get("min_tier_seconds", 30)
+        self._latencies = deque() # (monotonic time, seconds) of recent reports on the current tier
+        self._tier = 0
+        self._changed_at = float("-inf")
+        self._lock = threading.Lock()
+        self.tier_changes = 0
+
+    def observe_latency(self, seconds):
+        """Records the queue wait + generation time of one report."""
+        with self._lock:
+            self._latencies.append((time.monotonic(), seconds))
+
+    def _p95_latency(self, now):
+        while self._latencies and self._latencies[0][0] < now - self.latency_window_seconds:
+            self._latencies.popleft()
+        if len(self._latencies) < self.min_latency_samples:
+            return None
+        latencies = sorted(seconds for _, seconds in self._latencies)
+        return latencies[math.ceil(0.95 * len(latencies)) - 1]
+
+    def _tiers(self, default_variant, loaded_variants):
+        return [default_variant] + [name for name in self.fallback_variants
+                                    if name != default_variant and name in loaded_variants]
+
+    def select(self, queue_depth, default_variant, loaded_variants):
+        """Returns the variant for a request admitted at `queue_depth` (requests waiting or running)."""
+        with self._lock:
+            now = time.monotonic()
+            tiers = self._tiers(default_variant, loaded_variants)
+            tier = min(self._tier, len(tiers) - 1) # Fallbacks can be unloaded meanwhile
+            p95_latency = self._p95_latency(now)
+            overloaded = queue_depth >= self.queue_depth_high or (
+                p95_latency is not None and p95_latency >= self.p95_latency_high_seconds)
+            relaxed = queue_depth <= self.queue_depth_low and (
+                p95_latency is None or p95_latency <= self.p95_latency_low_seconds)
+            if now - self._changed_at >= self.min_tier_seconds:
+                if overloaded and tier < len(tiers) - 1:
+                    tier += 1
+                elif relaxed and tier > 0:
+                    tier -= 1
+            if tier != self._tier:
+                direction = "down" if tier > self._tier else "up"
+                logger.info(
+                    f"Model routing: tier {self._tier} -> {tier} ({tiers[tier]}), queue depth {queue_depth}, "
+                    f"p95 latency {p95_latency if p95_latency is None else round(p95_latency, 2)}s."
+                )
+                MODEL_VARIANT_TIER_CHANGES.inc(direction=direction)
+                self.tier_changes += 1
+                self._tier = tier
+                self._changed_at = now
+                self._latencies.clear()
+            MODEL_VARIANT_TIER.set(tier)
+            return tiers[tier]
+
+    def stats(self, default_variant, loaded_variants):
+        with self._lock:
+            tiers = self._tiers(default_variant, loaded_variants)
+            p95_latency = self._p95_latency(time.monotonic())
+            tier = min(self._tier, len(tiers) - 1)
+            return {
+                "tiers": tiers,
+                "tier": tier,
+                "current_variant": tiers[tier],
+                "p95_latency_seconds": round(p95_latency, 3) if p95_latency is not None else None,
+                "latency_samples": len(self._latencies),
+                "tier_changes": self.tier_changes,
+            }
@@ -1,13 +1,10 @@
-class PromptTemplates:
-    @staticmethod
-    def create_health_advisor_prompt(user_input):
-        """
-        Returns a prompt to instruct an LLM to behave like a clinical AI Health Advisor.
-        Generates a structured 7-part health report using the user’s structured health data.
-        Designed to work with small LLMs by being ultra-explicit and data-driven.
-        """
+from health_input_parser import detect_health_signals
 
-        system_prompt = """You are a highly focused and data-driven AI Health Advisor. 
+
+class PromptTemplates:
+    # The system prompt is identical for every request, so it lives at class level
+    # where ModelManager can pre-evaluate it once (see get_static_prefix).
+    SYSTEM_PROMPT = """You are a highly focused and data-driven AI Health Advisor. 
 Your role is to analyze structured personal health data (including symptoms, biomarkers, screen time, emotional health, steps, blood pressure, diabetes status, physician notes) and generate a **clear, personalized, and medically sound 7-part health report** for the user.
 
 🧠 YOU MUST FOLLOW THE EXACT FORMAT BELOW:
@@ -100,20 +97,22 @@ Recommend screening tests, routine checks, or preventive actions based on the us
 - DONT SHOW RULES IN RESPONSE
 ---
 
-📚 Clinical Reference Ranges and Interpretation Guide (For Reasoning):
+Now analyze the following structured user data and generate a clear, patient-directed report using this 4-section format. Make sure every sentence is clinically reasoned and explained clearly using the reference ranges provided with the data.
+"""
 
-**Fever:**
+    # Clinical reference ranges, keyed by the metric names of health_input_parser.METRIC_PATTERNS.
+    # Only the blocks for metrics found in the user input are sent (see create_health_advisor_prompt).
+    REFERENCE_BLOCKS = [
+        ("fever", """**Fever:**
 - Normal: 97°F to 99°F
 - Low-grade: 99°F to 100.4°F
 - High: 100.4°F or more → infection or inflammation possible
-- Very high: ≥104°F → severe, needs urgent care
-
-**Fasting Blood Sugar (Glucose):**
+- Very high: ≥104°F → severe, needs urgent care"""),
+        ("glucose", """**Fasting Blood Sugar (Glucose):**
 - Normal: <100 mg/dL
 - Prediabetes: 100 to 125 mg/dL
-- Diabetes: ≥126 mg/dL (confirmed on 2 tests)
-
-**Cholesterol:**
+- Diabetes: ≥126 mg/dL (confirmed on 2 tests)"""),
+        ("cholesterol", """**Cholesterol:**
 - HDL (Good):
   - Normal: >40 mg/dL (men), >50 mg/dL (women)
   - Higher HDL protects against heart disease
@@ -123,53 +122,213 @@ Recommend screening tests, routine checks, or preventive actions based on the us
   - Borderline high: 130–159 mg/dL
   - High: ≥160 mg/dL → Heart disease risk
 - Total Cholesterol:
-  - Desirable: <200 mg/dL
-
-**Step Count (Activity Level):**
+  - Desirable: <200 mg/dL"""),
+        ("steps", """**Step Count (Activity Level):**
 - Sedentary: <5,000 steps/day
 - Low Active: 5,000–7,499
 - Somewhat Active: 7,500–9,999
-- Active: ≥10,000 steps/day
-
-**Blood Pressure:**
+- Active: ≥10,000 steps/day"""),
+        ("blood_pressure", """**Blood Pressure:**
 - Normal: <120/80 mmHg
 - Elevated: 120–129/<80
 - Hypertension Stage 1: 130–139 or 80–89
-- Hypertension Stage 2: ≥140 or ≥90
-
-**Weight Relevance:**
+- Hypertension Stage 2: ≥140 or ≥90"""),
+        ("weight", """**Weight Relevance:**
 - If BMI or weight data provided, note: >25 BMI = overweight, >30 = obese.
-- Overweight + high glucose = increased insulin resistance risk.
-
-🧠 Reasoning Clues:
-- Low steps + high glucose = prediabetes risk
-- Chest pain + shortness of breath = cardiovascular or pulmonary red flag
-- High LDL + sedentary = long-term heart risk
-- Fatigue + low hydration = stress, electrolyte, or adrenal issue
-- High screen time + low steps + low sleep = burnout risk
+- Overweight + high glucose = increased insulin resistance risk."""),
+    ]
+
+    # The numeric cut-offs of REFERENCE_BLOCKS, for code that classifies measured values (see tracking_summary.py).
+    # A value v falls in labels[i] where edges[i - 1] <= v < edges[i]; keep in sync with the blocks above.
+    REFERENCE_THRESHOLDS = {
+        "steps": {"edges": [5000, 7500, 10000], "labels": ["sedentary", "low active", "somewhat active", "active"],
+                  "out_of_range": ["sedentary"]},
+        "glucose": {"edges": [100, 126], "labels": ["normal", "prediabetes range", "diabetes range"],
+                    "out_of_range": ["prediabetes range", "diabetes range"]},
+        "systolic": {"edges": [120, 130, 140],
+                     "labels": ["normal", "elevated", "hypertension stage 1", "hypertension stage 2"],
+                     "out_of_range": ["elevated", "hypertension stage 1", "hypertension stage 2"]},
+        "diastolic": {"edges": [80, 90], "labels": ["normal", "hypertension stage 1", "hypertension stage 2"],
+                      "out_of_range": ["hypertension stage 1", "hypertension stage 2"]},
+    }
+
+    # Reasoning clues and the signals they are about; a clue is sent if any of its signals is in the input
+    REASONING_CLUES = [
+        (("steps", "glucose"), "Low steps + high glucose = prediabetes risk"),
+        (("chest_pain", "shortness_of_breath"), "Chest pain + shortness of breath = cardiovascular or pulmonary red flag"),
+        (("cholesterol",), "High LDL + sedentary = long-term heart risk"),
+        (("fatigue", "hydration"), "Fatigue + low hydration = stress, electrolyte, or adrenal issue"),
+        (("screen_time", "sleep"), "High screen time + low steps + low sleep = burnout risk"),
+    ]
+
+    USER_DATA_TEMPLATE = """USER HEALTH DATA (STRUCTURED INPUT):
 
----
+{user_input}
 
-Now analyze the following structured user data and generate a clear, patient-directed report using this 4-section format. Make sure every sentence is clinically reasoned and explained clearly using the above data.
+Please interpret this using the clinical format and rules described above. Your output must reflect deep reasoning and must communicate directly with the patient in a medical, yet human-friendly tone. Do not repeat input data; interpret it.
 """
 
-        user_prompt = f"""USER HEALTH DATA (STRUCTURED INPUT):
+    # Replaces the middle of user input that does not fit the context window (see build_prompt_within_budget)
+    TRUNCATION_MARKER = "\n[... {omitted} characters of the input omitted to fit the context window ...]\n"
 
-{user_input}
+    @staticmethod
+    def get_static_prefix():
+        """
+        Returns the leading part of the prompt that does not depend on the user input
+        (system turn plus the opening of the user turn). ModelManager evaluates this once
+        and restores the resulting KV state instead of re-prefilling it on every request.
+        """
+        return f"""<|start_header_id|>system<|end_header_id|>
+
+{PromptTemplates.SYSTEM_PROMPT}<|eot_id|><|start_header_id|>user<|end_header_id|>
 
-Please interpret this using the clinical format and rules described above. Your output must reflect deep reasoning and must communicate directly with the patient in a medical, yet human-friendly tone. Do not repeat input data; interpret it.
 """
 
-        # MODIFIED LINE: Removed the leading "<|begin_of_text|>"
-        full_prompt = f"""<|start_header_id|>system<|end_header_id|>
+    @staticmethod
+    def select_reference_material(user_input):
+        """
+        Returns (reference_keys, clues) relevant to user_input, using the deterministic pre-parser.
+        If no known metric or signal is found, everything is returned rather than nothing.
+        """
+        signals = detect_health_signals(user_input)
+        if not signals:
+            return [key for key, _ in PromptTemplates.REFERENCE_BLOCKS], [clue for _, clue in PromptTemplates.REASONING_CLUES]
+        reference_keys = [key for key, _ in PromptTemplates.REFERENCE_BLOCKS if key in signals]
+        clues = [clue for clue_signals, clue in PromptTemplates.REASONING_CLUES if signals.intersection(clue_signals)]
+        return reference_keys, clues
 
-{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>
+    @staticmethod
+    def _reference_section(reference_keys, clues):
+        parts = []
+        if reference_keys:
+            blocks = [block for key, block in PromptTemplates.REFERENCE_BLOCKS if key in reference_keys]
+            parts.append("📚 Clinical Reference Ranges and Interpretation Guide (For Reasoning):\n\n" + "\n\n".join(blocks))
+        if clues:
+            parts.append("🧠 Reasoning Clues:\n" + "\n".join(f"- {clue}" for clue in clues))
+        if not parts:
+            return ""
+        return "\n\n".join(parts) + "\n\n---\n\n"
 
-{user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    @staticmethod
+    def create_health_advisor_prompt(user_input, reference_keys=None, clues=None):
+        """
+        Returns a prompt to instruct an LLM to behave like a clinical AI Health Advisor.
+        Generates a structured 7-part health report using the user’s structured health data.
+        Designed to work with small LLMs by being ultra-explicit and data-driven.
+        Only the reference ranges and clues relevant to user_input are included unless
+        reference_keys / clues are given explicitly (empty lists leave them out).
+        """
+        if reference_keys is None or clues is None:
+            selected_keys, selected_clues = PromptTemplates.select_reference_material(user_input)
+            reference_keys = selected_keys if reference_keys is None else reference_keys
+            clues = selected_clues if clues is None else clues
+
+        user_prompt = PromptTemplates._reference_section(reference_keys, clues) + PromptTemplates.USER_DATA_TEMPLATE.format(user_input=user_input)
+
+        # MODIFIED LINE: Removed the leading "<|begin_of_text|>"
+        # The static prefix must stay a verbatim prefix of full_prompt for the KV state reuse to hit,
+        # which is why the input-dependent reference material lives in the user turn.
+        full_prompt = PromptTemplates.get_static_prefix() + f"""{user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
 """
 
         return full_prompt
 
+    @staticmethod
+    def create_follow_up_turn(question):
+        """
+        Returns the text that continues a conversation after the assistant's last answer: it closes that answer,
+        adds the user's question and opens the next assistant turn, in the same Llama 3 chat format as
+        create_health_advisor_prompt. Appended to the session's tokens, so only this part needs a prefill.
+        """
+        return f"""<|eot_id|><|start_header_id|>user<|end_header_id|>
+
+{question.strip()}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+"""
+
+    @staticmethod
+    def get_template_signature():
+        """Text that changes whenever any part of the prompt template changes (used for cache fingerprints)."""
+        return PromptTemplates.create_health_advisor_prompt(
+            "",
+            reference_keys=[key for key, _ in PromptTemplates.REFERENCE_BLOCKS],
+            clues=[clue for _, clue in PromptTemplates.REASONING_CLUES],
+        ) + PromptTemplates.TRUNCATION_MARKER
+
+    @staticmethod
+    def build_prompt_within_budget(user_input, count_tokens, n_ctx, max_tokens, safety_margin_tokens=32):
+        """
+        Builds the prompt so that prompt tokens + max_tokens fit in n_ctx. `count_tokens` is the model's
+        tokenizer (text -> number of tokens). Truncation policy, applied only as far as needed:
+        1. drop the reasoning clues
+        2. drop the reference ranges
+        3. cut the middle of the user input (keeping its start and end) and mark the cut
+        max_tokens is never reduced, so the report itself is not cut short.
+        Returns (prompt, budget_report). Raises ValueError if even the bare template does not fit.
+        """
+        budget = n_ctx - max_tokens - safety_margin_tokens
+        reference_keys, clues = PromptTemplates.select_reference_material(user_input)
+        report = {
+            "budget_tokens": budget,
+            "reference_blocks": list(reference_keys),
+            "reasoning_clues": len(clues),
+            "dropped": [],
+            "truncated_characters": 0,
+        }
+
+        prompt = PromptTemplates.create_health_advisor_prompt(user_input, reference_keys, clues)
+        prompt_tokens = count_tokens(prompt)
+        if prompt_tokens > budget and clues:
+            clues = []
+            report["reasoning_clues"] = 0
+            report["dropped"].append("reasoning_clues")
+            prompt = PromptTemplates.create_health_advisor_prompt(user_input, reference_keys, clues)
+            prompt_tokens = count_tokens(prompt)
+        if prompt_tokens > budget and reference_keys:
+            reference_keys = []
+            report["reference_blocks"] = []
+            report["dropped"].append("reference_blocks")
+            prompt = PromptTemplates.create_health_advisor_prompt(user_input, reference_keys, clues)
+            prompt_tokens = count_tokens(prompt)
+
+        if prompt_tokens > budget:
+            template_tokens = count_tokens(PromptTemplates.create_health_advisor_prompt("", reference_keys, clues))
+            if template_tokens >= budget:
+                raise ValueError(
+                    f"The prompt template alone needs {template_tokens} tokens, more than the {budget} available "
+                    f"(n_ctx={n_ctx}, max_tokens={max_tokens}). Raise n_ctx or lower max_tokens."
+                )
+            # Largest middle cut that fits: binary search on the number of characters kept
+            low, high = 0, len(user_input)
+            best_prompt, best_tokens, best_kept = None, None, 0
+            while low <= high:
+                kept = (low + high) // 2
+                candidate = PromptTemplates.create_health_advisor_prompt(
+                    PromptTemplates._truncate_middle(user_input, kept), reference_keys, clues
+                )
+                candidate_tokens = count_tokens(candidate)
+                if candidate_tokens <= budget:
+                    best_prompt, best_tokens, best_kept = candidate, candidate_tokens, kept
+                    low = kept + 1
+                else:
+                    high = kept - 1
+            if best_prompt is None:
+                raise ValueError(f"Could not fit the user input into {budget} prompt tokens.")
+            prompt, prompt_tokens = best_prompt, best_tokens
+            report["truncated_characters"] = len(user_input) - best_kept
+
+        report["prompt_tokens"] = prompt_tokens
+        return prompt, report
+
+    @staticmethod
+    def _truncate_middle(text, kept_characters):
+        """Keeps the first and last kept_characters / 2 characters of text, with a marker in between."""
+        if kept_characters >= len(text):
+            return text
+        head = kept_characters - kept_characters // 2
+        tail = kept_characters // 2
+        marker = PromptTemplates.TRUNCATION_MARKER.format(omitted=len(text) - kept_characters)
+        return text[:head] + marker + (text[len(text) - tail:] if tail else "")
+
     @staticmethod
     def format_user_input(user_input):
         """Returns raw user input as-is for single input field."""
@@ -0,0 +1,271 @@
+# response_cache.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_user_input(user_input):
+    """Canonical form used for cache keys: NFC, unified line endings, no trailing spaces, collapsed blanks."""
+    text = unicodedata.normalize("NFC", user_input).replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    text = re.sub(r"\n{2,}", "\n\n", text)
+    return text.strip()
+
+
+def generation_fingerprint(prompt_template, model_config, model_path):
+    """Hash of everything besides the user input that determines the output."""
+    hasher = hashlib.sha256()
+    hasher.update(prompt_template.encode("utf-8"))
+    hasher.update(json.dumps(model_config, sort_keys=True, default=str).encode("utf-8"))
+    hasher.update(os.path.basename(model_path).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier cache for generated reports:
+    - memory: LRU with TTL, bounded by entry count and total bytes
+    - disk: SQLite, survives restarts; memory misses fall through to it and promote the entry
+    get_or_compute() also coalesces concurrent identical requests so only one generation runs.
+    """
+
+    def __init__(self, sqlite_path=None, memory_max_entries=512, memory_max_bytes=32 * 1024 * 1024,
+                 ttl_seconds=24 * 3600, sqlite_max_entries=100000):
+        self.memory_max_entries = memory_max_entries
+        self.memory_max_bytes = memory_max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_max_entries = sqlite_max_entries
+        self._memory = OrderedDict() # key -> (value, expires_at, size_bytes)
+        self._memory_bytes = 0
+        self._lock = threading.Lock() # Memory tier and counters
+        self._db_lock = threading.Lock() # SQLite connection; never held together with _lock
+        self._in_flight = {} # key -> asyncio.Future of the running generation
+        self.stats_counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "coalesced": 0,
+            "misses": 0,
+            "bytes_saved": 0,
+            "evictions": 0,
+        }
+
+        self._db = None
+        self._puts_since_trim = 0
+        if sqlite_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+                self._db = sqlite3.connect(sqlite_path, check_same_thread=False, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses(created_at)")
+                self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+                logger.info(f"Response cache: SQLite tier at {sqlite_path}")
+            except sqlite3.Error as e:
+                logger.error(f"Response cache: could not open SQLite tier at {sqlite_path}, using memory only: {str(e)}")
+                self._db = None
+
+    @staticmethod
+    def make_key(user_input, fingerprint):
+        return hashlib.sha256(f"{fingerprint}\n{normalize_user_input(user_input)}".encode("utf-8")).hexdigest()
+
+    # --- Memory tier ---
+
+    def _memory_get(self, key, now):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        value, expires_at, size_bytes = entry
+        if expires_at <= now:
+            self._memory_remove(key)
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_put(self, key, value, expires_at):
+        size_bytes = len(value.encode("utf-8"))
+        if size_bytes > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._memory_remove(key)
+        self._memory[key] = (value, expires_at, size_bytes)
+        self._memory_bytes += size_bytes
+        while len(self._memory) > self.memory_max_entries or self._memory_bytes > self.memory_max_bytes:
+            oldest_key = next(iter(self._memory))
+            self._memory_remove(oldest_key)
+            self.stats_counters["evictions"] += 1
+
+    def _memory_remove(self, key):
+        _, _, size_bytes = self._memory.pop(key)
+        self._memory_bytes -= size_bytes
+
+    # --- Public API ---
+
+    def get(self, key):
+        """Returns the cached value or None. Counts hits but not misses (see get_or_compute)."""
+        value = self._memory_lookup(key)
+        if value is not None or self._db is None:
+            return value
+        return self._disk_lookup(key)
+
+    async def get_async(self, key):
+        """Same as get, but the SQLite tier is read in a worker thread so a slow disk does not stall the event loop."""
+        value = self._memory_lookup(key)
+        if value is not None or self._db is None:
+            return value
+        return await asyncio.to_thread(self._disk_lookup, key)
+
+    def put(self, key, value):
+        expires_at = self._memory_store(key, value)
+        self._disk_store(key, value, expires_at)
+
+    async def put_async(self, key, value):
+        """Same as put; the entry is in the memory tier on return, the SQLite write runs in a worker thread."""
+        expires_at = self._memory_store(key, value)
+        await asyncio.to_thread(self._disk_store, key, value, expires_at)
+
+    def _memory_lookup(self, key):
+        with self._lock:
+            value = self._memory_get(key, time.time())
+            if value is not None:
+                self.stats_counters["memory_hits"] += 1
+                self.stats_counters["bytes_saved"] += len(value.encode("utf-8"))
+            return value
+
+    def _memory_store(self, key, value):
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._memory_put(key, value, expires_at)
+        return expires_at
+
+    def _disk_lookup(self, key):
+        # Blocking; only _db_lock is held during the query, so memory lookups never wait for the disk
+        with self._db_lock:
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache: SQLite read failed: {str(e)}")
+                return None
+        if row is None:
+            return None
+        value, expires_at = row
+        with self._lock:
+            self._memory_put(key, value, expires_at) # Promote
+            self.stats_counters["disk_hits"] += 1
+            self.stats_counters["bytes_saved"] += len(value.encode("utf-8"))
+        return value
+
+    def _disk_store(self, key, value, expires_at):
+        now = time.time()
+        with self._db_lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, expires_at),
+                )
+                # Keep the disk tier bounded (every 100 writes): drop expired rows, then the oldest beyond the limit
+                self._puts_since_trim += 1
+                if self._puts_since_trim >= 100:
+                    self._puts_since_trim = 0
+                    self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                    self._db.execute(
+                        "DELETE FROM responses WHERE key IN ("
+                        "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                        (self.sqlite_max_entries,),
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache: SQLite write failed: {str(e)}")
+
+    async def get_or_compute(self, key, compute, retry_exceptions=()):
+        """
+        Returns (value, cache_status) where cache_status is "hit", "coalesced" or "miss".
+        `compute` is a coroutine function; it only runs on a miss, and concurrent callers with the same key
+        wait for that one run instead of starting their own. Failures are not cached and reach every waiter,
+        except `retry_exceptions` (problems of the leading request only, e.g. its client disconnected):
+        waiters then try again themselves.
+        """
+        while True:
+            value = await self.get_async(key)
+            if value is not None:
+                return value, "hit"
+
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                break
+            await asyncio.wait([in_flight]) # Unlike awaiting it, this does not cancel us if the leader is cancelled
+            if in_flight.cancelled():
+                continue
+            error = in_flight.exception()
+            if error is not None:
+                if isinstance(error, retry_exceptions):
+                    continue
+                raise error
+            value = in_flight.result()
+            with self._lock:
+                self.stats_counters["coalesced"] += 1
+                self.stats_counters["bytes_saved"] += len(value.encode("utf-8"))
+            return value, "coalesced"
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        with self._lock:
+            self.stats_counters["misses"] += 1
+        try:
+            value = await compute()
+            expires_at = self._memory_store(key, value)
+            future.set_result(value) # Waiters get the value from here; they do not wait for the SQLite write
+            await asyncio.to_thread(self._disk_store, key, value, expires_at)
+            return value, "miss"
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # Mark as retrieved so asyncio does not warn when nobody was waiting
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.stats_counters)
+            hits = counters["memory_hits"] + counters["disk_hits"] + counters["coalesced"]
+            lookups = hits + counters["misses"]
+            counters.update({
+                "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "in_flight": len(self._in_flight),
+            })
+        with self._db_lock:
+            if self._db is not None:
+                try:
+                    counters["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                except sqlite3.Error:
+                    counters["disk_entries"] = None
+        return counters
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,163 @@
+# section_budget.py
+import bisect
+import logging
+import re
+
+import numpy as np
+
+from config import MODEL_CONFIG, STRUCTURED_OUTPUT_CONFIG
+from utils import REPORT_SECTIONS, SECTION_HEADER_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# Structured generation of the 7-part report (STRUCTURED_OUTPUT_CONFIG). SectionBudgetProcessor is a llama.cpp
+# logits processor that follows the report as it is generated:
+# - the report starts directly with "**1. Short-Term Risks**" (no preamble);
+# - each section gets its own token budget; once it is used up the current sentence may finish
+#   (up to sentence_grace_tokens more, as long as the later sections and their headers still fit in max_tokens),
+#   then the next header is forced token by token;
+# - EOS is blocked until section 7 is reached, and forced as soon as section 7 is complete
+#   (its paragraph ended, or its budget is used up), so nothing is generated after it.
+
+SENTENCE_ENDINGS = (b".", b"!", b"?", b"\n")
+HEADER_TOKEN_ALLOWANCE = 16 # Room per section for the forced header in the max_tokens cap
+# SECTION_HEADER_PATTERN on the generated bytes; a header is searched for only in the last HEADER_TAIL_BYTES
+HEADER_BYTES_PATTERN = re.compile(SECTION_HEADER_PATTERN.pattern.encode("utf-8"))
+HEADER_TAIL_BYTES = 256
+
+
+def generation_max_tokens():
+    """
+    max_tokens for a report: MODEL_CONFIG's. In structured mode it is lowered to the sum of the section budgets plus
+    headroom when that is smaller, never raised.
+    """
+    max_tokens = MODEL_CONFIG.get("max_tokens", 400)
+    if not STRUCTURED_OUTPUT_CONFIG.get("enabled", False):
+        return max_tokens
+    budgets = STRUCTURED_OUTPUT_CONFIG.get("section_token_budgets", {})
+    per_section = STRUCTURED_OUTPUT_CONFIG.get("sentence_grace_tokens", 24) + HEADER_TOKEN_ALLOWANCE
+    return min(max_tokens,
+               sum(budgets.get(number, 0) for number, _, _ in REPORT_SECTIONS) + len(REPORT_SECTIONS) * per_section)
+
+
+def _header_text(number, title):
+    return f"**{number}. {title}**" if number == 1 else f"\n\n**{number}. {title}**"
+
+
+class SectionBudgetProcessor:
+    """
+    Logits processor for Llama.__call__(logits_processor=...) and SpeculativeDecoder.generate.
+    It is called with all token ids so far (prompt + generated) and derives the section state from them, so one
+    instance serves one generation; the state is updated incrementally (each call detokenizes only the new tokens
+    and looks for a header in the tail of the text).
+    """
+
+    def __init__(self, llama, section_token_budgets=None, sentence_grace_tokens=None, min_section_tokens=None,
+                 max_tokens=None):
+        self.llama = llama
+        self.max_tokens = max_tokens if max_tokens is not None else generation_max_tokens()
+        self.budgets = section_token_budgets or STRUCTURED_OUTPUT_CONFIG.get("section_token_budgets", {})
+        self.sentence_grace_tokens = (sentence_grace_tokens if sentence_grace_tokens is not None
+                                      else STRUCTURED_OUTPUT_CONFIG.get("sentence_grace_tokens", 24))
+        self.min_section_tokens = (min_section_tokens if min_section_tokens is not None
+                                   else STRUCTURED_OUTPUT_CONFIG.get("min_section_tokens", 8))
+        self.eos_token = llama.token_eos()
+        self.header_tokens = {
+            number: llama.tokenize(_header_text(number, title).encode("utf-8"), add_bos=False)
+            for number, title, _ in REPORT_SECTIONS
+        }
+        # Tokens the sections after each one need at least: their budgets plus their headers
+        self.reserved_after = {
+            number: sum(self.budgets.get(later, 0) + len(self.header_tokens[later])
+                        for later, _, _ in REPORT_SECTIONS if later > number)
+            for number, _, _ in REPORT_SECTIONS
+        }
+        self.n_prompt_tokens = None # Set on the first call, which samples the first generated token
+        self._tokens = [] # Generated tokens seen so far
+        self._offsets = [] # Byte offset in self._text where each generated token's piece starts
+        self._text = bytearray()
+        # Headers found so far: (section number, byte offset where its content starts, index of its first token)
+        self._headers = []
+        self.forced_headers = 0 # Headers this processor had to start (for the log)
+
+    def _sync(self, input_ids):
+        if self.n_prompt_tokens is None:
+            self.n_prompt_tokens = len(input_ids)
+        # Keep what input_ids still agrees with; only rejected speculative drafts are ever taken back
+        n_kept = min(len(self._tokens), len(input_ids) - self.n_prompt_tokens)
+        while n_kept > 0 and int(input_ids[self.n_prompt_tokens + n_kept - 1]) != self._tokens[n_kept - 1]:
+            n_kept -= 1
+        if n_kept < len(self._tokens):
+            del self._text[self._offsets[n_kept]:]
+            del self._tokens[n_kept:], self._offsets[n_kept:]
+            while self._headers and self._headers[-1][1] > len(self._text):
+                self._headers.pop()
+        new_tokens = [int(token) for token in input_ids[self.n_prompt_tokens + n_kept:]]
+        if not new_tokens:
+            return
+        content_start = self._headers[-1][1] if self._headers else 0
+        scan_from = max(content_start, len(self._text) - HEADER_TAIL_BYTES)
+        for token in new_tokens:
+            self._offsets.append(len(self._text))
+            self._tokens.append(token)
+            self._text.extend(self.llama.detokenize([token]))
+        # A new header ends in the new bytes and starts at most HEADER_TAIL_BYTES before them
+        for match in HEADER_BYTES_PATTERN.finditer(self._text, scan_from):
+            self._headers.append((int(match.group(1)), match.end(), bisect.bisect_left(self._offsets, match.end())))
+
+    def _section_state(self):
+        """(current section number or 0, tokens written since its header ended, its content as bytes)."""
+        if not self._headers:
+            return 0, len(self._tokens), bytes(self._text)
+        section, content_start, first_token = self._headers[-1]
+        return section, len(self._tokens) - first_token, bytes(self._text[content_start:])
+
+    def _pending_header(self, number):
+        """Tokens of header `number` still to force if the generated text already ends in a part of it, else None."""
+        header = self.header_tokens[number]
+        for k in range(min(len(header) - 1, len(self._tokens)), 0, -1):
+            if self._tokens[-k:] == header[:k]:
+                return header[k:]
+        return None
+
+    @staticmethod
+    def _force(scores, token):
+        forced = np.full_like(scores, -np.inf)
+        forced[token] = 0.0 # The only finite logit, so every sampler setting picks it
+        return forced
+
+    def __call__(self, input_ids, scores):
+        self._sync(input_ids)
+        section, content_tokens, content = self._section_state()
+        if section == 0:
+            # Nothing useful before the first header; force it from the first token on
+            pending = self._pending_header(1) if self._tokens else self.header_tokens[1]
+            if pending is not None:
+                return self._force(scores, pending[0])
+            return scores
+
+        stripped = content.rstrip(b" ")
+        inside_bold = content.count(b"**") % 2 == 1 # E.g. a header the model started itself; let it finish
+        at_sentence_end = stripped.strip() != b"" and stripped.endswith(SENTENCE_ENDINGS) and not inside_bold
+        over_budget = content_tokens >= self.budgets.get(section, 10 ** 9)
+        # The grace ends early when the later sections would no longer fit in max_tokens
+        out_of_room = len(self._tokens) + self.reserved_after.get(section, 0) >= self.max_tokens
+        must_move_on = over_budget and (at_sentence_end or out_of_room
+                                        or content_tokens >= self.budgets[section] + self.sentence_grace_tokens)
+
+        if section >= len(REPORT_SECTIONS):
+            paragraph_done = content_tokens >= self.min_section_tokens and b"\n" in content.strip()
+            if must_move_on or paragraph_done:
+                return self._force(scores, self.eos_token)
+            return scores
+
+        pending = self._pending_header(section + 1)
+        if pending is not None and over_budget:
+            return self._force(scores, pending[0])
+        if must_move_on:
+            self.forced_headers += 1
+            return self._force(scores, self.header_tokens[section + 1][0])
+        # The report is not finished before section 7
+        scores = scores.copy()
+        scores[self.eos_token] = -np.inf
+        return scores
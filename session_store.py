@@ -0,0 +1,248 @@
+# session_store.py
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import SESSION_EVICTIONS, SESSION_STATE_SIZE_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+def _pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True # Exists, but belongs to someone else
+    return True
+
+
+class SessionStore:
+    """
+    Conversations that can be continued with follow-up questions (see ModelManager.generate_followup).
+    A session keeps its text (prompt, report and the turns so far), the tokens in its KV state and the llama.cpp
+    state itself. The states are bounded in two tiers:
+    - memory: up to memory_max_bytes; over it the least recently used states are spilled to disk_dir
+    - disk: up to disk_max_bytes; over it the least recently used states are dropped. Their sessions keep the text
+      and re-prefill it on the next follow-up, so evictions cost time, never the conversation.
+    Sessions expire ttl_seconds after their last use, and at most max_sessions are kept (LRU).
+    All methods are thread safe; the ones that may touch the disk should not run on the event loop.
+    """
+
+    def __init__(self, max_sessions=1000, ttl_seconds=1800, memory_max_bytes=512 * 1024 * 1024,
+                 disk_dir=None, disk_max_bytes=4 * 1024 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._sessions = OrderedDict() # session_id -> entry, least recently used first
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.stats_counters = {
+            "created": 0,
+            "follow_ups": 0,
+            "spilled": 0, # State moved from memory to disk
+            "dropped": 0, # State removed, the session continues from its text
+            "removed": 0, # Whole session removed (max_sessions)
+            "expired": 0,
+        }
+
+        # Spilled states only make sense to the process that holds the index, so every store gets its own
+        # directory; directories of processes that are gone are leftovers and removed.
+        self._spill_dir = None
+        if disk_dir:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+                for stale_dir in glob.glob(os.path.join(disk_dir, "sessions-*-*")):
+                    pid = os.path.basename(stale_dir).split("-")[1]
+                    if pid.isdigit() and not _pid_is_running(int(pid)):
+                        shutil.rmtree(stale_dir, ignore_errors=True)
+                self._spill_dir = tempfile.mkdtemp(prefix=f"sessions-{os.getpid()}-", dir=disk_dir)
+                logger.info(f"Session store: spilling llama.cpp states to {self._spill_dir}")
+            except OSError as e:
+                logger.error(f"Session store: could not create spill directory in {disk_dir}, memory only: {str(e)}")
+                self._spill_dir = None
+
+    # --- State tiers ---
+
+    def _state_path(self, session_id):
+        return os.path.join(self._spill_dir, f"{session_id}.state")
+
+    def _set_state(self, session_id, entry, llama_state):
+        self._discard_state(session_id, entry)
+        if llama_state is None:
+            return
+        entry["state"] = llama_state
+        entry["state_tier"] = "memory"
+        entry["state_bytes"] = len(llama_state)
+        self._memory_bytes += entry["state_bytes"]
+        SESSION_STATE_SIZE_BYTES.observe(entry["state_bytes"])
+
+    def _discard_state(self, session_id, entry):
+        if entry["state_tier"] == "memory":
+            self._memory_bytes -= entry["state_bytes"]
+        elif entry["state_tier"] == "disk":
+            self._disk_bytes -= entry["state_bytes"]
+            try:
+                os.remove(self._state_path(session_id))
+            except OSError:
+                pass
+        entry.update(state=None, state_tier=None, state_bytes=0)
+
+    def _read_state(self, session_id, entry):
+        if entry["state_tier"] == "memory":
+            return entry["state"]
+        if entry["state_tier"] == "disk":
+            try:
+                with open(self._state_path(session_id), "rb") as f:
+                    return f.read()
+            except OSError as e:
+                logger.warning(f"Session store: could not read spilled state of {session_id}: {str(e)}")
+                self._discard_state(session_id, entry)
+        return None
+
+    def _spill(self, session_id, entry):
+        """Moves a memory state to disk, making room there first; drops it if it cannot be written."""
+        llama_state, size_bytes = entry["state"], entry["state_bytes"]
+        self._discard_state(session_id, entry)
+        if self._spill_dir is None or size_bytes > self.disk_max_bytes:
+            self._count_eviction("dropped")
+            return
+        for other_id, other in list(self._sessions.items()):
+            if self._disk_bytes + size_bytes <= self.disk_max_bytes:
+                break
+            if other["state_tier"] == "disk":
+                self._discard_state(other_id, other)
+                self._count_eviction("dropped")
+        try:
+            tmp_path = f"{self._state_path(session_id)}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(llama_state)
+            os.replace(tmp_path, self._state_path(session_id))
+        except OSError as e:
+            logger.warning(f"Session store: could not spill state of {session_id}, dropping it: {str(e)}")
+            self._count_eviction("dropped")
+            return
+        entry.update(state_tier="disk", state_bytes=size_bytes)
+        self._disk_bytes += size_bytes
+        self._count_eviction("spilled")
+
+    def _count_eviction(self, reason):
+        self.stats_counters[reason] += 1
+        SESSION_EVICTIONS.inc(reason=reason)
+
+    def _remove(self, session_id, reason):
+        entry = self._sessions.pop(session_id)
+        self._discard_state(session_id, entry)
+        self._count_eviction(reason)
+
+    def _enforce_limits(self, now):
+        # Every use moves a session to the end with the same TTL, so the expired ones are at the front
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest["expires_at"] > now:
+                break
+            self._remove(oldest_id, "expired")
+        while len(self._sessions) > self.max_sessions:
+            self._remove(next(iter(self._sessions)), "removed")
+        if self._memory_bytes > self.memory_max_bytes:
+            for session_id, entry in list(self._sessions.items()):
+                if self._memory_bytes <= self.memory_max_bytes:
+                    break
+                if entry["state_tier"] == "memory":
+                    self._spill(session_id, entry)
+
+    # --- Public API ---
+
+    def create(self, session_state):
+        """
+        Stores a new session from ModelManager's session state dict {"text", "tokens", "llama_state", "fingerprint"}
+        (tokens / llama_state may be None, e.g. for a report served from the response cache). Returns its id.
+        """
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            entry = {"turns": 0, "created_at": now, "state": None, "state_tier": None, "state_bytes": 0}
+            self._sessions[session_id] = entry
+            self._apply(session_id, entry, session_state, now)
+            self.stats_counters["created"] += 1
+        return session_id
+
+    def update(self, session_id, session_state):
+        """Replaces the session's state after a follow-up. Returns False if the session is gone meanwhile."""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return False
+            entry["turns"] += 1
+            self._sessions.move_to_end(session_id)
+            self._apply(session_id, entry, session_state, now)
+            self.stats_counters["follow_ups"] += 1
+        return True
+
+    def _apply(self, session_id, entry, session_state, now):
+        entry["text"] = session_state["text"]
+        entry["tokens"] = session_state.get("tokens")
+        entry["fingerprint"] = session_state.get("fingerprint")
+        entry["expires_at"] = now + self.ttl_seconds
+        self._set_state(session_id, entry, session_state.get("llama_state"))
+        self._enforce_limits(now)
+
+    def get(self, session_id):
+        """
+        Returns the session state dict (as passed to create / update, plus "turns" and "state_tier" where the state
+        was found: "memory", "disk" or None) and marks the session as used, or None if it is unknown or expired.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= now:
+                self._remove(session_id, "expired")
+                return None
+            self._sessions.move_to_end(session_id)
+            entry["expires_at"] = now + self.ttl_seconds
+            state_tier = entry["state_tier"]
+            llama_state = self._read_state(session_id, entry)
+            return {
+                "text": entry["text"],
+                "tokens": entry["tokens"] if llama_state is not None else None,
+                "llama_state": llama_state,
+                "fingerprint": entry["fingerprint"],
+                "turns": entry["turns"],
+                "state_tier": state_tier if llama_state is not None else None,
+            }
+
+    def stats(self):
+        with self._lock:
+            self._enforce_limits(time.time())
+            state_sizes = [entry["state_bytes"] for entry in self._sessions.values() if entry["state_tier"]]
+            counters = dict(self.stats_counters)
+            counters.update({
+                "sessions": len(self._sessions),
+                "states_in_memory": sum(1 for entry in self._sessions.values() if entry["state_tier"] == "memory"),
+                "states_on_disk": sum(1 for entry in self._sessions.values() if entry["state_tier"] == "disk"),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+                "average_state_bytes": int(sum(state_sizes) / len(state_sizes)) if state_sizes else 0,
+                "largest_state_bytes": max(state_sizes, default=0),
+            })
+            return counters
+
+    def close(self):
+        with self._lock:
+            self._sessions.clear()
+            self._memory_bytes = self._disk_bytes = 0
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
@@ -0,0 +1,225 @@
+# speculative_decoder.py
+import logging
+import time
+
+import numpy as np
+import llama_cpp
+
+logger = logging.getLogger(__name__)
+
+
+def find_draft(history, ngram_size=3, num_pred_tokens=8):
+    """
+    Prompt-lookup drafting: finds the most recent earlier occurrence of the last n tokens of `history`
+    (n = ngram_size down to 1) and returns the up to num_pred_tokens tokens that followed it. Empty if none.
+    """
+    tokens = np.asarray(history, dtype=np.int64)
+    for n in range(min(ngram_size, len(tokens) - 1), 0, -1):
+        pattern = tokens[-n:]
+        # Candidate start positions of an earlier copy of the pattern (the tail itself excluded)
+        windows = np.lib.stride_tricks.sliding_window_view(tokens[:-1], n)
+        matches = np.flatnonzero((windows == pattern).all(axis=1))
+        if len(matches):
+            start = int(matches[-1]) + n
+            return tokens[start:start + num_pred_tokens].tolist()
+    return []
+
+
+class SpeculativeDecoder:
+    """
+    Prompt-lookup speculative decoding on the main context of a loaded Llama (no draft model).
+
+    Health reports copy a lot from their prompt (lab values, units, phrases from the reference ranges), so the
+    tokens that followed the last n-gram earlier in the prompt / output are a cheap guess for what comes next.
+    Each step feeds the last sampled token plus the draft into one llama_decode() with logits for every position,
+    then samples position by position and keeps drafted tokens only while they equal the sampled token. Every
+    token is sampled by Llama.sample() on the context's own RNG, one call per emitted token, exactly as
+    Llama.__call__ does, so the output is that of plain decoding as long as the batched logits equal the
+    single-token ones (see matches_plain_decoding). A step costs about as much as a single-token decode on CPU
+    because the weights are read once for all its tokens.
+    """
+
+    def __init__(self, llama, ngram_size=3, num_pred_tokens=8):
+        self.llama = llama
+        self.ngram_size = max(1, int(ngram_size))
+        self.num_pred_tokens = max(0, int(num_pred_tokens))
+        self.n_vocab = llama.n_vocab()
+        self.batch = llama_cpp.llama_batch_init(self.num_pred_tokens + 1, 0)
+        self.stats = None # Stats of the last generate() call, see _stats
+        self.last_tokens = None # Tokens generated by the last generate() call
+        logger.info(f"SpeculativeDecoder ready: ngram_size={self.ngram_size}, num_pred_tokens={self.num_pred_tokens}.")
+
+    def close(self):
+        if self.batch is not None:
+            llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+
+    def _decode(self, tokens, n_past):
+        for i, token in enumerate(tokens):
+            self.batch.token[i] = token
+            self.batch.pos[i] = n_past + i
+            self.batch.seq_id[i] = 0
+            self.batch.logits[i] = 1
+        self.batch.n_tokens = len(tokens)
+        return_code = llama_cpp.llama_decode(self.llama.ctx, self.batch)
+        if return_code != 0:
+            raise RuntimeError(f"llama_decode returned {return_code} (context full?)")
+
+    def _load_logits(self, batch_index, n_tokens):
+        """Makes position batch_index of the last decode the current one, as Llama.eval() leaves it for sample()."""
+        pointer = llama_cpp.llama_get_logits_ith(self.llama.ctx, batch_index)
+        self.llama.n_tokens = n_tokens
+        self.llama.scores[n_tokens - 1, :] = np.ctypeslib.as_array(pointer, shape=(self.n_vocab,))
+
+    def _prefill(self, prompt_tokens):
+        """Evaluates the prompt after the longest prefix already in the context (e.g. the restored system prompt)."""
+        llama = self.llama
+        reusable = llama_cpp.Llama.longest_token_prefix(llama.input_ids[:llama.n_tokens].tolist(), prompt_tokens[:-1])
+        llama_cpp.llama_kv_cache_seq_rm(llama.ctx, -1, reusable, -1)
+        llama.n_tokens = reusable
+        llama.eval(prompt_tokens[reusable:]) # Updates n_tokens / input_ids and the last logits row
+        return len(prompt_tokens) - reusable
+
+    def generate(self, prompt, max_tokens=400, temperature=0.1, top_p=0.85, top_k=40, repeat_penalty=1.1,
+                 stop=None, logits_processor=None):
+        """
+        Yields the generated text in pieces (never a partial stop sequence or UTF-8 character).
+        The sampling arguments and logits_processor are those of Llama.__call__. Afterwards self.stats holds the
+        token counts, timings and drafting statistics, self.last_tokens the generated tokens.
+        """
+        llama = self.llama
+        stop_sequences = [s.encode("utf-8") for s in (stop or [])]
+        holdback = max((len(s) for s in stop_sequences), default=1) - 1
+        eos_token = llama.token_eos()
+        sampling = dict(top_k=top_k, top_p=top_p, temp=temperature, repeat_penalty=repeat_penalty,
+                        logits_processor=logits_processor)
+        # Tokenized as in Llama.__call__ and prepare_prefix_cache, so the restored system prompt is a prefix
+        prompt_tokens = llama.tokenize(prompt.encode("utf-8"))
+        max_tokens = min(max_tokens, llama.n_ctx() - len(prompt_tokens))
+        if max_tokens <= 0:
+            raise ValueError(f"Prompt too long ({len(prompt_tokens)} tokens) for the context window.")
+
+        started_at = time.perf_counter()
+        prefilled_tokens = self._prefill(prompt_tokens)
+        prefilled_at = time.perf_counter()
+
+        history = list(prompt_tokens)
+        generated = []
+        emitted_bytes = 0
+        drafted_tokens = accepted_tokens = verify_steps = 0
+        plain_step_seconds = [] # Full loop iterations without a draft: the cost of one token by plain decoding
+        step_started_at = None
+        step_had_draft = True
+        finished = False
+        self.last_tokens = generated
+        pending = llama.sample(**sampling)
+        try:
+            while True:
+                # `pending` is sampled but not in the KV cache yet
+                if pending == eos_token:
+                    break
+                generated.append(pending)
+                history.append(pending)
+                text = llama.detokenize(generated)
+                stop_at = min((text.index(s) for s in stop_sequences if s in text), default=None)
+                if stop_at is not None:
+                    text, finished = text[:stop_at], True
+                if len(generated) >= max_tokens:
+                    finished = True
+                # Emit what can no longer turn into a stop sequence, cut at a UTF-8 character boundary
+                safe_end = len(text) if finished else max(emitted_bytes, len(text) - holdback)
+                while safe_end > emitted_bytes and safe_end < len(text) and (text[safe_end] & 0xC0) == 0x80:
+                    safe_end -= 1
+                if safe_end > emitted_bytes:
+                    yield text[emitted_bytes:safe_end].decode("utf-8", errors="ignore")
+                    emitted_bytes = safe_end
+                if finished:
+                    break
+
+                draft = find_draft(history, self.ngram_size, self.num_pred_tokens) if self.num_pred_tokens else []
+                draft = draft[:max(0, min(max_tokens - len(generated) - 1, llama.n_ctx() - llama.n_tokens - 1))]
+                now = time.perf_counter()
+                if step_started_at is not None and not step_had_draft:
+                    plain_step_seconds.append(now - step_started_at)
+                step_started_at, step_had_draft = now, bool(draft)
+                n_past = llama.n_tokens
+                self._decode([pending] + draft, n_past)
+                llama.input_ids[n_past:n_past + 1 + len(draft)] = [pending] + draft
+                verify_steps += 1
+                drafted_tokens += len(draft)
+
+                # Sample position by position; a drafted token is kept while it equals what was sampled
+                for i in range(len(draft) + 1):
+                    self._load_logits(i, n_past + 1 + i)
+                    token = llama.sample(**sampling)
+                    if i < len(draft) and token == draft[i] and token != eos_token and len(generated) < max_tokens - 1:
+                        accepted_tokens += 1
+                        generated.append(token)
+                        history.append(token)
+                        continue
+                    break
+                # Positions after the last accepted draft token hold rejected guesses
+                llama_cpp.llama_kv_cache_seq_rm(llama.ctx, -1, llama.n_tokens, -1)
+                pending = token
+        finally:
+            finished_at = time.perf_counter()
+            self.stats = self._stats(len(prompt_tokens), prefilled_tokens, len(generated), prefilled_at - started_at,
+                                     finished_at - prefilled_at, drafted_tokens, accepted_tokens, verify_steps,
+                                     plain_step_seconds)
+
+    def matches_plain_decoding(self, prompt, max_tokens=64, seed=42, logits_processor_factory=None, **sampling):
+        """
+        Generates max_tokens tokens of prompt with Llama.generate() (what Llama.__call__ runs) and with generate(),
+        both from the same RNG seed, and compares them. Returns (True, None) if the tokens are identical, else
+        (False, index of the first difference). logits_processor_factory makes a fresh processor for each run.
+        Reseeds the context's RNG.
+        """
+        llama = self.llama
+        eos_token = llama.token_eos()
+        new_processor = logits_processor_factory or (lambda: None)
+        llama_cpp.llama_set_rng_seed(llama.ctx, seed)
+        plain_tokens = []
+        tokens = llama.generate(
+            llama.tokenize(prompt.encode("utf-8")),
+            top_k=sampling.get("top_k", 40), top_p=sampling.get("top_p", 0.85),
+            temp=sampling.get("temperature", 0.1), repeat_penalty=sampling.get("repeat_penalty", 1.1),
+            logits_processor=new_processor(),
+        )
+        for token in tokens:
+            if token == eos_token or len(plain_tokens) >= max_tokens:
+                break
+            plain_tokens.append(token)
+        tokens.close()
+
+        llama_cpp.llama_set_rng_seed(llama.ctx, seed)
+        for _ in self.generate(prompt, max_tokens=max_tokens, logits_processor=new_processor(), **sampling):
+            pass
+        speculative_tokens = self.last_tokens
+        if plain_tokens == speculative_tokens:
+            return True, None
+        mismatch = next((i for i, (a, b) in enumerate(zip(plain_tokens, speculative_tokens)) if a != b),
+                        min(len(plain_tokens), len(speculative_tokens)))
+        return False, mismatch
+
+    @staticmethod
+    def _stats(prompt_tokens, prefilled_tokens, completion_tokens, prefill_seconds, decode_seconds,
+               drafted_tokens, accepted_tokens, verify_steps, plain_step_seconds):
+        # Speedup estimate: tokens per second achieved vs. the measured cost of iterations that had no draft
+        speedup = None
+        if plain_step_seconds and decode_seconds > 0 and completion_tokens:
+            speedup = round(completion_tokens / decode_seconds * float(np.median(plain_step_seconds)), 2)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "prefilled_tokens": prefilled_tokens,
+            "prefill_seconds": prefill_seconds,
+            "decode_seconds": decode_seconds,
+            "speculative": {
+                "drafted_tokens": drafted_tokens,
+                "accepted_tokens": accepted_tokens,
+                "acceptance_rate": round(accepted_tokens / drafted_tokens, 3) if drafted_tokens else None,
+                "verify_steps": verify_steps,
+                "tokens_per_step": round(completion_tokens / verify_steps, 2) if verify_steps else None,
+                "decode_speedup": speedup,
+            },
+        }
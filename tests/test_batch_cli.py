@@ -0,0 +1,138 @@
+# tests/test_batch_cli.py
+import json
+
+import pytest
+
+from batch_cli import Checkpoint, count_lines, iter_input_lines, recover_output
+
+
+def write_input(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def result_line(index, error=None):
+    return (json.dumps({"index": index, "id": f"r{index}", "recommendations": None if error else "...", "error": error})
+            + "\n").encode("utf-8")
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    path = tmp_path / "cohort.jsonl"
+    write_input(path, [{"id": f"r{i}", "user_input": "x" * (i + 1)} for i in range(6)])
+    return str(path)
+
+
+def register_all(checkpoint, input_path):
+    lines = list(iter_input_lines(input_path))
+    for index, end_offset, _ in lines:
+        checkpoint.register(index, end_offset)
+    return lines
+
+
+def test_watermark_advances_over_contiguous_finished_records(tmp_path, input_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), input_path)
+    lines = register_all(checkpoint, input_path)
+
+    for index in (1, 2, 4): # Out of order: 0 is still in flight
+        checkpoint.mark_done(index)
+    assert (checkpoint.watermark, checkpoint.done_above) == (0, {1, 2, 4})
+    checkpoint.mark_done(0)
+    assert (checkpoint.watermark, checkpoint.done_above) == (3, {4})
+    assert checkpoint.watermark_offset == lines[2][1] # Where record 3 starts
+    assert [checkpoint.is_done(index) for index in range(6)] == [True, True, True, False, True, False]
+
+
+def test_watermark_waits_for_the_input_offset(tmp_path, input_path):
+    # A result can arrive before its line was registered (e.g. recovered from the output): no offset, no advance
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), input_path)
+    checkpoint.mark_done(0)
+    assert checkpoint.watermark == 0
+    checkpoint.register(0, 10)
+    assert (checkpoint.watermark, checkpoint.watermark_offset) == (1, 10)
+
+
+def test_resume_seeks_to_the_watermark(tmp_path, input_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path, input_path)
+    register_all(checkpoint, input_path)
+    for index in (0, 1, 3):
+        checkpoint.mark_done(index)
+    checkpoint.counters["succeeded"] = 3
+    checkpoint.save(output_offset=123)
+
+    resumed = Checkpoint(path, input_path)
+    assert resumed.load()
+    assert (resumed.watermark, resumed.done_above, resumed.output_offset) == (2, {3}, 123)
+    assert resumed.counters == {"succeeded": 3, "failed": 0}
+    remaining = [index for index, _, _ in iter_input_lines(input_path, resumed.watermark_offset, resumed.watermark)
+                 if not resumed.is_done(index)]
+    assert remaining == [2, 4, 5]
+    first_line = next(iter_input_lines(input_path, resumed.watermark_offset, resumed.watermark))[2]
+    assert json.loads(first_line)["id"] == "r2"
+
+
+def test_load_rejects_a_checkpoint_of_another_input(tmp_path, input_path):
+    path = str(tmp_path / "checkpoint.json")
+    Checkpoint(path, input_path).save(0)
+    other_input = tmp_path / "other.jsonl"
+    write_input(other_input, [])
+    with pytest.raises(ValueError, match="belongs to"):
+        Checkpoint(path, str(other_input)).load()
+    assert Checkpoint(str(tmp_path / "missing.json"), input_path).load() is False
+
+
+def test_recover_output_counts_results_after_the_checkpoint_and_cuts_a_torn_line(tmp_path, input_path):
+    output_path = tmp_path / "reports.jsonl"
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), input_path)
+    register_all(checkpoint, input_path)
+    checkpoint.mark_done(0)
+    checkpoint.counters["succeeded"] = 1
+    covered = result_line(0)
+    checkpoint.save(len(covered))
+
+    # After the checkpoint: results 2 and 1 were written, then the process died halfway through result 3
+    after = result_line(2) + result_line(1, error="invalid input")
+    output_path.write_bytes(covered + after + result_line(3)[:20])
+
+    resumed = Checkpoint(checkpoint.path, input_path)
+    resumed.load()
+    register_all(resumed, input_path)
+    output_offset = recover_output(str(output_path), resumed)
+
+    assert output_offset == len(covered) + len(after)
+    assert output_path.read_bytes() == covered + after
+    assert resumed.counters == {"succeeded": 2, "failed": 1}
+    assert resumed.watermark == 3
+    assert [resumed.is_done(index) for index in range(6)] == [True, True, True, False, False, False]
+
+
+def test_recover_output_does_not_count_a_result_twice(tmp_path, input_path):
+    output_path = tmp_path / "reports.jsonl"
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), input_path)
+    register_all(checkpoint, input_path)
+    checkpoint.mark_done(0)
+    checkpoint.counters["succeeded"] = 1
+    # Crash after the result of 0 was written but before the checkpoint covered it
+    output_path.write_bytes(result_line(0))
+    assert recover_output(str(output_path), checkpoint) == len(result_line(0))
+    assert checkpoint.counters == {"succeeded": 1, "failed": 0}
+
+
+def test_recover_output_rejects_a_shorter_or_missing_output(tmp_path, input_path):
+    output_path = tmp_path / "reports.jsonl"
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), input_path)
+    assert recover_output(str(output_path), checkpoint) == 0 # Fresh run
+    checkpoint.output_offset = 100
+    with pytest.raises(ValueError, match="gone"):
+        recover_output(str(output_path), checkpoint)
+    output_path.write_bytes(result_line(0))
+    with pytest.raises(ValueError, match="shorter"):
+        recover_output(str(output_path), checkpoint)
+
+
+def test_count_lines_counts_a_last_line_without_newline(tmp_path):
+    path = tmp_path / "cohort.jsonl"
+    path.write_bytes(b'{"user_input": "a"}\n{"user_input": "b"}')
+    assert count_lines(str(path)) == 2
@@ -0,0 +1,109 @@
+# tests/test_job_queue.py
+import pytest
+
+from job_queue import IdempotencyConflictError, JobQueue, JobQueueFullError
+
+
+@pytest.fixture
+def queue():
+    job_queue = JobQueue()
+    yield job_queue
+    job_queue.close()
+
+
+def test_claims_highest_priority_then_oldest(queue):
+    low, _ = queue.submit("low 1", priority=0)
+    high_1, _ = queue.submit("high 1", priority=5)
+    high_2, _ = queue.submit("high 2", priority=5)
+    medium, _ = queue.submit("medium", priority=1)
+
+    assert queue.get(high_2["id"])["queue_position"] == 1
+    assert queue.get(low["id"])["queue_position"] == 3
+    claimed = [queue.claim_next()["id"] for _ in range(4)]
+    assert claimed == [high_1["id"], high_2["id"], medium["id"], low["id"]]
+    assert queue.claim_next() is None
+
+
+def test_idempotency_key_returns_the_existing_job(queue):
+    job, created = queue.submit("Age 45, glucose 130", idempotency_key="abc")
+    # Same input up to whitespace: the first job, not a second one
+    again, created_again = queue.submit("  Age 45,   glucose 130\r\n", idempotency_key="abc")
+    assert created and not created_again
+    assert again["id"] == job["id"]
+    assert queue.stats()["queued"] == 1
+
+
+def test_idempotency_key_with_a_different_input_conflicts(queue):
+    queue.submit("Age 45, glucose 130", idempotency_key="abc")
+    with pytest.raises(IdempotencyConflictError):
+        queue.submit("Age 52, glucose 98", idempotency_key="abc")
+    with pytest.raises(IdempotencyConflictError):
+        queue.submit("Age 45, glucose 130", idempotency_key="abc", callback_url="https://example.com/hook")
+
+
+def test_idempotency_key_still_known_after_the_job_finished(queue):
+    job, _ = queue.submit("Age 45", idempotency_key="abc")
+    queue.claim_next()
+    queue.complete(job["id"], {"recommendations": "..."})
+    again, created = queue.submit("Age 45", idempotency_key="abc")
+    assert not created
+    assert again["status"] == "succeeded"
+    assert again["result"] == {"recommendations": "..."}
+
+
+def test_full_queue_rejects_new_jobs():
+    queue = JobQueue(max_queued_jobs=2)
+    queue.submit("one")
+    queue.submit("two")
+    with pytest.raises(JobQueueFullError) as error:
+        queue.submit("three")
+    assert error.value.queued_jobs == 2
+    queue.claim_next() # A running job no longer counts against the limit
+    queue.submit("three")
+    queue.close()
+
+
+def test_running_jobs_are_requeued_after_a_restart(tmp_path):
+    sqlite_path = str(tmp_path / "jobs.sqlite3")
+    queue = JobQueue(sqlite_path, max_attempts=2)
+    job, _ = queue.submit("Age 45", priority=3)
+    queue.submit("Age 60")
+    assert queue.claim_next()["id"] == job["id"]
+    queue.close() # The process stops while the job runs
+
+    queue = JobQueue(sqlite_path, max_attempts=2)
+    requeued = queue.get(job["id"])
+    assert requeued["status"] == "queued"
+    assert requeued["attempts"] == 1
+    assert requeued["started_at"] is None
+    assert queue.claim_next()["id"] == job["id"] # Keeps its priority
+    queue.close()
+
+    # Second interruption: max_attempts reached, the job fails instead of running a third time
+    queue = JobQueue(sqlite_path, max_attempts=2)
+    failed = queue.get(job["id"])
+    assert failed["status"] == "failed"
+    assert "restart" in failed["error"]
+    assert queue.stats()["queued"] == 1
+    queue.close()
+
+
+def test_release_and_retry(queue):
+    job, _ = queue.submit("Age 45")
+    queue.claim_next()
+    queue.release(job["id"]) # The model was busy: the attempt does not count
+    assert queue.get(job["id"])["attempts"] == 0
+
+    queue.claim_next()
+    assert queue.fail(job["id"], "timeout", retry=True) == "queued"
+    queue.claim_next()
+    assert queue.fail(job["id"], "timeout", retry=True) == "failed" # max_attempts=2 used up
+    assert queue.get(job["id"])["error"] == "timeout"
+
+
+def test_queued_jobs_expire_at_their_ttl():
+    queue = JobQueue(job_ttl_seconds=0)
+    job, _ = queue.submit("Age 45")
+    assert queue.claim_next() is None
+    assert queue.get(job["id"])["status"] == "expired"
+    queue.close()
@@ -0,0 +1,126 @@
+# tests/test_response_cache.py
+import asyncio
+
+import pytest
+
+from inference_queue import ClientDisconnectedError
+from response_cache import ResponseCache
+
+
+def test_make_key_ignores_whitespace_but_not_the_fingerprint():
+    key = ResponseCache.make_key("Age 45,  glucose 130\r\n", "fp-1")
+    assert key == ResponseCache.make_key("Age 45, glucose 130", "fp-1")
+    assert key != ResponseCache.make_key("Age 45, glucose 130", "fp-2")
+
+
+def test_memory_tier_evicts_the_least_recently_used():
+    cache = ResponseCache(memory_max_entries=2)
+    cache.put("a", "report a")
+    cache.put("b", "report b")
+    assert cache.get("a") == "report a" # a is now the most recently used
+    cache.put("c", "report c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "report a"
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["memory_bytes"] == len("report a") + len("report c")
+
+
+def test_disk_tier_survives_a_restart_and_is_promoted(tmp_path):
+    sqlite_path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(sqlite_path)
+    cache.put("a", "report a")
+    cache.close()
+
+    cache = ResponseCache(sqlite_path)
+    assert cache.get("a") == "report a"
+    assert cache.get("a") == "report a"
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["disk_entries"]) == (1, 1, 1)
+    cache.close()
+
+
+def test_concurrent_requests_are_coalesced():
+    cache = ResponseCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "report"
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_compute("key", compute) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(status for _, status in results) == ["coalesced"] * 4 + ["miss"]
+    assert all(value == "report" for value, _ in results)
+    assert asyncio.run(cache.get_or_compute("key", compute)) == ("report", "hit")
+    stats = cache.stats()
+    assert (stats["misses"], stats["coalesced"], stats["in_flight"]) == (1, 4, 0)
+
+
+def test_waiters_retry_when_the_leader_disconnects():
+    cache = ResponseCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise ClientDisconnectedError("Client disconnected while waiting for inference.")
+        return "report"
+
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_compute("key", compute, (ClientDisconnectedError,)))
+        await asyncio.sleep(0) # The leader registers its in-flight future first
+        waiters = [cache.get_or_compute("key", compute, (ClientDisconnectedError,)) for _ in range(3)]
+        return await asyncio.gather(leader, *waiters, return_exceptions=True)
+
+    leader_result, *waiter_results = asyncio.run(main())
+    assert isinstance(leader_result, ClientDisconnectedError)
+    # One waiter takes over and generates, the others are coalesced onto its run
+    assert len(calls) == 2
+    assert sorted(status for _, status in waiter_results) == ["coalesced", "coalesced", "miss"]
+    assert cache.get("key") == "report"
+
+
+def test_other_failures_reach_every_waiter_and_are_not_cached():
+    cache = ResponseCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("model crashed")
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_compute("key", compute, (ClientDisconnectedError,))
+                                      for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.get("key") is None
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_cancelled_leader_lets_a_waiter_take_over():
+    cache = ResponseCache()
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return "report"
+
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(main()) == ("report", "miss")
@@ -0,0 +1,114 @@
+# tests/test_session_store.py
+import os
+import time
+
+import pytest
+
+from session_store import SessionStore
+
+
+def session_state(text, size_bytes):
+    return {"text": text, "tokens": [1, 2, 3], "llama_state": bytes([len(text) % 256]) * size_bytes,
+            "fingerprint": "fp"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    session_store = SessionStore(memory_max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=100)
+    yield session_store
+    session_store.close()
+
+
+def test_least_recently_used_state_spills_to_disk(store):
+    first = store.create(session_state("first", 60))
+    second = store.create(session_state("second", 60))
+
+    stats = store.stats()
+    assert stats["spilled"] == 1
+    assert (stats["states_in_memory"], stats["states_on_disk"]) == (1, 1)
+    assert (stats["memory_bytes"], stats["disk_bytes"]) == (60, 60)
+
+    spilled = store.get(first)
+    assert spilled["state_tier"] == "disk"
+    assert spilled["llama_state"] == session_state("first", 60)["llama_state"]
+    assert spilled["tokens"] == [1, 2, 3]
+    assert store.get(second)["state_tier"] == "memory"
+
+
+def test_disk_overflow_drops_the_oldest_state_but_keeps_the_session(store):
+    first = store.create(session_state("first", 60))
+    second = store.create(session_state("second", 60))
+    store.create(session_state("third", 60)) # second spills, first is dropped from disk to make room
+
+    stats = store.stats()
+    assert (stats["spilled"], stats["dropped"]) == (2, 1)
+    assert (stats["memory_bytes"], stats["disk_bytes"]) == (60, 60)
+    assert stats["sessions"] == 3
+
+    dropped = store.get(first)
+    assert dropped["text"] == "first"
+    assert dropped["llama_state"] is None
+    assert dropped["tokens"] is None
+    assert dropped["state_tier"] is None
+    assert store.get(second)["state_tier"] == "disk"
+
+
+def test_get_refreshes_the_lru_order(store):
+    first = store.create(session_state("first", 60))
+    second = store.create(session_state("second", 60)) # first spills
+    store.get(first) # Read from disk, but now the most recently used session
+    store.update(second, session_state("second, turn 2", 60)) # Memory 120: the oldest memory state spills
+    assert store.get(first)["state_tier"] == "disk"
+    assert store.get(second)["state_tier"] == "memory"
+    assert store.get(second)["turns"] == 1
+
+
+def test_state_larger_than_the_disk_tier_is_dropped(store):
+    first = store.create(session_state("first", 150))
+    stats = store.stats()
+    assert (stats["spilled"], stats["dropped"]) == (0, 1)
+    assert (stats["memory_bytes"], stats["disk_bytes"]) == (0, 0)
+    assert store.get(first)["llama_state"] is None
+
+
+def test_update_replaces_a_spilled_state(store, tmp_path):
+    first = store.create(session_state("first", 60))
+    store.create(session_state("second", 60)) # first spills
+    store.update(first, session_state("first, turn 2", 30)) # Replaces the disk copy, memory is now 90
+    stats = store.stats()
+    assert (stats["memory_bytes"], stats["disk_bytes"]) == (90, 0)
+    spill_files = [name for _, _, names in os.walk(tmp_path) for name in names]
+    assert spill_files == []
+
+
+def test_max_sessions_removes_the_least_recently_used():
+    store = SessionStore(max_sessions=2)
+    first = store.create(session_state("first", 10))
+    second = store.create(session_state("second", 10))
+    store.get(first)
+    store.create(session_state("third", 10))
+    assert store.get(second) is None
+    assert store.get(first) is not None
+    assert store.stats()["removed"] == 1
+    store.close()
+
+
+def test_sessions_expire_after_their_ttl():
+    store = SessionStore(ttl_seconds=0.05)
+    session_id = store.create(session_state("first", 10))
+    time.sleep(0.1)
+    assert store.get(session_id) is None
+    assert store.update(session_id, session_state("first", 10)) is False
+    stats = store.stats()
+    assert (stats["expired"], stats["sessions"], stats["memory_bytes"]) == (1, 0, 0)
+    store.close()
+
+
+def test_without_disk_dir_states_over_the_memory_limit_are_dropped():
+    store = SessionStore(memory_max_bytes=100)
+    first = store.create(session_state("first", 60))
+    store.create(session_state("second", 60))
+    stats = store.stats()
+    assert (stats["spilled"], stats["dropped"], stats["memory_bytes"]) == (0, 1, 60)
+    assert store.get(first)["text"] == "first"
+    store.close()
@@ -0,0 +1,109 @@
+# tests/test_tracking_summary.py
+import json
+import random
+
+import pytest
+
+from tracking_summary import TrackingDataError, TrackingSummarizer, summarize_tracking_data
+
+RECORDS = [
+    {"date": f"2024-03-{day:02d}T08:00:00", "steps": 6000 + 250 * day, "systolic": 120 + day, "diastolic": 80,
+     "glucose": 95 + day, "notes": "café"}
+    for day in range(1, 15)
+]
+
+
+def as_csv(records):
+    lines = ["Date,Steps,Systolic,Diastolic,Glucose,Notes"]
+    lines += [",".join(str(record[field]) for field in ("date", "steps", "systolic", "diastolic", "glucose", "notes"))
+              for record in records]
+    return "﻿" + "\r\n".join(lines) + "\r\n" # Excel export: BOM and CRLF
+
+
+def as_json(records):
+    return json.dumps(records, indent=2, ensure_ascii=False)
+
+
+def as_ndjson(records):
+    return "\n".join(json.dumps(record, ensure_ascii=False) for record in records)
+
+
+def split_at(data, boundaries):
+    boundaries = sorted(set(boundaries))
+    return [data[start:end] for start, end in zip([0] + boundaries, boundaries + [len(data)])]
+
+
+def summarize(chunks, content_type):
+    summarizer = TrackingSummarizer(content_type)
+    for chunk in chunks:
+        summarizer.feed(chunk)
+    return summarizer.close()
+
+
+@pytest.mark.parametrize("content_type, render", [
+    ("text/csv", as_csv),
+    ("application/json", as_json),
+    ("application/x-ndjson", as_ndjson),
+])
+def test_chunk_boundaries_do_not_change_the_summary(content_type, render):
+    data = render(RECORDS).encode("utf-8")
+    expected = summarize([data], content_type)
+    assert expected["records"] == len(RECORDS)
+    assert expected["samples"] == 3 * len(RECORDS) # Steps, blood pressure and glucose
+    assert expected["ignored_fields"] == ["notes"]
+
+    # Byte by byte splits every record, number, UTF-8 character ("é", the BOM) and CRLF pair
+    assert summarize([data[i:i + 1] for i in range(len(data))], content_type) == expected
+    rng = random.Random(0)
+    for _ in range(20):
+        boundaries = rng.sample(range(1, len(data)), 12)
+        assert summarize(split_at(data, boundaries), content_type) == expected
+
+
+def test_long_and_wide_records_give_the_same_metrics():
+    long_records = []
+    for record in RECORDS:
+        long_records += [
+            {"timestamp": record["date"], "metric": "steps", "value": record["steps"]},
+            {"timestamp": record["date"], "metric": "bp", "value": f"{record['systolic']}/{record['diastolic']}"},
+            {"timestamp": record["date"], "metric": "blood_sugar", "value": record["glucose"]},
+        ]
+    wide = summarize([as_ndjson(RECORDS).encode("utf-8")], "application/x-ndjson")
+    long = summarize([as_ndjson(long_records).encode("utf-8")], "application/x-ndjson")
+    assert long["metrics"] == wide["metrics"]
+    assert long["samples"] == wide["samples"]
+    assert wide["metrics"]["steps"]["days"] == len(RECORDS)
+    assert (wide["first_date"], wide["last_date"]) == ("2024-03-01", "2024-03-14")
+
+
+def test_invalid_records_are_skipped_and_reported():
+    data = "date,steps\n2024-03-01,8000\nnot a date,9000\n2024-03-02,8000,extra\n2024-03-03,-5\n2024-03-04,7000\n"
+    summary = summarize([data.encode("utf-8")], "text/csv")
+    assert (summary["records"], summary["skipped_records"], summary["samples"]) == (2, 3, 2)
+    assert len(summary["errors"]) == 3
+
+
+def test_truncated_json_array_is_rejected():
+    data = as_json(RECORDS).encode("utf-8")
+    with pytest.raises(TrackingDataError, match="cut off"):
+        summarize([data[:data.rindex(b"]")]], "application/json")
+    with pytest.raises(TrackingDataError, match="Invalid JSON"):
+        summarize([data[:data.index(b"caf", len(data) // 2)]], "application/json") # Inside a string
+
+
+def test_record_longer_than_the_limit_is_rejected():
+    summarizer = TrackingSummarizer("application/x-ndjson", max_record_bytes=100)
+    with pytest.raises(TrackingDataError, match="longer than"):
+        summarizer.feed(b'{"date": "2024-03-01", "steps": ' + b" " * 200)
+
+
+def test_csv_needs_a_timestamp_column():
+    with pytest.raises(TrackingDataError, match="timestamp column"):
+        summarize([b"steps,glucose\n8000,100\n"], "text/csv")
+
+
+def test_summary_block_covers_the_metrics():
+    summary, summary_block = summarize_tracking_data([as_csv(RECORDS).encode("utf-8")], "text/csv")
+    assert summary["samples"] == 3 * len(RECORDS)
+    assert summary_block
+    assert "2024-03-01" in summary_block and "2024-03-14" in summary_block
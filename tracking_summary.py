@@ -0,0 +1,449 @@
+# tracking_summary.py
+import codecs
+import csv
+import json
+import logging
+import math
+import time
+from array import array
+from datetime import datetime, timezone
+
+import numpy as np
+
+from prompt_templates import PromptTemplates
+
+logger = logging.getLogger(__name__)
+
+# Ingestion of longitudinal wearable / tracker data (see POST /tracking/summary). Records are parsed as they
+# stream in and only their numbers are kept (array('d') buffers per metric, no per-sample Python objects); the
+# aggregates are computed with NumPy at the end, and the summary block for the prompt has the same size however
+# long the history is.
+#
+# Accepted record shapes (CSV rows with a header line, JSON objects in an array, or NDJSON lines):
+# - long: {"timestamp": ..., "metric": "steps", "value": 8123}, blood pressure as "value": "132/84"
+# - wide: {"date": ..., "steps": 8123, "systolic": 132, "diastolic": 84, "glucose": 104, "screen_time": 5.5}
+# Timestamps are ISO 8601 dates / datetimes (UTC if no offset is given) or Unix epoch seconds (milliseconds are
+# recognised by their size).
+
+# Metrics, their unit, how samples are combined per calendar day ("sum": daily totals, None: every sample is a
+# reading of its own) and the range of plausible values (anything outside is treated as a sensor / entry error)
+TRACKING_METRICS = {
+    "steps": {"unit": "steps", "daily": "sum", "plausible": (0, 100000)},
+    "blood_pressure": {"unit": "mmHg", "daily": None, "plausible": ((50, 300), (30, 200))},  # (systolic, diastolic)
+    "glucose": {"unit": "mg/dL", "daily": None, "plausible": (10, 1000)},
+    "screen_time": {"unit": "h", "daily": "sum", "plausible": (0, 24)},
+}
+METRIC_ALIASES = {
+    "step_count": "steps",
+    "bp": "blood_pressure",
+    "blood_sugar": "glucose",
+    "screen_time_hours": "screen_time",
+}
+TIMESTAMP_FIELDS = ("timestamp", "date", "datetime", "time")
+
+SECONDS_PER_DAY = 86400.0
+
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+class TrackingDataError(ValueError):
+    """Raised for input that cannot be summarized at all (format, header, no usable samples). Maps to 400."""
+    pass
+
+
+class TrackingDataTooLargeError(TrackingDataError):
+    """Raised when the input has more than max_samples samples. Maps to 413."""
+    pass
+
+
+class TrackingSummarizer:
+    """
+    Incremental parser + summarizer for one upload: feed() the raw body chunk by chunk, then close() returns
+    the summary dict (see summarize). Single use and not thread safe; feed() may run in a worker thread.
+    """
+
+    def __init__(self, content_type="text/csv", max_samples=5000000, max_record_bytes=64 * 1024, recent_days=7,
+                 max_reported_errors=5):
+        media_type = (content_type or "text/csv").split(";")[0].strip().lower()
+        if media_type not in CONTENT_TYPES:
+            raise TrackingDataError(f"Unsupported content type {media_type!r}; send one of {', '.join(CONTENT_TYPES)}.")
+        self.format = CONTENT_TYPES[media_type]
+        self.max_samples = max_samples
+        self.max_record_bytes = max_record_bytes
+        self.recent_days = recent_days
+        self.max_reported_errors = max_reported_errors
+
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._csv_header = None
+        self._json_state = "start" # "start" -> "items" -> "done"
+        self._last_timestamp = (None, None) # Consecutive records mostly share their timestamp string
+
+        self._times = {metric: array("d") for metric in TRACKING_METRICS}
+        self._values = {metric: array("d") for metric in TRACKING_METRICS}
+        self._diastolic = array("d") # Paired with self._values["blood_pressure"] (systolic)
+        self.samples = 0
+        self.records = 0
+        self.skipped_records = 0
+        self.errors = []
+        self.ignored_fields = set()
+
+    # --- Parsing ---
+
+    def feed(self, chunk):
+        """Parses the complete records in chunk (bytes); a partial record at the end waits for the next chunk."""
+        self._feed_text(self._decoder.decode(chunk))
+
+    def close(self):
+        """Parses what is left and returns the summary."""
+        self._feed_text(self._decoder.decode(b"", final=True), final=True)
+        if self.format == "json" and self._json_state != "done":
+            raise TrackingDataError("JSON input must be an array of records and was cut off before its closing ']'.")
+        if self.samples == 0:
+            detail = f" First errors: {'; '.join(self.errors)}" if self.errors else ""
+            raise TrackingDataError(f"No usable samples found in {self.records} records.{detail}")
+        return self.summarize()
+
+    def _feed_text(self, text, final=False):
+        self._buffer += text
+        if self.format == "json":
+            self._parse_json_items(final)
+        else:
+            if final:
+                complete, self._buffer = self._buffer, ""
+            else:
+                complete, _, self._buffer = self._buffer.rpartition("\n")
+            if complete:
+                if self.format == "csv":
+                    self._parse_csv_lines(complete.splitlines())
+                else:
+                    for line in complete.splitlines():
+                        if line.strip():
+                            self._parse_json_record(line)
+        if len(self._buffer) > self.max_record_bytes:
+            raise TrackingDataError(f"A record is longer than {self.max_record_bytes} bytes; is the input in the declared format?")
+
+    def _parse_csv_lines(self, lines):
+        for row in csv.reader(lines):
+            if not row or not any(cell.strip() for cell in row):
+                continue
+            if self._csv_header is None:
+                self._csv_header = [cell.strip().lower() for cell in row]
+                if not self._csv_header or not set(self._csv_header).intersection(TIMESTAMP_FIELDS):
+                    raise TrackingDataError(f"The CSV header needs a timestamp column ({', '.join(TIMESTAMP_FIELDS)}).")
+                continue
+            if len(row) != len(self._csv_header):
+                self._skip(f"expected {len(self._csv_header)} columns, got {len(row)}")
+                continue
+            self._add_record(dict(zip(self._csv_header, row)))
+
+    def _parse_json_record(self, line):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            self._skip(f"invalid JSON ({e.msg})")
+            return
+        self._add_json_record(record)
+
+    def _add_json_record(self, record):
+        if not isinstance(record, dict):
+            self._skip("record is not a JSON object")
+            return
+        self._add_record({str(key).lower(): value for key, value in record.items()})
+
+    def _parse_json_items(self, final):
+        # Incremental decoding of a top-level array: decode one complete element at a time, keep the rest buffered
+        buffer, position = self._buffer, 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position >= len(buffer) or self._json_state == "done":
+                break
+            if self._json_state == "start":
+                if buffer[position] != "[":
+                    raise TrackingDataError("JSON input must be an array of records (or send application/x-ndjson).")
+                self._json_state = "items"
+                position += 1
+                continue
+            if buffer[position] == "]":
+                self._json_state = "done"
+                position += 1
+                continue
+            try:
+                record, position = self._json_decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                if final:
+                    raise TrackingDataError(f"Invalid JSON at character {e.pos}: {e.msg}")
+                break # Element not complete yet
+            self._add_json_record(record)
+        self._buffer = buffer[position:]
+        if self._json_state == "done" and self._buffer.strip():
+            raise TrackingDataError("Unexpected data after the JSON array.")
+
+    # --- Records ---
+
+    def _skip(self, reason):
+        self.skipped_records += 1
+        if len(self.errors) < self.max_reported_errors:
+            self.errors.append(f"record {self.records + self.skipped_records}: {reason}")
+
+    def _add_record(self, record):
+        timestamp = next((record[field] for field in TIMESTAMP_FIELDS if record.get(field) not in (None, "")), None)
+        try:
+            if timestamp is None:
+                raise ValueError("no timestamp")
+            epoch_seconds = self._parse_timestamp(timestamp)
+            if "metric" in record:
+                # Long format: one sample per record
+                metric = str(record["metric"]).strip().lower()
+                metric = METRIC_ALIASES.get(metric, metric)
+                if metric not in TRACKING_METRICS:
+                    raise ValueError(f"unknown metric {record['metric']!r}")
+                samples = [(metric, record.get("value"))]
+            else:
+                # Wide format: every known column with a value is a sample; systolic + diastolic form a reading
+                samples = []
+                for field, value in record.items():
+                    if field in TIMESTAMP_FIELDS or value in (None, ""):
+                        continue
+                    metric = METRIC_ALIASES.get(field, field)
+                    if metric in TRACKING_METRICS:
+                        samples.append((metric, value))
+                    elif field not in ("systolic", "diastolic"):
+                        self.ignored_fields.add(field)
+                if record.get("systolic") not in (None, "") or record.get("diastolic") not in (None, ""):
+                    samples.append(("blood_pressure", (record.get("systolic"), record.get("diastolic"))))
+                if not samples:
+                    raise ValueError("no known metric in the record")
+            parsed = [(metric, self._parse_value(metric, value)) for metric, value in samples]
+        except (ValueError, TypeError) as e:
+            self._skip(str(e))
+            return
+
+        if self.samples + len(parsed) > self.max_samples:
+            raise TrackingDataTooLargeError(f"More than {self.max_samples} samples; send a shorter history.")
+        self.records += 1
+        for metric, value in parsed:
+            self._times[metric].append(epoch_seconds)
+            if metric == "blood_pressure":
+                self._values[metric].append(value[0])
+                self._diastolic.append(value[1])
+            else:
+                self._values[metric].append(value)
+            self.samples += 1
+
+    def _parse_timestamp(self, timestamp):
+        if timestamp == self._last_timestamp[0]:
+            return self._last_timestamp[1]
+        if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+            epoch_seconds = float(timestamp)
+        else:
+            text = str(timestamp).strip()
+            try:
+                epoch_seconds = float(text)
+            except ValueError:
+                parsed = datetime.fromisoformat(text) # ValueError for anything that is not ISO 8601
+                if parsed.tzinfo is None:
+                    parsed = parsed.replace(tzinfo=timezone.utc)
+                epoch_seconds = parsed.timestamp()
+        if epoch_seconds > 1e11: # Epoch milliseconds (1e11 seconds is the year 5138)
+            epoch_seconds /= 1000.0
+        if not math.isfinite(epoch_seconds):
+            raise ValueError(f"invalid timestamp {timestamp!r}")
+        self._last_timestamp = (timestamp, epoch_seconds)
+        return epoch_seconds
+
+    @staticmethod
+    def _parse_number(value, plausible, name):
+        number = float(value)
+        if not (plausible[0] <= number <= plausible[1]): # Also rejects NaN
+            raise ValueError(f"{name} value {value!r} outside {plausible[0]}-{plausible[1]}")
+        return number
+
+    def _parse_value(self, metric, value):
+        plausible = TRACKING_METRICS[metric]["plausible"]
+        if metric != "blood_pressure":
+            return self._parse_number(value, plausible, metric)
+        if isinstance(value, str):
+            value = value.split("/")
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise ValueError(f"blood pressure needs systolic and diastolic (e.g. \"132/84\"), got {value!r}")
+        return (self._parse_number(value[0], plausible[0], "systolic"),
+                self._parse_number(value[1], plausible[1], "diastolic"))
+
+    # --- Aggregates ---
+
+    def _describe(self, x_days, values):
+        """Vectorized statistics of one series; x_days are the sample times in days (for recency and trend)."""
+        p10, median, p90 = np.percentile(values, [10, 50, 90])
+        recent = values[x_days > x_days.max() - self.recent_days]
+        trend_per_week = None
+        if len(values) >= 3 and np.ptp(x_days) >= 2:
+            x_centered = x_days - x_days.mean()
+            # Least-squares slope per day, times 7
+            trend_per_week = float(np.dot(x_centered, values - values.mean()) / np.dot(x_centered, x_centered) * 7)
+        return {
+            "mean": float(values.mean()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "p10": float(p10),
+            "median": float(median),
+            "p90": float(p90),
+            "recent_mean": float(recent.mean()),
+            "trend_per_week": trend_per_week,
+        }
+
+    @staticmethod
+    def _categories(reference, category_indexes):
+        thresholds = PromptTemplates.REFERENCE_THRESHOLDS[reference]
+        counts = np.bincount(category_indexes, minlength=len(thresholds["labels"]))
+        categories = dict(zip(thresholds["labels"], counts.tolist()))
+        return categories, sum(categories[label] for label in thresholds["out_of_range"])
+
+    @staticmethod
+    def _category_indexes(reference, values):
+        return np.searchsorted(PromptTemplates.REFERENCE_THRESHOLDS[reference]["edges"], values, side="right")
+
+    def summarize(self):
+        """
+        Returns {"metrics": {metric: aggregates}, "first_date", "last_date", "records", "samples",
+        "skipped_records", "errors", "ignored_fields"}. Daily metrics are aggregated per UTC calendar day first.
+        """
+        metrics = {}
+        first_times, last_times = [], []
+        for metric, spec in TRACKING_METRICS.items():
+            if not self._values[metric]:
+                continue
+            times = np.frombuffer(self._times[metric], dtype=np.float64)
+            values = np.frombuffer(self._values[metric], dtype=np.float64)
+            first_times.append(times.min())
+            last_times.append(times.max())
+            if spec["daily"] == "sum":
+                unique_days, day_indexes = np.unique(np.floor(times / SECONDS_PER_DAY), return_inverse=True)
+                x_days, values = unique_days, np.bincount(day_indexes, weights=values)
+                aggregates = {"unit": f"{spec['unit']}/day", "samples": len(times), "days": len(unique_days)}
+            else:
+                x_days = times / SECONDS_PER_DAY
+                aggregates = {"unit": spec["unit"], "samples": len(times),
+                              "days": len(np.unique(np.floor(x_days)))}
+
+            if metric == "blood_pressure":
+                diastolic = np.frombuffer(self._diastolic, dtype=np.float64)
+                aggregates["systolic"] = self._describe(x_days, values)
+                aggregates["diastolic"] = self._describe(x_days, diastolic)
+                # A reading is as high as the worse of its two values: map the diastolic categories onto the
+                # systolic ones (which include "elevated") by label
+                systolic_labels = PromptTemplates.REFERENCE_THRESHOLDS["systolic"]["labels"]
+                diastolic_to_systolic = np.array([systolic_labels.index(label) for label in
+                                                  PromptTemplates.REFERENCE_THRESHOLDS["diastolic"]["labels"]])
+                category_indexes = np.maximum(
+                    self._category_indexes("systolic", values),
+                    diastolic_to_systolic[self._category_indexes("diastolic", diastolic)],
+                )
+                aggregates["categories"], aggregates["out_of_range"] = self._categories("systolic", category_indexes)
+            else:
+                aggregates.update(self._describe(x_days, values))
+                if metric in PromptTemplates.REFERENCE_THRESHOLDS:
+                    aggregates["categories"], aggregates["out_of_range"] = self._categories(
+                        metric, self._category_indexes(metric, values))
+            metrics[metric] = aggregates
+
+        return {
+            "metrics": metrics,
+            "first_date": _iso_date(min(first_times)) if first_times else None,
+            "last_date": _iso_date(max(last_times)) if last_times else None,
+            "records": self.records,
+            "samples": self.samples,
+            "skipped_records": self.skipped_records,
+            "errors": list(self.errors),
+            "ignored_fields": sorted(self.ignored_fields)[:20],
+        }
+
+
+def _iso_date(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, tz=timezone.utc).date().isoformat()
+
+
+def _number(value, decimals=0):
+    return f"{value:,.{decimals}f}"
+
+
+def _trend(value, unit, decimals=0):
+    if value is None:
+        return ""
+    return f", trend {value:+,.{decimals}f} {unit} per week"
+
+
+def _category_text(categories, noun):
+    return ", ".join(f"{label}: {count} {noun}" for label, count in categories.items() if count)
+
+
+def render_summary_block(summary, recent_days=7):
+    """
+    Renders a summary (TrackingSummarizer.summarize) as the compact text block for the prompt: one line per metric,
+    so its size does not depend on the length of the history. Uses the words health_input_parser looks for, so the
+    matching reference ranges are added to the prompt.
+    """
+    metrics = summary["metrics"]
+    lines = [f"Wearable tracking summary, {summary['first_date']} to {summary['last_date']}:"]
+    steps = metrics.get("steps")
+    if steps:
+        lines.append(
+            f"- Daily steps ({steps['days']} days): mean {_number(steps['mean'])}, median {_number(steps['median'])}, "
+            f"10th-90th percentile {_number(steps['p10'])}-{_number(steps['p90'])}, last {recent_days} days mean "
+            f"{_number(steps['recent_mean'])}{_trend(steps['trend_per_week'], 'steps/day')}; "
+            f"{_category_text(steps['categories'], 'days')}."
+        )
+    blood_pressure = metrics.get("blood_pressure")
+    if blood_pressure:
+        systolic, diastolic = blood_pressure["systolic"], blood_pressure["diastolic"]
+        lines.append(
+            f"- Blood pressure ({blood_pressure['samples']} readings over {blood_pressure['days']} days): mean "
+            f"{_number(systolic['mean'])}/{_number(diastolic['mean'])} mmHg, median {_number(systolic['median'])}/"
+            f"{_number(diastolic['median'])}, 90th percentile {_number(systolic['p90'])}/{_number(diastolic['p90'])}, "
+            f"highest {_number(systolic['max'])}/{_number(diastolic['max'])}, last {recent_days} days mean "
+            f"{_number(systolic['recent_mean'])}/{_number(diastolic['recent_mean'])}"
+            f"{_trend(systolic['trend_per_week'], 'mmHg systolic', 1)}; "
+            f"{_category_text(blood_pressure['categories'], 'readings')}."
+        )
+    glucose = metrics.get("glucose")
+    if glucose:
+        lines.append(
+            f"- Blood glucose ({glucose['samples']} samples over {glucose['days']} days): mean "
+            f"{_number(glucose['mean'])} mg/dL, median {_number(glucose['median'])}, 10th-90th percentile "
+            f"{_number(glucose['p10'])}-{_number(glucose['p90'])}, highest {_number(glucose['max'])}, last "
+            f"{recent_days} days mean {_number(glucose['recent_mean'])}{_trend(glucose['trend_per_week'], 'mg/dL', 1)}; "
+            f"{_category_text(glucose['categories'], 'samples')} (timing of samples unknown)."
+        )
+    screen_time = metrics.get("screen_time")
+    if screen_time:
+        lines.append(
+            f"- Daily screen time ({screen_time['days']} days): mean {_number(screen_time['mean'], 1)} h, median "
+            f"{_number(screen_time['median'], 1)} h, 90th percentile {_number(screen_time['p90'], 1)} h, last "
+            f"{recent_days} days mean {_number(screen_time['recent_mean'], 1)} h"
+            f"{_trend(screen_time['trend_per_week'], 'h/day', 1)}."
+        )
+    return "\n".join(lines)
+
+
+def summarize_tracking_data(chunks, content_type="text/csv", **summarizer_options):
+    """
+    Convenience wrapper for iterables of bytes chunks (files, tests, scripts): returns (summary, summary_block).
+    Raises TrackingDataError for unusable input.
+    """
+    start_time = time.time()
+    summarizer = TrackingSummarizer(content_type, **summarizer_options)
+    for chunk in chunks:
+        summarizer.feed(chunk)
+    summary = summarizer.close()
+    summary_block = render_summary_block(summary, summarizer.recent_days)
+    logger.info(f"Tracking data: {summary['samples']} samples summarized in {time.time() - start_time:.3f} seconds.")
+    return summary, summary_block
@@ -1,5 +1,7 @@
-import streamlit as st
+import ipaddress
 import re
+import socket
+from urllib.parse import urlsplit
 
 def validate_input(text, min_length=50):
     """Validate user input"""
@@ -7,21 +9,150 @@ def validate_input(text, min_length=50):
         return False, f"Please provide at least {min_length} characters"
     return True, ""
 
+def validate_callback_url(url, allowed_hosts=None):
+    """
+    Validate a job callback URL: http(s) only. With allowed_hosts the host must be one of them; otherwise every
+    address it resolves to must be public, so callbacks cannot reach the server's own network (loopback, private,
+    link-local / cloud metadata addresses). Resolves the host name, so it blocks.
+    """
+    try:
+        parsed = urlsplit(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        return False, "callback_url is not a valid URL"
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False, "callback_url must be an http(s) URL"
+    host = parsed.hostname.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            return False, f"callback_url host {host} is not in the allowed callback hosts"
+        return True, ""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)}
+    except (OSError, UnicodeError):
+        return False, f"callback_url host {host} cannot be resolved"
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0]) # Drop an IPv6 zone id
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            return False, f"callback_url host {host} resolves to a non-public address"
+    return True, ""
+
+# Boilerplate openings the model likes to start with; removed by format_response
+RESPONSE_PREFIXES_TO_REMOVE = [
+    "Based on the information provided,",
+    "According to your health data,",
+    "Here are my recommendations:",
+    "I recommend the following:"
+]
+
+# Section headers as the model writes them, e.g. "**1. Short-Term Risks**" or "**5.Food Recommendations**"
+SECTION_HEADER_PATTERN = re.compile(r'\*\*\s*([1-7])\.\s*([^*\n]+?)\s*\*\*')
+
+# The 7 report sections the system prompt asks for: (number, title, field name in the API's ReportSections)
+REPORT_SECTIONS = [
+    (1, "Short-Term Risks", "short_term_risks"),
+    (2, "Long-Term Risks (Chronic)", "long_term_risks"),
+    (3, "Warnings", "warnings"),
+    (4, "Advice", "advice"),
+    (5, "Food Recommendations", "food_recommendations"),
+    (6, "Exercise Recommendations", "exercise_recommendations"),
+    (7, "Early Detection & Preventive Care", "early_detection_and_preventive_care"),
+]
+
 def format_response(response):
     """Format the model response for readability"""
     response = response.strip()
-    prefixes_to_remove = [
-        "Based on the information provided,",
-        "According to your health data,",
-        "Here are my recommendations:",
-        "I recommend the following:"
-    ]
-    for prefix in prefixes_to_remove:
+    for prefix in RESPONSE_PREFIXES_TO_REMOVE:
         if response.lower().startswith(prefix.lower()):
             response = response[len(prefix):].strip()
     response = re.sub(r'\n\s*\n', '\n\n', response)
     return response
 
+class StreamingResponseFormatter:
+    """
+    Incremental version of format_response for streamed output.
+    feed() returns the text that is safe to send now; finish() returns the rest.
+    The concatenation of all returned pieces equals format_response(full_text).
+    """
+
+    def __init__(self):
+        self._head = ""  # Raw text held back until we know whether it starts with a removable prefix
+        self._head_resolved = False
+        self._pending_whitespace = ""  # Trailing whitespace held back until we know how to collapse it
+
+    def _resolve_head(self, text):
+        """Mirrors the prefix loop of format_response. Returns None while more text is needed to decide."""
+        text = text.lstrip()
+        for prefix in RESPONSE_PREFIXES_TO_REMOVE:
+            if text.lower().startswith(prefix.lower()):
+                text = text[len(prefix):].lstrip()
+            elif prefix.lower().startswith(text.lower()):
+                return None # Could still turn into this prefix
+        return text
+
+    def _collapse(self, text):
+        # Whitespace at the end of a chunk may continue in the next one, so it is held back
+        text = self._pending_whitespace + text
+        stripped = text.rstrip()
+        self._pending_whitespace = text[len(stripped):]
+        return re.sub(r'\n\s*\n', '\n\n', stripped)
+
+    def feed(self, chunk):
+        if not self._head_resolved:
+            self._head += chunk
+            resolved = self._resolve_head(self._head)
+            if resolved is None:
+                return ""
+            self._head_resolved = True
+            self._head = ""
+            chunk = resolved
+        return self._collapse(chunk)
+
+    def finish(self):
+        if not self._head_resolved:
+            self._head_resolved = True
+            return format_response(self._head)
+        self._pending_whitespace = "" # format_response strips trailing whitespace
+        return ""
+
+class ReportSectionTracker:
+    """Watches formatted streamed text and reports each "**N. Title**" header once it is complete."""
+
+    def __init__(self):
+        self.text = ""
+        self.current_section = None
+        self._scan_from = 0
+
+    def feed(self, text):
+        """Appends text and returns a list of (section_number, title) for headers completed by it."""
+        self.text += text
+        completed = []
+        for match in SECTION_HEADER_PATTERN.finditer(self.text, self._scan_from):
+            section_number = int(match.group(1))
+            completed.append((section_number, match.group(2).strip()))
+            self.current_section = section_number
+            self._scan_from = match.end()
+        return completed
+
+def parse_report_sections(text):
+    """
+    Splits a formatted report into its sections: {field name: section text} for every "**N. Title**" header found
+    (a repeated number keeps the first one). Returns None if the text has no section headers at all.
+    """
+    matches = list(SECTION_HEADER_PATTERN.finditer(text or ""))
+    if not matches:
+        return None
+    field_names = {number: field_name for number, _, field_name in REPORT_SECTIONS}
+    sections = {}
+    for i, match in enumerate(matches):
+        field_name = field_names[int(match.group(1))]
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        if field_name not in sections:
+            sections[field_name] = text[match.end():end].strip()
+    return sections
+
 def create_example_data():
     """Create example data for users"""
     return {
@@ -35,6 +166,8 @@ Health Tracking data: Blood Pressure: 120/80 mmHg, Diabetes (Fasting: 95 mg/dL,
 
 def display_disclaimer():
     """Display medical disclaimer"""
+    # Imported here so the API (which also uses this module) never loads Streamlit; only the UI calls this
+    import streamlit as st
     st.warning("""
     ⚠️ **Medical Disclaimer**: This AI Health Advisor provides general wellness recommendations and should not replace professional medical advice. 
     Always consult with qualified healthcare professionals for medical concerns, diagnosis, or treatment decisions.
@@ -0,0 +1,452 @@
+# worker_pool.py
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# ModelManager methods that are generators; their items are sent back one message at a time
+STREAM_METHODS = ("generate_response_stream", "generate_batch")
+
+
+def available_cpus():
+    """CPU ids this process may run on (respects cgroup / taskset limits where the OS exposes them)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def physical_core_cpus(cpus):
+    """
+    Picks one logical CPU per physical core from `cpus` (Linux sysfs topology).
+    llama.cpp gains little from SMT siblings, so workers are pinned to distinct cores first.
+    Falls back to `cpus` unchanged when the topology is not available.
+    """
+    seen_cores = set()
+    selected = []
+    for cpu in cpus:
+        siblings_path = f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        try:
+            with open(siblings_path) as f:
+                core_key = f.read().strip()
+        except OSError:
+            return list(cpus)
+        if core_key not in seen_cores:
+            seen_cores.add(core_key)
+            selected.append(cpu)
+    return selected
+
+
+def partition_cpus(num_workers, threads_per_worker=None):
+    """
+    Splits the available cores into `num_workers` disjoint slices.
+    Returns (slices, threads_per_worker). Physical cores are used first; SMT siblings only
+    if more threads were requested than there are physical cores.
+    """
+    cpus = available_cpus()
+    cores = physical_core_cpus(cpus)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, len(cores) // num_workers)
+    needed = threads_per_worker * num_workers
+    pool = cores if needed <= len(cores) else cpus
+    if needed > len(pool):
+        logger.warning(
+            f"{num_workers} workers x {threads_per_worker} threads = {needed} threads, but only {len(pool)} CPUs are "
+            f"available. Threads will be oversubscribed; lower num_workers or threads_per_worker."
+        )
+        # Wrap around so every worker still gets a slice of the right size
+        pool = list(itertools.islice(itertools.cycle(pool), needed))
+    slices = [pool[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(num_workers)]
+    return slices, threads_per_worker
+
+
+def _worker_main(worker_id, conn, cpus, n_threads, pin_cpus):
+    """
+    Entry point of a worker process: pins itself to its cores, loads its own model variants (ModelVariantRegistry)
+    and then serves requests from `conn` one at a time. Imports happen here so the parent never needs llama.cpp for this.
+    """
+    # Ctrl-C reaches the whole process group; the parent decides when workers stop (shutdown message), so the
+    # requests in flight can still finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if pin_cpus and cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            logger.warning(f"Worker {worker_id}: could not set CPU affinity to {cpus}: {str(e)}")
+
+    from model_variants import ModelVariantRegistry
+
+    # The core slice wins over MODEL_CONFIG and any tuning profile; MODEL_CONFIG itself stays as in the parent, so
+    # prefix snapshots and session states keep the same fingerprints in every process
+    model_manager = ModelVariantRegistry(llama_overrides={"n_threads": n_threads, "n_threads_batch": n_threads})
+    loaded = model_manager.load_model()
+    conn.send(("ready", worker_id, loaded, model_manager.tuning_profile, model_manager.loaded_variants()))
+    if not loaded:
+        return
+
+    pending = deque() # Requests that arrived while a stream was being generated
+
+    def drop_pending(request_id):
+        # A cancelled request that has not started yet is simply never run
+        for queued in list(pending):
+            if queued[0] == "generate" and queued[1] == request_id:
+                pending.remove(queued)
+                conn.send(("end", request_id, None))
+
+    while True:
+        message = pending.popleft() if pending else conn.recv()
+        kind = message[0]
+        if kind == "shutdown":
+            break
+        if kind == "cancel":
+            drop_pending(message[1]) # Cancels for requests that already finished are ignored
+            continue
+
+        _, request_id, method, args = message
+        try:
+            if method in STREAM_METHODS:
+                stream = getattr(model_manager, method)(*args)
+                stream_cancelled = False
+                stream_result = None # The generator's return value (e.g. prefill stats), sent with "end"
+                try:
+                    while True:
+                        try:
+                            piece = next(stream)
+                        except StopIteration as stop:
+                            stream_result = stop.value
+                            break
+                        conn.send(("chunk", request_id, piece))
+                        # Look for a cancel of this stream without blocking; keep anything else for later
+                        while conn.poll():
+                            incoming = conn.recv()
+                            if incoming[0] == "cancel" and incoming[1] == request_id:
+                                stream_cancelled = True
+                            elif incoming[0] == "cancel":
+                                drop_pending(incoming[1])
+                            else:
+                                pending.append(incoming)
+                        if stream_cancelled:
+                            break
+                finally:
+                    stream.close()
+                conn.send(("end", request_id, stream_result))
+            else:
+                conn.send(("result", request_id, getattr(model_manager, method)(*args)))
+        except Exception as e:
+            logger.error(f"Worker {worker_id}: error while serving {method}: {str(e)}", exc_info=True)
+            conn.send(("error", request_id, str(e)))
+
+
+class ModelWorkerPool:
+    """
+    Pool of inference worker processes, each with its own llama.cpp context on a disjoint set of cores.
+    Exposes the same interface as model_variants.ModelVariantRegistry (ModelManager's plus the variant argument), so
+    the API can use either. Calls are blocking and thread safe; each one goes to the least-loaded live worker.
+    Variants are loaded on one worker after the other, so the others keep serving meanwhile.
+    """
+
+    def __init__(self, num_workers, threads_per_worker=None, pin_cpus=True, startup_timeout_seconds=600):
+        self.num_workers = max(1, int(num_workers))
+        self.pin_cpus = pin_cpus
+        self.startup_timeout_seconds = startup_timeout_seconds
+        self.cpu_slices, self.threads_per_worker = partition_cpus(self.num_workers, threads_per_worker)
+        self._context = multiprocessing.get_context("spawn") # fork + an initialised llama.cpp/BLAS is not safe
+        self._workers = []
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._responses = {} # request_id -> queue.Queue for messages from the worker
+        self._shutting_down = False
+        self._tokenizer = None # Vocab-only Llama in this process, so prompts can be measured without a round trip
+        self._tokenizer_lock = threading.Lock()
+        from config import MODEL_VARIANTS, MODEL_ROUTING_CONFIG
+        self.variants = MODEL_VARIANTS
+        self.default_variant = MODEL_ROUTING_CONFIG.get("default_variant") or next(iter(MODEL_VARIANTS))
+        self._admin_lock = threading.Lock() # One variant load / unload / activation at a time
+
+    def start(self):
+        """Starts all workers and waits until they loaded the model. Returns True if at least one is ready."""
+        for worker_id, cpus in enumerate(self.cpu_slices):
+            parent_conn, child_conn = self._context.Pipe()
+            process = self._context.Process(
+                target=_worker_main,
+                args=(worker_id, child_conn, cpus, self.threads_per_worker, self.pin_cpus),
+                name=f"model-worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._workers.append({
+                "id": worker_id,
+                "process": process,
+                "conn": parent_conn,
+                "send_lock": threading.Lock(),
+                "cpus": cpus,
+                "in_flight": set(),
+                "completed": 0,
+                "alive": False,
+                "tuning_profile": None, # Each worker tunes for its own CPU slice (AUTOTUNE_CONFIG)
+                "variants": set(), # Loaded model variants
+            })
+            logger.info(f"Started model worker {worker_id} (pid {process.pid}) on CPUs {cpus} with {self.threads_per_worker} threads.")
+
+        for worker in self._workers:
+            if not worker["conn"].poll(self.startup_timeout_seconds):
+                logger.error(f"Model worker {worker['id']} did not report ready within {self.startup_timeout_seconds}s.")
+                continue
+            try:
+                _, _, loaded, worker["tuning_profile"], variants = worker["conn"].recv()
+                worker["variants"] = set(variants)
+            except EOFError:
+                loaded = False
+            worker["alive"] = bool(loaded)
+            if loaded:
+                threading.Thread(target=self._receive_loop, args=(worker,), name=f"model-worker-{worker['id']}-recv", daemon=True).start()
+                logger.info(f"Model worker {worker['id']} is ready.")
+            else:
+                logger.error(f"Model worker {worker['id']} failed to load the model.")
+
+        ready = sum(1 for worker in self._workers if worker["alive"])
+        logger.info(f"Model worker pool: {ready}/{self.num_workers} workers ready.")
+        return ready > 0
+
+    def _receive_loop(self, worker):
+        # One thread per worker routes its messages to the waiting callers
+        while True:
+            try:
+                message = worker["conn"].recv()
+            except (EOFError, OSError):
+                break
+            request_id = message[1]
+            with self._lock:
+                response_queue = self._responses.get(request_id)
+            if response_queue is not None:
+                response_queue.put(message)
+
+        if self._shutting_down:
+            logger.info(f"Model worker {worker['id']} stopped.")
+        else:
+            logger.error(f"Model worker {worker['id']} exited unexpectedly (exit code {worker['process'].exitcode}).")
+        with self._lock:
+            worker["alive"] = False
+            orphaned = list(worker["in_flight"])
+            queues = [self._responses.get(request_id) for request_id in orphaned]
+        for request_id, response_queue in zip(orphaned, queues):
+            if response_queue is not None:
+                response_queue.put(("error", request_id, f"Model worker {worker['id']} exited unexpectedly."))
+
+    def _dispatch(self, method, args, worker=None):
+        """
+        Sends a request to `worker`, or to the least-loaded live worker if none is given.
+        Returns (worker, request_id, response_queue).
+        """
+        with self._lock:
+            live_workers = [worker for worker in self._workers if worker["alive"]]
+            if not live_workers:
+                raise ValueError("Model not loaded. No model worker is available.")
+            if worker is None:
+                worker = min(live_workers, key=lambda w: (len(w["in_flight"]), w["completed"]))
+            request_id = next(self._request_ids)
+            response_queue = queue.Queue()
+            self._responses[request_id] = response_queue
+            worker["in_flight"].add(request_id) # Before sending, so an early reply or a worker exit finds the request
+        try:
+            with worker["send_lock"]:
+                worker["conn"].send(("generate", request_id, method, args))
+        except Exception as e:
+            # E.g. the worker died meanwhile (broken pipe): nobody will answer, so nothing may wait for this request
+            with self._lock:
+                worker["in_flight"].discard(request_id)
+                self._responses.pop(request_id, None)
+            logger.error(f"Could not send {method} to model worker {worker['id']}: {str(e)}")
+            raise Exception(f"Error generating response from Llama model: model worker {worker['id']} is not reachable ({str(e)}).")
+        return worker, request_id, response_queue
+
+    def _finish(self, worker, request_id):
+        with self._lock:
+            worker["in_flight"].discard(request_id)
+            worker["completed"] += 1
+            self._responses.pop(request_id, None)
+
+    def generate_response(self, prompt, variant=None):
+        return self._call("generate_response", (prompt, variant))
+
+    def generate_response_with_stats(self, prompt, variant=None):
+        return self._call("generate_response_with_stats", (prompt, variant))
+
+    def generate_response_for_session(self, prompt, variant=None):
+        return self._call("generate_response_for_session", (prompt, variant))
+
+    def generate_followup(self, session_state, turn_text, variant=None):
+        # Session states are portable between workers (same model and MODEL_CONFIG), so any worker can continue one
+        return self._call("generate_followup", (session_state, turn_text, variant))
+
+    def warmup(self, max_tokens=16):
+        """Runs ModelManager.warmup on every live worker at the same time. Returns the slowest worker's seconds."""
+        with self._lock:
+            live_workers = [worker for worker in self._workers if worker["alive"]]
+        calls = [self._dispatch("warmup", (max_tokens,), worker=worker) for worker in live_workers]
+        return max((self._wait_result(*call) for call in calls), default=0.0)
+
+    def _call(self, method, args):
+        return self._wait_result(*self._dispatch(method, args))
+
+    def _wait_result(self, worker, request_id, response_queue):
+        try:
+            kind, _, value = response_queue.get()
+        finally:
+            self._finish(worker, request_id)
+        if kind == "error":
+            raise Exception(f"Error generating response from Llama model: {value}")
+        return value
+
+    def generate_response_stream(self, prompt, variant=None):
+        return self._stream("generate_response_stream", (prompt, variant))
+
+    def generate_batch(self, prompts, variant=None):
+        # One worker per batch: its BatchDecoder already keeps its cores busy with parallel sequences
+        return self._stream("generate_batch", (list(prompts), variant))
+
+    # --- Model variants (same methods as ModelVariantRegistry) ---
+
+    def _live_workers(self):
+        with self._lock:
+            return [worker for worker in self._workers if worker["alive"]]
+
+    def _check_variant(self, name):
+        if name not in self.variants:
+            from model_variants import UnknownModelVariantError
+            raise UnknownModelVariantError(f"Unknown model variant {name!r}; configured: {sorted(self.variants)}.")
+
+    def load_variant(self, name, reload=False):
+        """
+        Loads (or reloads) a variant on every live worker, one worker at a time: a worker does not serve while it
+        loads, the others do. Returns True if all workers have it loaded.
+        """
+        self._check_variant(name)
+        with self._admin_lock:
+            loaded_everywhere = True
+            for worker in self._live_workers():
+                if name in worker["variants"] and not reload:
+                    continue
+                try:
+                    loaded = self._wait_result(*self._dispatch("load_variant", (name, reload), worker=worker))
+                except Exception as e:
+                    logger.error(f"Model worker {worker['id']}: loading variant {name} failed: {str(e)}")
+                    loaded = False
+                if loaded:
+                    worker["variants"].add(name)
+                loaded_everywhere = loaded_everywhere and loaded
+            return loaded_everywhere
+
+    def unload_variant(self, name):
+        """Unloads a variant on every live worker. Returns False if no worker had it loaded."""
+        self._check_variant(name)
+        with self._admin_lock:
+            if name == self.default_variant:
+                raise ValueError(f"Model variant {name} is the default variant; activate another one before unloading it.")
+            unloaded = False
+            for worker in self._live_workers():
+                if name in worker["variants"]:
+                    self._wait_result(*self._dispatch("unload_variant", (name,), worker=worker))
+                    worker["variants"].discard(name)
+                    unloaded = True
+            return unloaded
+
+    def set_default_variant(self, name):
+        """Makes a variant the default one on every worker; it must be loaded on all of them."""
+        with self._admin_lock:
+            if name not in self.loaded_variants():
+                raise ValueError(f"Model variant {name} is not loaded on every worker.")
+            for worker in self._live_workers():
+                self._wait_result(*self._dispatch("set_default_variant", (name,), worker=worker))
+            previous, self.default_variant = self.default_variant, name
+        logger.info(f"Default model variant changed from {previous} to {name} on all workers.")
+        return previous
+
+    def loaded_variants(self):
+        """Variants loaded on every live worker (the ones requests can be routed to)."""
+        live_workers = self._live_workers()
+        if not live_workers:
+            return []
+        return sorted(set.intersection(*(worker["variants"] for worker in live_workers)))
+
+    def status(self):
+        loaded = self.loaded_variants()
+        return {
+            "default_variant": self.default_variant,
+            "variants": {
+                name: {"loaded": name in loaded, "model_path": spec.get("path")}
+                for name, spec in self.variants.items()
+            },
+        }
+
+    def count_tokens(self, text):
+        """Same as ModelManager.count_tokens; loads only the vocabulary of the GGUF file (no weights) on first use."""
+        with self._tokenizer_lock:
+            if self._tokenizer is None:
+                from llama_cpp import Llama
+                from config import MODEL_PATH
+                self._tokenizer = Llama(model_path=MODEL_PATH, vocab_only=True, verbose=False)
+            return len(self._tokenizer.tokenize(text.encode("utf-8")))
+
+    def _stream(self, method, args):
+        worker, request_id, response_queue = self._dispatch(method, args)
+        finished = False
+        try:
+            while True:
+                message = response_queue.get()
+                kind = message[0]
+                if kind == "chunk":
+                    yield message[2]
+                elif kind == "end":
+                    finished = True
+                    return message[2] # What the worker's generator returned
+                else:
+                    finished = True
+                    raise Exception(f"Error generating response from Llama model: {message[2]}")
+        finally:
+            if not finished and worker["alive"]:
+                # Consumer stopped early: tell the worker to stop decoding
+                with worker["send_lock"]:
+                    worker["conn"].send(("cancel", request_id))
+            self._finish(worker, request_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "num_workers": self.num_workers,
+                "threads_per_worker": self.threads_per_worker,
+                "workers": [
+                    {
+                        "id": worker["id"],
+                        "pid": worker["process"].pid,
+                        "cpus": worker["cpus"],
+                        "alive": worker["alive"],
+                        "in_flight": len(worker["in_flight"]),
+                        "completed": worker["completed"],
+                        "tuning_profile": worker["tuning_profile"],
+                        "variants": sorted(worker["variants"]),
+                    }
+                    for worker in self._workers
+                ],
+            }
+
+    def shutdown(self):
+        self._shutting_down = True
+        for worker in self._workers:
+            if worker["alive"]:
+                try:
+                    with worker["send_lock"]:
+                        worker["conn"].send(("shutdown",))
+                except OSError:
+                    pass
+        for worker in self._workers:
+            worker["process"].join(timeout=10)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+        logger.info("Model worker pool shut down.")